@@ -0,0 +1,663 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from types import SimpleNamespace
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+# Offline benchmark for the OCR and metadata paths.
+# Google Vision and OpenAI are replaced by deterministic local fakes with configurable latency and
+# error injection, and the inputs are synthetic PDF and text corpora, so runs need no credentials
+# and can be compared before and after a change. Each benchmark runs in a fresh process so its
+# peak RSS is its own.
+#
+#   python benchmark.py --pages 5,50 --density 150,600 --concurrency 4 --json results.json
+#
+# --compare-overlay-modes also builds every PDF with each overlay mode (raster, compressed, original)
+# and reports output size and peak RSS per mode.
+# --screen-check screens scanned letters that share a letterhead for duplicates and lists any page
+# matched to a different letter.
+# --startup also times how long fresh interpreters take to import the scripts and show --help.
+# Point --startup-repo at another checkout (git worktree add ../before <commit>) to compare.
+
+VOCABULARY = (
+    "archive broadcast cinema documentary editor film frame image journal media montage network "
+    "newspaper photograph press radio reel screen signal sound studio television theory viewer "
+    "analysis audience culture history industry production public report review study"
+).split()
+
+# ---------------------------------------------------------------------------
+# Fake Google Vision client
+# ---------------------------------------------------------------------------
+
+class FakeVisionClient:
+    # Stand-in for vision.ImageAnnotatorClient. Words are laid out in lines across the image and
+    # derived from a hash of the image bytes, so the same page always gets the same result.
+    def __init__(self, latency=0.3, jitter=0.1, error_rate=0.0, words_per_page=300, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.words_per_page = words_per_page
+        self.seed = seed
+        self.calls = 0
+        self.images = 0
+        self.bytes_received = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _wait(self):
+        with self._lock:
+            delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+            self.calls += 1
+        time.sleep(delay)
+
+    def _inject_error(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def document_text_detection(self, image):
+        self._wait()
+        return self._build_response(image.content)
+
+    def batch_annotate_images(self, requests):
+        # One round trip for the whole batch
+        self._wait()
+        return SimpleNamespace(responses=[self._build_response(request.image.content) for request in requests])
+
+    def _build_response(self, content):
+        from PIL import Image
+
+        with self._lock:
+            self.images += 1
+            self.bytes_received += len(content)
+        if self._inject_error():
+            return SimpleNamespace(error=SimpleNamespace(code=13, message="Injected fake Vision error"),
+                                   full_text_annotation=SimpleNamespace(pages=[]))
+
+        width, height = Image.open(io.BytesIO(content)).size
+        page_random = random.Random(hashlib.sha256(content).digest() + self.seed.to_bytes(4, "little"))
+        words_per_line = 10
+        line_count = max(1, -(-self.words_per_page // words_per_line))
+        line_height = height * 0.9 / line_count
+        word_width = width * 0.8 / words_per_line
+
+        paragraphs = []
+        words = []
+        for index in range(self.words_per_page):
+            line, column = divmod(index, words_per_line)
+            x0 = int(width * 0.1 + column * word_width)
+            y0 = int(height * 0.05 + line * line_height)
+            x1, y1 = int(x0 + word_width * 0.8), int(y0 + line_height * 0.7)
+            text = "." if column == words_per_line - 1 else page_random.choice(VOCABULARY)
+            vertices = [SimpleNamespace(x=x, y=y) for x, y in ((x0, y0), (x1, y0), (x1, y1), (x0, y1))]
+            words.append(SimpleNamespace(symbols=[SimpleNamespace(text=char) for char in text],
+                                         bounding_box=SimpleNamespace(vertices=vertices)))
+            # Five lines per paragraph
+            if len(words) == words_per_line * 5:
+                paragraphs.append(SimpleNamespace(words=words))
+                words = []
+        if words:
+            paragraphs.append(SimpleNamespace(words=words))
+
+        blocks = [SimpleNamespace(paragraphs=[paragraph]) for paragraph in paragraphs]
+        return SimpleNamespace(error=SimpleNamespace(code=0, message=""),
+                               full_text_annotation=SimpleNamespace(pages=[SimpleNamespace(blocks=blocks)]))
+
+# ---------------------------------------------------------------------------
+# Fake OpenAI chat completions
+# ---------------------------------------------------------------------------
+
+class FakeChatCompletion:
+    # Stand-in for openai.ChatCompletion.create (openai==0.28). Latency grows with the number of
+    # requested tokens; injected errors are rate limits with a Retry-After header.
+    def __init__(self, latency=1.0, seconds_per_token=0.002, error_rate=0.0, retry_after=1, seed=0):
+        self.latency = latency
+        self.seconds_per_token = seconds_per_token
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls = 0
+        self.prompt_chars = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def create(self, model, messages, max_tokens=500, temperature=0.5, **kwargs):
+        import openai
+
+        prompt = messages[-1]["content"]
+        with self._lock:
+            self.calls += 1
+            self.prompt_chars += sum(len(message["content"]) for message in messages)
+            inject_error = self._random.random() < self.error_rate
+        if inject_error:
+            raise openai.error.RateLimitError("Injected fake rate limit", headers={"Retry-After": str(self.retry_after)})
+        time.sleep(self.latency + max_tokens * self.seconds_per_token)
+
+        if "generate structured metadata" in prompt:
+            content = json.dumps({
+                "Abstract": "Synthetic abstract.", "Keywords": ["synthetic", "benchmark"],
+                "Description": "Synthetic description.", "Title": "Synthetic Title", "Creator": "Unknown",
+                "Subject": "Media studies", "Basic Keywords": ["synthetic"],
+                "Long-tail keywords": ["synthetic benchmark document"], "SEO Keywords": ["benchmark"],
+            })
+        else:
+            content = "Synthetic summary of this section. " * 10
+        return {
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4},
+        }
+
+# ---------------------------------------------------------------------------
+# Synthetic corpora
+# ---------------------------------------------------------------------------
+
+def synthetic_words(count, rng):
+    return [rng.choice(VOCABULARY) for _ in range(count)]
+
+def build_pdf_corpus(folder, page_counts, densities, kind="scanned", scan_dpi=150, seed=0):
+    # One PDF per (page count, words per page). "scanned" pages are images without a text layer,
+    # "born-digital" pages have real text, and "mixed" alternates the two.
+    import fitz
+
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    pdf_paths = []
+    for page_count in page_counts:
+        for density in densities:
+            pdf_path = os.path.join(folder, f"synthetic_{kind}_{page_count}p_{density}w.pdf")
+            pdf_paths.append(pdf_path)
+            if os.path.exists(pdf_path):
+                continue
+            document = fitz.open()
+            for page_num in range(page_count):
+                text_page_document = fitz.open()
+                text_page = text_page_document.new_page(width=612, height=792)
+                words = synthetic_words(density, rng)
+                line_height = min(14, 700 / max(1, -(-density // 12)))
+                for line_num in range(0, len(words), 12):
+                    text_page.insert_text((50, 60 + (line_num // 12) * line_height), " ".join(words[line_num:line_num + 12]),
+                                          fontsize=max(4, line_height * 0.75))
+                scanned = kind == "scanned" or (kind == "mixed" and page_num % 2 == 0)
+                if scanned:
+                    pixmap = text_page.get_pixmap(dpi=scan_dpi, colorspace=fitz.csGRAY)
+                    page = document.new_page(width=612, height=792)
+                    page.insert_image(page.rect, pixmap=pixmap)
+                else:
+                    document.insert_pdf(text_page_document)
+                text_page_document.close()
+            document.save(pdf_path, garbage=3, deflate=True)
+            document.close()
+    return pdf_paths
+
+def letterhead_page(body_seed, name="Jane Doe"):
+    # One letter on a shared letterhead: only the addressee and the body change with the arguments
+    import fitz
+
+    document = fitz.open()
+    page = document.new_page(width=612, height=792)
+    page.draw_rect(fitz.Rect(60, 40, 160, 110), color=(0, 0, 0), fill=(0.2, 0.2, 0.2))
+    page.insert_text((180, 70), "NATIONAL MEDIA ARCHIVE", fontsize=20)
+    page.insert_text((180, 92), "Department of Broadcast History - 14 Rue du Film, Paris", fontsize=9)
+    page.draw_line((60, 125), (550, 125), width=2)
+    page.insert_text((60, 160), "12 March 1984", fontsize=11)
+    page.insert_text((60, 190), f"Dear {name},", fontsize=11)
+    rng = random.Random(body_seed)
+    for line_num in range(6):
+        page.insert_text((60, 225 + 20 * line_num), " ".join(synthetic_words(11, rng)), fontsize=11)
+    page.insert_text((60, 400), "Yours sincerely,", fontsize=11)
+    page.insert_text((60, 440), "The Archivist", fontsize=11)
+    return document
+
+def scan_page(document, page, rng, shift=0, angle=0.0, blur=0.0, noise=0.0, contrast=1.0, jpeg_quality=None):
+    # Add the first page of document to page as a 200 dpi grayscale scan, shifted by up to shift
+    # pixels, rotated by angle degrees, blurred, noisier and with a contrast change
+    import fitz
+    import numpy as np
+    from PIL import Image, ImageFilter
+
+    pixmap = document[0].get_pixmap(dpi=200, colorspace=fitz.csGRAY)
+    image = Image.frombytes("L", (pixmap.width, pixmap.height), pixmap.samples)
+    if angle:
+        image = image.rotate(angle, resample=Image.BICUBIC, fillcolor=255)
+    if blur:
+        image = image.filter(ImageFilter.GaussianBlur(blur))
+    pixels = np.asarray(image, dtype=np.float32) * contrast + 255 * (1 - contrast)
+    pixels = np.roll(pixels, (rng.randint(-shift, shift), rng.randint(-shift, shift)), axis=(0, 1))
+    pixels += np.random.default_rng(rng.randrange(2 ** 32)).normal(0, noise, pixels.shape) if noise else 0
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    buffer = io.BytesIO()
+    if jpeg_quality:
+        image.save(buffer, "JPEG", quality=jpeg_quality)
+    else:
+        image.save(buffer, "PNG")
+    page.insert_image(page.rect, stream=buffer.getvalue())
+
+def build_letterhead_corpus(folder, seed=0):
+    # Scanned letters on the same letterhead, for the duplicate screening check: different letters
+    # (other bodies, or only another addressee) must not be matched, while rescans of a letter
+    # (shifted, rotated, blurred, noisier, JPEG) and exact repeats should be. Returns the PDF path
+    # and, per page, the page it duplicates or None. A change of a single character is not
+    # included: the screen can't tell it from scanner noise (see page_screen.py).
+    import fitz
+
+    os.makedirs(folder, exist_ok=True)
+    pdf_path = os.path.join(folder, "letterheads.pdf")
+    rng = random.Random(seed)
+    letters = [letterhead_page(body_seed) for body_seed in range(4)]
+    # (document, scan settings, page duplicated)
+    pages = [(letter, {}, None) for letter in letters]
+    pages.append((letterhead_page(0, name="John Smith"), {}, None))
+    pages.append((letterhead_page(1, name="Paul Martin"), {}, None))
+    pages.append((letters[0], {"shift": 12, "contrast": 0.85, "noise": 8}, 0))
+    pages.append((letters[2], {"shift": 6, "angle": -0.3, "blur": 0.8, "noise": 12}, 2))
+    for attempt in range(4):
+        pages.append((letters[attempt % 2], {"shift": 12, "angle": rng.uniform(-0.6, 0.6), "blur": 1.3, "noise": 18,
+                                              "contrast": 0.8, "jpeg_quality": 40}, attempt % 2))
+    pages.append((letters[3], {}, 3))
+    if not os.path.exists(pdf_path):
+        document = fitz.open()
+        for letter, settings, _ in pages:
+            scan_page(letter, document.new_page(width=612, height=792), rng, **settings)
+        document.save(pdf_path, garbage=3, deflate=True)
+        document.close()
+    return pdf_path, [duplicate_of for _, _, duplicate_of in pages]
+
+def build_text_corpus(folder, sizes, seed=0):
+    # One OCR text file per size in characters, from a short article to a long book
+    os.makedirs(folder, exist_ok=True)
+    rng = random.Random(seed)
+    text_files = []
+    for size in sizes:
+        text_file = f"synthetic_{size}c.txt"
+        text_files.append(text_file)
+        path = os.path.join(folder, text_file)
+        if os.path.exists(path):
+            continue
+        words = []
+        length = 0
+        while length < size:
+            word = rng.choice(VOCABULARY)
+            words.append(word)
+            length += len(word) + 1
+        with open(path, "w", encoding="utf-8") as text_output:
+            text_output.write(" ".join(words)[:size])
+    return text_files
+
+# ---------------------------------------------------------------------------
+# Stage timing
+# ---------------------------------------------------------------------------
+
+class StageTimer:
+    # Wraps module functions and class methods to record how long each call takes, per stage
+    def __init__(self):
+        self.durations = {}
+        self._patches = []
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.durations.setdefault(stage, []).append(seconds)
+
+    def wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - start_time)
+
+        setattr(owner, name, timed)
+        self._patches.append((owner, name, original))
+
+    def restore(self):
+        for owner, name, original in reversed(self._patches):
+            setattr(owner, name, original)
+        self._patches.clear()
+
+    def summary(self):
+        return {stage: latency_summary(values) for stage, values in self.durations.items()}
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def latency_summary(values):
+    ordered = sorted(values)
+    return {
+        "count": len(ordered),
+        "total_s": sum(ordered),
+        "p50_ms": percentile(ordered, 0.50) * 1000,
+        "p90_ms": percentile(ordered, 0.90) * 1000,
+        "p99_ms": percentile(ordered, 0.99) * 1000,
+        "max_ms": (ordered[-1] * 1000) if ordered else 0.0,
+    }
+
+# ---------------------------------------------------------------------------
+# Benchmark runners (each runs in its own process)
+# ---------------------------------------------------------------------------
+
+def run_ocr_benchmark(pdf_paths, output_folder, vision_options, ocr_options):
+    import fitz
+    import ocr_engines
+    import ocr_generator_local as ocr
+
+    fake_vision = FakeVisionClient(**vision_options)
+    ocr.set_vision_client(fake_vision)
+    timer = StageTimer()
+    timer.wrap(fitz.Page, "get_pixmap", "render")
+    timer.wrap(ocr, "encode_page_image", "encode")
+    timer.wrap(ocr, "prepare_page_image", "prepare")
+    timer.wrap(ocr_engines.VisionEngine, "recognize", "vision")
+    timer.wrap(ocr_engines.VisionEngine, "recognize_batch", "vision_batch")
+    timer.wrap(ocr, "compose_ocr_page", "compose")
+    timer.wrap(fitz.Document, "save", "save")
+    timer.wrap(ocr, "create_hybrid_ocr_pdf", "document")
+
+    os.makedirs(output_folder, exist_ok=True)
+    total_pages = 0
+    output_bytes = 0
+    errors = []
+    start_time = time.perf_counter()
+    for pdf_path in pdf_paths:
+        with fitz.open(pdf_path) as pdf_document:
+            total_pages += pdf_document.page_count
+        try:
+            ocr.create_hybrid_ocr_pdf(pdf_path, output_folder, **ocr_options)
+            output_bytes += os.path.getsize(os.path.join(output_folder, f"ocr_{os.path.basename(pdf_path)}"))
+        except Exception as e:
+            errors.append(f"{os.path.basename(pdf_path)}: {type(e).__name__}: {e}")
+    wall_seconds = time.perf_counter() - start_time
+    timer.restore()
+
+    return {
+        "documents": len(pdf_paths),
+        "pages": total_pages,
+        "wall_s": wall_seconds,
+        "pages_per_s": total_pages / wall_seconds if wall_seconds else 0.0,
+        "input_bytes": sum(os.path.getsize(path) for path in pdf_paths),
+        "output_bytes": output_bytes,
+        "vision_calls": fake_vision.calls,
+        "vision_images": fake_vision.images,
+        "vision_bytes": fake_vision.bytes_received,
+        "peak_rss_bytes": ocr.peak_rss_bytes(),
+        "stages": timer.summary(),
+        "errors": errors,
+    }
+
+def install_fake_vision(vision_options):
+    # Worker setup for ocr_generator_local.compare_overlay_modes: OCR goes to the fake client
+    import ocr_generator_local as ocr
+    ocr.set_vision_client(FakeVisionClient(**vision_options))
+
+def run_overlay_comparison(pdf_paths, output_folder, vision_options, dpi):
+    # Output size, peak RSS and time of every overlay mode, each mode in its own process; the OCR
+    # cache is shared, so each page goes to the fake Vision once
+    import ocr_generator_local as ocr
+
+    results = {}
+    for pdf_path in pdf_paths:
+        print(f"\n== overlay modes: {os.path.basename(pdf_path)} ==")
+        modes = ocr.compare_overlay_modes(pdf_path, output_folder, cache_folder=os.path.join(output_folder, ".ocr_cache"),
+                                          dpi=dpi, worker_setup=partial(install_fake_vision, vision_options))
+        results[os.path.basename(pdf_path)] = {
+            mode: {"output_bytes": output_bytes, "peak_rss_bytes": peak_rss, "seconds": seconds}
+            for mode, (output_bytes, peak_rss, seconds) in modes.items()
+        }
+    return results
+
+def run_screen_check(pdf_path, expected):
+    # Screen the letterhead corpus for duplicates and report every page judged differently from
+    # expected: a page matched to the wrong letter would get that letter's text
+    import fitz
+    import ocr_generator_local as ocr
+    from page_screen import PageScreener
+
+    screener = PageScreener(dpi=ocr.SCREEN_DPI, blank_ink=ocr.SCREEN_BLANK_INK, detect_duplicates=True,
+                            max_tile_difference=ocr.SCREEN_MAX_TILE_DIFFERENCE)
+    durations = []
+    errors = []
+    duplicates = wrong_matches = missed_duplicates = 0
+    with fitz.open(pdf_path) as pdf_document:
+        for page, duplicate_of in zip(pdf_document, expected):
+            key = (pdf_document.name, page.number)
+            start_time = time.perf_counter()
+            verdict = ocr.screen_page(screener, page)
+            durations.append(time.perf_counter() - start_time)
+            if verdict is None:
+                # Stand-in word boxes that name the page, so a duplicate shows which page it matched
+                screener.record(key, 100, 100, [(str(page.number), [(0, 0), (1, 0), (1, 1), (0, 1)])])
+                matched = None
+            else:
+                duplicates += verdict == "duplicate"
+                boxes = screener.reuse_boxes(key, 100, 100)
+                matched = int(boxes[0][0]) if boxes else verdict
+            if matched != duplicate_of:
+                if duplicate_of is None:
+                    wrong_matches += 1
+                    errors.append(f"page {page.number}: different letter matched to page {matched}")
+                else:
+                    missed_duplicates += 1
+                    errors.append(f"page {page.number}: rescan of page {duplicate_of} screened as {matched}")
+
+    return {
+        "pages": len(expected),
+        "expected_duplicates": sum(duplicate_of is not None for duplicate_of in expected),
+        "duplicates": duplicates,
+        "wrong_matches": wrong_matches,
+        "missed_duplicates": missed_duplicates,
+        "stages": {"screen": latency_summary(durations)},
+        "errors": errors,
+    }
+
+def run_metadata_benchmark(text_folder, text_files, work_folder, openai_options, workers):
+    import openai
+    import ocr_generator_local as ocr
+    import metadata_generator as metadata
+
+    fake_chat = FakeChatCompletion(**openai_options)
+    openai.ChatCompletion.create = fake_chat.create
+    # A fresh response cache and no rate-limit pressure, so every request reaches the fake
+    metadata.llm_cache_folder = tempfile.mkdtemp(prefix="llm_cache_", dir=work_folder)
+    metadata.rate_limiter = metadata.TokenBucketLimiter(10 ** 6, 10 ** 9)
+    # Token counts without the model's BPE tables, which tiktoken would download
+    metadata.token_encoding = metadata.ApproximateEncoding()
+
+    timer = StageTimer()
+    timer.wrap(metadata, "request_completion", "llm_request")
+    timer.wrap(metadata, "summarize_for_metadata", "summarize")
+    timer.wrap(metadata, "process_file", "document")
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(lambda text_file: metadata.process_file(text_file, text_folder), text_files))
+    wall_seconds = time.perf_counter() - start_time
+    timer.restore()
+
+    return {
+        "documents": len(text_files),
+        "wall_s": wall_seconds,
+        "documents_per_s": len(text_files) / wall_seconds if wall_seconds else 0.0,
+        "input_chars": sum(os.path.getsize(os.path.join(text_folder, name)) for name in text_files),
+        "llm_calls": fake_chat.calls,
+        "prompt_chars": fake_chat.prompt_chars,
+        "with_metadata": sum(1 for result in results if result and metadata.has_metadata(result)),
+        "peak_rss_bytes": ocr.peak_rss_bytes(),
+        "stages": timer.summary(),
+    }
+
+# ---------------------------------------------------------------------------
+# Startup time
+# ---------------------------------------------------------------------------
+
+STARTUP_COMMANDS = {
+    "import ocr_generator_local": ["-c", "import ocr_generator_local"],
+    "import metadata_generator": ["-c", "import metadata_generator"],
+    "cli.py ocr --help": ["cli.py", "ocr", "--help"],
+}
+
+def run_startup_benchmark(repo_folder, repeats):
+    # Wall time of a fresh interpreter per command, run in repo_folder with no stdin so that nothing
+    # can wait for input. The first run of each command is discarded to warm the OS file cache.
+    durations = {}
+    errors = []
+    for name, command in STARTUP_COMMANDS.items():
+        for attempt in range(repeats + 1):
+            start_time = time.perf_counter()
+            completed = subprocess.run([sys.executable] + command, cwd=repo_folder, stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            elapsed = time.perf_counter() - start_time
+            if completed.returncode != 0:
+                errors.append(f"{name}: exit code {completed.returncode}: "
+                              f"{completed.stderr.decode(errors='replace').strip().splitlines()[-1:]}")
+                break
+            if attempt:
+                durations.setdefault(name, []).append(elapsed)
+    return {
+        "repo": os.path.abspath(repo_folder),
+        "repeats": repeats,
+        "stages": {name: latency_summary(values) for name, values in durations.items()},
+        "errors": errors,
+    }
+
+def run_in_fresh_process(function, *args):
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1) as pool:
+        return pool.apply(function, args)
+
+# ---------------------------------------------------------------------------
+# Reporting and CLI
+# ---------------------------------------------------------------------------
+
+def format_bytes(value):
+    return "n/a" if value is None else f"{value / 1024 ** 2:.1f} MB"
+
+def print_report(name, result):
+    print(f"\n== {name} ==")
+    for key, value in result.items():
+        if key in ("stages", "errors"):
+            continue
+        if key.endswith("bytes"):
+            value = format_bytes(value)
+        elif isinstance(value, float):
+            value = f"{value:.2f}"
+        print(f"{key:>16}: {value}")
+    print(f"{'stage':>16}  {'count':>6}  {'total s':>8}  {'p50 ms':>8}  {'p90 ms':>8}  {'p99 ms':>8}  {'max ms':>8}")
+    for stage, stats in result["stages"].items():
+        print(f"{stage:>16}  {stats['count']:>6}  {stats['total_s']:>8.2f}  {stats['p50_ms']:>8.1f}  "
+              f"{stats['p90_ms']:>8.1f}  {stats['p99_ms']:>8.1f}  {stats['max_ms']:>8.1f}")
+    for error in result.get("errors", []):
+        print(f"  error: {error}")
+
+def int_list(value):
+    return [int(item) for item in value.split(",") if item]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for create_hybrid_ocr_pdf and process_file.")
+    parser.add_argument("--workdir", help="folder for corpora and outputs (default: a new temporary folder)")
+    parser.add_argument("--skip-ocr", action="store_true")
+    parser.add_argument("--skip-metadata", action="store_true")
+    parser.add_argument("--json", help="write the results to this JSON file")
+    parser.add_argument("--startup", action="store_true", help="also measure script startup time")
+    parser.add_argument("--startup-repo", default=os.path.dirname(os.path.abspath(__file__)),
+                        help="checkout whose startup time is measured (default: this one)")
+    parser.add_argument("--startup-repeats", type=int, default=5)
+
+    corpus = parser.add_argument_group("corpora")
+    corpus.add_argument("--pages", type=int_list, default=[5, 25], help="page counts of the synthetic PDFs")
+    corpus.add_argument("--density", type=int_list, default=[150, 600], help="words per page of the synthetic PDFs")
+    corpus.add_argument("--kind", choices=("scanned", "born-digital", "mixed"), default="scanned")
+    corpus.add_argument("--text-sizes", type=int_list, default=[5000, 50000, 500000],
+                        help="sizes in characters of the synthetic OCR text files")
+
+    fakes = parser.add_argument_group("fakes")
+    fakes.add_argument("--vision-latency", type=float, default=0.3)
+    fakes.add_argument("--vision-error-rate", type=float, default=0.0)
+    fakes.add_argument("--vision-words", type=int, default=300, help="words the fake Vision returns per page")
+    fakes.add_argument("--openai-latency", type=float, default=1.0)
+    fakes.add_argument("--openai-error-rate", type=float, default=0.0)
+
+    ocr_group = parser.add_argument_group("OCR settings")
+    ocr_group.add_argument("--dpi", type=int, default=300)
+    ocr_group.add_argument("--concurrency", type=int, default=4, help="max concurrent Vision requests")
+    ocr_group.add_argument("--batch-size", type=int, default=1)
+    ocr_group.add_argument("--image-format", choices=("png", "jpeg", "gray"), default="png")
+    ocr_group.add_argument("--overlay-mode", choices=("raster", "compressed", "original"), default="original")
+    ocr_group.add_argument("--preprocess", choices=("gray", "binary"),
+                           help="clean up and shrink pages before OCR (see ocr_preprocess.py)")
+    ocr_group.add_argument("--max-pixels", type=int, default=12_000_000, help="pixel budget with --preprocess")
+    ocr_group.add_argument("--screen", action="store_true",
+                           help="pre-screen pages for blanks and duplicates (see page_screen.py)")
+    ocr_group.add_argument("--screen-check", action="store_true",
+                           help="check duplicate screening on scanned letters that share a letterhead")
+    ocr_group.add_argument("--output-chunk-pages", type=int, default=0,
+                           help="write the output PDF every N pages (0 = one save at the end)")
+    ocr_group.add_argument("--compare-overlay-modes", action="store_true",
+                           help="also build every PDF with each overlay mode and compare size and peak RSS")
+    ocr_group.add_argument("--metadata-workers", type=int, default=8)
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="ocr_benchmark_")
+    os.makedirs(workdir, exist_ok=True)
+    print(f"Benchmark work folder: {workdir}")
+    results = {"settings": vars(args)}
+
+    if args.startup:
+        results["startup"] = run_startup_benchmark(args.startup_repo, max(1, args.startup_repeats))
+        print_report("startup", results["startup"])
+
+    if not args.skip_ocr:
+        pdf_paths = build_pdf_corpus(os.path.join(workdir, "pdfs"), args.pages, args.density, kind=args.kind)
+        vision_options = {"latency": args.vision_latency, "error_rate": args.vision_error_rate,
+                          "words_per_page": args.vision_words}
+        ocr_options = {"dpi": args.dpi, "max_concurrent_requests": args.concurrency, "batch_size": args.batch_size,
+                       "image_format": args.image_format, "overlay_mode": args.overlay_mode,
+                       "skip_born_digital": True, "adaptive_dpi": True,
+                       "output_chunk_pages": args.output_chunk_pages}
+        if args.preprocess:
+            from ocr_preprocess import PagePreprocessor
+            ocr_options["preprocessor"] = PagePreprocessor(mode=args.preprocess, max_pixels=args.max_pixels)
+        if args.screen:
+            from page_screen import PageScreener
+            ocr_options["screener"] = PageScreener(detect_duplicates=True)
+        results["create_hybrid_ocr_pdf"] = run_in_fresh_process(
+            run_ocr_benchmark, pdf_paths, os.path.join(workdir, "ocr_output"), vision_options, ocr_options)
+        print_report("create_hybrid_ocr_pdf", results["create_hybrid_ocr_pdf"])
+        if args.compare_overlay_modes:
+            results["overlay_modes"] = run_overlay_comparison(pdf_paths, os.path.join(workdir, "overlay_modes"),
+                                                              vision_options, args.dpi)
+
+    if args.screen_check:
+        pdf_path, expected = build_letterhead_corpus(os.path.join(workdir, "letterheads"))
+        results["screen_check"] = run_in_fresh_process(run_screen_check, pdf_path, expected)
+        print_report("screen_check", results["screen_check"])
+
+    if not args.skip_metadata:
+        text_folder = os.path.join(workdir, "texts")
+        text_files = build_text_corpus(text_folder, args.text_sizes)
+        openai_options = {"latency": args.openai_latency, "error_rate": args.openai_error_rate}
+        results["process_file"] = run_in_fresh_process(
+            run_metadata_benchmark, text_folder, text_files, workdir, openai_options, args.metadata_workers)
+        print_report("process_file", results["process_file"])
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump(results, json_file, indent=4)
+        print(f"\nResults written to {args.json}")
+    return results
+
+if __name__ == "__main__":
+    main()
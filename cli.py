@@ -0,0 +1,57 @@
+import sys
+import argparse
+import importlib
+import subprocess
+
+from lazy_imports import REQUIRED_PACKAGES
+
+# Single command-line entry point for the project:
+#   python cli.py ocr [PDFs...] [-w N] [-o folder]    hybrid OCR PDFs (interactive without inputs)
+#   python cli.py metadata [--debug]                  metadata for the OCR text files
+#   python cli.py pipeline PDFs... [options]          streaming OCR -> metadata run
+#   python cli.py search "words" [--index file]       find words in the OCR word index
+#   python cli.py install-deps                        install the required packages
+# Each command imports only the module it runs, and that module imports its heavy dependencies on
+# first use, so "--help" and argument errors come back immediately.
+
+def install_dependencies():
+    # Install the packages that are not importable yet
+    for package_name, install_name in REQUIRED_PACKAGES:
+        try:
+            importlib.import_module(package_name)
+            print(f"{package_name} is already installed.")
+        except ImportError:
+            print(f"{package_name} is not installed. Installing...")
+            subprocess.check_call([sys.executable, "-m", "pip", "install", install_name])
+            print(f"{package_name} has been installed.")
+
+def run_metadata(argv):
+    parser = argparse.ArgumentParser(prog="cli.py metadata", description="Generate metadata for the OCR text files.")
+    parser.add_argument("--debug", action="store_true", help="print debug messages")
+    args = parser.parse_args(argv)
+    import metadata_generator
+    metadata_generator.debug_output = metadata_generator.debug_output or args.debug
+    metadata_generator.main()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="CWIS OCR and metadata tools.")
+    parser.add_argument("command", choices=("ocr", "metadata", "pipeline", "search", "install-deps"))
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="arguments of the command (see <command> --help)")
+    args = parser.parse_args(argv)
+
+    if args.command == "install-deps":
+        install_dependencies()
+    elif args.command == "ocr":
+        import ocr_generator_local
+        ocr_generator_local.cli(args.args)
+    elif args.command == "metadata":
+        run_metadata(args.args)
+    elif args.command == "pipeline":
+        import ocr_metadata_pipeline
+        ocr_metadata_pipeline.cli(args.args)
+    elif args.command == "search":
+        import word_index
+        return word_index.cli(args.args)
+
+if __name__ == "__main__":
+    sys.exit(main())
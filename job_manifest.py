@@ -0,0 +1,141 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+
+# SQLite job manifest for resumable OCR runs.
+# Each input PDF is recorded with its path, size, mtime and content hash plus its state
+# ("in_progress", "done" or "failed"), and the OCR word boxes of every finished page are
+# checkpointed as soon as they arrive. A rerun skips finished documents and resumes partial ones
+# from their checkpoints without sending those pages to Google Vision again.
+# A finished document also records the settings its output was made with, and each checkpoint the
+# OCR feature (engine and preprocessing) of its word boxes, so a rerun with other settings redoes
+# the document and only reuses checkpoints that match.
+# The database is safe to share between the worker processes of a batch run.
+class JobManifest:
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.connection = sqlite3.connect(manifest_path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL,
+                size INTEGER NOT NULL,
+                mtime REAL NOT NULL,
+                content_hash TEXT NOT NULL,
+                state TEXT NOT NULL,
+                output_path TEXT,
+                error TEXT,
+                settings TEXT,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS pages (
+                document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+                page_num INTEGER NOT NULL,
+                render_dpi INTEGER NOT NULL,
+                ocr_feature TEXT,
+                bounding_boxes TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (document_id, page_num)
+            );
+        """)
+        # Manifests written before settings were recorded get the new columns; their documents
+        # and checkpoints then match no settings and are redone once
+        for table, column in (("documents", "settings"), ("pages", "ocr_feature")):
+            columns = {row[1] for row in self.connection.execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE {table} ADD COLUMN {column} TEXT")
+        self.connection.commit()
+
+    @staticmethod
+    def hash_file(path, chunk_size=1024 * 1024):
+        digest = hashlib.sha256()
+        with open(path, "rb") as pdf_file:
+            for chunk in iter(lambda: pdf_file.read(chunk_size), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def start_document(self, pdf_path, output_path):
+        # Register a document and return (document id, previous state). Page checkpoints are kept
+        # only if the file is unchanged; the content hash is recomputed only when size or mtime moved.
+        pdf_path = os.path.abspath(pdf_path)
+        stat = os.stat(pdf_path)
+        row = self.connection.execute(
+            "SELECT id, size, mtime, content_hash, state FROM documents WHERE path = ?", (pdf_path,)
+        ).fetchone()
+
+        if row is not None:
+            document_id, size, mtime, content_hash, state = row
+            unchanged = size == stat.st_size and mtime == stat.st_mtime
+            if not unchanged and size == stat.st_size:
+                unchanged = content_hash == self.hash_file(pdf_path)
+            if unchanged:
+                self._update_document(document_id, "in_progress" if state != "done" else state,
+                                      output_path=output_path, mtime=stat.st_mtime)
+                return document_id, state
+            self.connection.execute("DELETE FROM pages WHERE document_id = ?", (document_id,))
+            self.connection.execute("DELETE FROM documents WHERE id = ?", (document_id,))
+
+        cursor = self.connection.execute(
+            "INSERT INTO documents (path, size, mtime, content_hash, state, output_path, updated_at) "
+            "VALUES (?, ?, ?, ?, 'in_progress', ?, ?)",
+            (pdf_path, stat.st_size, stat.st_mtime, self.hash_file(pdf_path), output_path, time.time()),
+        )
+        self.connection.commit()
+        return cursor.lastrowid, None
+
+    def _update_document(self, document_id, state, output_path=None, mtime=None, error=None, settings=None):
+        self.connection.execute(
+            "UPDATE documents SET state = ?, output_path = COALESCE(?, output_path), "
+            "mtime = COALESCE(?, mtime), error = ?, settings = COALESCE(?, settings), updated_at = ? WHERE id = ?",
+            (state, output_path, mtime, error, settings, time.time(), document_id),
+        )
+        self.connection.commit()
+
+    def is_done(self, document_id, state, settings=None):
+        # A document counts as done only if its output file is still there and was made with the
+        # same settings
+        if state != "done":
+            return False
+        row = self.connection.execute(
+            "SELECT output_path, settings FROM documents WHERE id = ?", (document_id,)
+        ).fetchone()
+        return bool(row and row[0] and os.path.exists(row[0]) and row[1] == settings)
+
+    def get_page(self, document_id, page_num, render_dpi, ocr_feature=None):
+        # Return the checkpointed bounding boxes of a page, or None if it must be OCR'd.
+        # Boxes are in rendered-image pixels, so a checkpoint taken at another DPI, or with another
+        # engine or preprocessing (ocr_feature, as in the OCR cache key), is not reused.
+        row = self.connection.execute(
+            "SELECT render_dpi, ocr_feature, bounding_boxes FROM pages WHERE document_id = ? AND page_num = ?",
+            (document_id, page_num),
+        ).fetchone()
+        if row is None or row[0] != render_dpi or row[1] != ocr_feature:
+            return None
+        return [(word, [tuple(vertex) for vertex in vertices]) for word, vertices in json.loads(row[2])]
+
+    def checkpoint_page(self, document_id, page_num, render_dpi, bounding_boxes, ocr_feature=None):
+        data = json.dumps([[word, [list(vertex) for vertex in vertices]] for word, vertices in bounding_boxes])
+        self.connection.execute(
+            "INSERT OR REPLACE INTO pages (document_id, page_num, render_dpi, ocr_feature, bounding_boxes, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (document_id, page_num, render_dpi, ocr_feature, data, time.time()),
+        )
+        self.connection.commit()
+
+    def finish_document(self, document_id, settings=None):
+        # settings: the output settings fingerprint that is_done compares against
+        self._update_document(document_id, "done", settings=settings)
+
+    def fail_document(self, document_id, error):
+        self._update_document(document_id, "failed", error=str(error))
+
+    def summary(self):
+        # Number of documents per state
+        return dict(self.connection.execute("SELECT state, COUNT(*) FROM documents GROUP BY state").fetchall())
+
+    def close(self):
+        self.connection.close()
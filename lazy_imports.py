@@ -0,0 +1,52 @@
+import importlib
+import threading
+
+# Deferred imports for the heavy dependencies (PyMuPDF, the Google Cloud Vision client, openai,
+# tiktoken, numpy). A LazyModule stands in for the module and imports it the first time one of its
+# attributes is used, so importing the scripts, showing --help or starting a worker process does
+# not pay for libraries the run never touches. Packages are no longer installed at import time;
+# "python cli.py install-deps" installs everything in REQUIRED_PACKAGES.
+
+# (import name, pip install name) of every third-party package the scripts use
+REQUIRED_PACKAGES = [
+    ("fitz", "pymupdf"),
+    ("google.cloud.vision", "google-cloud-vision"),
+    ("numpy", "numpy"),
+    ("PIL", "pillow"),
+    ("pytesseract", "pytesseract"),  # only for the Tesseract OCR engine, which also needs the tesseract binary
+    ("tqdm", "tqdm"),
+    ("openai", "openai==0.28"),
+    ("tenacity", "tenacity"),
+    ("tiktoken", "tiktoken"),
+]
+
+# Custom exception for a dependency that is used but not installed
+class MissingDependencyError(ImportError):
+    pass
+
+class LazyModule:
+    def __init__(self, module_name, install_name=None):
+        self._module_name = module_name
+        self._install_name = install_name or module_name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    try:
+                        self._module = importlib.import_module(self._module_name)
+                    except ImportError as e:
+                        raise MissingDependencyError(
+                            f"{self._module_name} is not installed. Install it with: pip install {self._install_name} "
+                            f"(or python cli.py install-deps)"
+                        ) from e
+        return self._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._module_name!r} ({state})>"
@@ -0,0 +1,315 @@
+import re
+import math
+import threading
+from collections import Counter
+
+from lazy_imports import LazyModule
+
+np = LazyModule("numpy")
+
+# Local pre-extraction for the metadata prompts.
+# Much of what the model is asked for can be found cheaply on this machine, so instead of the whole
+# OCR text the prompt carries candidates plus a short, representative excerpt:
+#   keywords  - TF-IDF over the whole corpus (CorpusProfile), single words and two-word phrases
+#   title     - the most title-like line near the top of the first page
+#   authors   - "by ..." / "Autor: ..." patterns and name-like lines near the title
+#   language  - the language whose common words make up the largest share of the text
+#   excerpt   - the opening of the document plus the sentences richest in its keywords, in
+#               document order, up to a token budget
+# OCR text files hold one page per block, pages separated by a blank line (write_ocr_text).
+
+# Common words per language, used both for language detection and to keep them out of keywords
+STOPWORDS = {
+    "en": set("""the of and to in a is that for it as was with be by on not he i this are or his from at
+        which but have an they you were her she there been one all we their has would when if so no will
+        more can its also into than only other these some what them may who any our about such over after
+        between through during under out then most""".split()),
+    "es": set("""de la que el en y a los del se las por un para con no una su al lo como más pero sus le ya
+        o este sí porque esta entre cuando muy sin sobre también me hasta hay donde quien desde todo nos
+        durante todos uno les ni contra otros ese eso ante ellos e esto mí antes algunos qué unos yo otro
+        otras otra él tanto esa estos mucho quienes nada muchos cual poco ella estar estas algunas algo
+        nosotros es son fue ser ha han""".split()),
+    "fr": set("""de la le et les des en un une du est que pour qui dans par sur au pas plus ne ce il se avec
+        sont aux son ou sa mais comme ont été cette nous leur elle ses tout lui ces même aussi entre
+        fait était""".split()),
+    "de": set("""der die und in den von zu das mit sich des auf für ist im dem nicht ein eine als auch es an
+        werden aus er hat dass sie nach wird bei einer um am sind noch wie einem über einen so zum war
+        haben nur oder aber vor zur bis mehr durch man""".split()),
+    "pt": set("""de a o que e do da em um para é com não uma os no se na por mais as dos como mas foi ao ele
+        das tem à seu sua ou ser quando muito há nos já está eu também só pelo pela até isso ela entre
+        era depois sem mesmo aos ter seus quem nas""".split()),
+    "it": set("""di e il la che in a per un è del non sono una le si con da della al i lo gli anche come
+        ma nel alla più dei delle questo o ha cui loro sua suo ad nella tra essere stato""".split()),
+}
+ALL_STOPWORDS = set().union(*STOPWORDS.values())
+LANGUAGE_NAMES = {"en": "English", "es": "Spanish", "fr": "French", "de": "German", "pt": "Portuguese", "it": "Italian"}
+
+WORD_PATTERN = re.compile(r"[^\W\d_]+")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+|\n")
+# Words that continue a title wrapped onto the next line
+CONTINUATION_WORDS = set("of in and for on to at from with de del en y para por con e et du des und von im di da".split())
+AUTHOR_PATTERN = re.compile(
+    r"(?i:\b(?:written|edited|compiled) by|\bby|\bpor|\bpar|\bvon|\bautor(?:es|a)?:|\bauthors?:|\bed(?:itor|s?\.)?:?)"
+    r"\s+((?:[A-ZÁÉÍÓÚÑ][\w.'-]+\.?\s*){1,4}(?:(?:and|y|&|,)\s+(?:[A-ZÁÉÍÓÚÑ][\w.'-]+\.?\s*){1,4})*)"
+)
+
+def words_of(text):
+    return WORD_PATTERN.findall(text.lower())
+
+def keyword_terms(words):
+    # Candidate terms of a word sequence: words of three or more letters that are not stopwords,
+    # and pairs of such words that follow each other
+    terms = []
+    previous = None
+    for word in words:
+        if len(word) < 3 or word in ALL_STOPWORDS:
+            previous = None
+            continue
+        terms.append(word)
+        if previous is not None:
+            terms.append(f"{previous} {word}")
+        previous = word
+    return terms
+
+def document_terms(words):
+    # Keyword terms of a whole document. A phrase that occurs only once is as likely to be noise as
+    # a topic, and keeping every one would make the corpus vocabulary explode, so those are dropped.
+    terms = keyword_terms(words)
+    phrase_counts = Counter(term for term in terms if " " in term)
+    return [term for term in terms if " " not in term or phrase_counts[term] > 1]
+
+def first_page(text):
+    # Pages are separated by blank lines; a text without them is cut after its first 60 lines
+    page = text.split("\n\n", 1)[0]
+    return "\n".join(page.splitlines()[:60])
+
+class CorpusProfile:
+    # Document frequencies of the keyword terms of a corpus, for TF-IDF scoring. Documents are
+    # counted once each; add_documents counts many at once with a single bincount.
+    def __init__(self):
+        self.vocabulary = {}
+        self.terms = []
+        self.document_frequency = None
+        self.documents = 0
+        self._counted = set()
+        self.lock = threading.Lock()
+
+    def _term_ids(self, terms):
+        # Ids of the terms, adding new ones to the vocabulary
+        vocabulary = self.vocabulary
+        ids = np.empty(len(terms), dtype=np.int64)
+        for index, term in enumerate(terms):
+            term_id = vocabulary.get(term)
+            if term_id is None:
+                term_id = vocabulary[term] = len(self.terms)
+                self.terms.append(term)
+            ids[index] = term_id
+        return ids
+
+    def add_documents(self, documents):
+        # documents: (name, text) pairs; names already counted are skipped
+        with self.lock:
+            unique_ids = []
+            for name, text in documents:
+                if name in self._counted:
+                    continue
+                self._counted.add(name)
+                unique_ids.append(np.unique(self._term_ids(document_terms(words_of(text)))))
+                self.documents += 1
+            if not unique_ids:
+                return
+            counts = np.bincount(np.concatenate(unique_ids), minlength=len(self.terms))
+            if self.document_frequency is not None:
+                counts[:len(self.document_frequency)] += self.document_frequency
+            self.document_frequency = counts
+
+    def add_document(self, name, text):
+        self.add_documents([(name, text)])
+
+    def term_weights(self, words):
+        # TF-IDF weight of every keyword term of a document, as (term ids, weights, occurrences).
+        # Terms the profile has not seen yet get a document frequency of 0.
+        with self.lock:
+            ids, counts = np.unique(self._term_ids(document_terms(words)), return_counts=True)
+            frequency = self.document_frequency if self.document_frequency is not None else np.zeros(0, dtype=np.int64)
+            document_frequency = np.zeros(len(ids), dtype=np.float64)
+            known = ids < len(frequency)
+            document_frequency[known] = frequency[ids[known]]
+            documents = self.documents
+        idf = np.log((1 + documents) / (1 + document_frequency)) + 1
+        weights = (1 + np.log(counts)) * idf
+        return ids, weights, counts
+
+    def keywords(self, words, count=15, phrases=False):
+        # The count terms with the highest TF-IDF weight; two-word phrases only with phrases=True
+        ids, weights, _ = self.term_weights(words)
+        is_phrase = np.array([" " in self.terms[term_id] for term_id in ids.tolist()], dtype=bool)
+        selected = is_phrase if phrases else ~is_phrase
+        ids, weights = ids[selected], weights[selected]
+        top = np.argsort(-weights, kind="stable")[:count]
+        return [self.terms[term_id] for term_id in ids[top].tolist()]
+
+def detect_language(words, sample=3000):
+    # (language code, share of the sampled words that are its stopwords); "und" when no language stands out
+    sample_words = words[:sample]
+    if not sample_words:
+        return "und", 0.0
+    shares = {language: sum(1 for word in sample_words if word in stopwords) / len(sample_words)
+              for language, stopwords in STOPWORDS.items()}
+    language = max(shares, key=shares.get)
+    if shares[language] < 0.08:
+        return "und", shares[language]
+    return language, shares[language]
+
+def title_score(line, position):
+    # How title-like a line near the top of the first page is, or None if it can't be a title
+    words = line.split()
+    letters = sum(char.isalpha() for char in line)
+    if not 2 <= len(words) <= 16 or letters < 0.7 * len(line.replace(" ", "")):
+        return None
+    lowered = line.lower()
+    if "@" in line or "http" in lowered or "www." in lowered or re.match(r"(page|p\.|vol\.|no\.)\s*\d", lowered) \
+            or AUTHOR_PATTERN.search(line):
+        return None
+    # Small words stay lowercase in title case
+    content_words = [word for word in words if word.lower() not in ALL_STOPWORDS] or words
+    capitalised = sum(1 for word in content_words if word[0].isupper()) / len(content_words)
+    score = 2.0 if line.isupper() else 2.0 * capitalised
+    score += max(0.0, (20 - position) / 10)
+    # Running heads and publisher names are short; titles say what the document is about
+    score += 0.2 * min(len(words), 10)
+    if line.rstrip().endswith((".", ",", ";")):
+        score -= 2.0
+    return score
+
+def guess_title(page_text):
+    lines = [line.strip() for line in page_text.splitlines() if line.strip()][:20]
+    best, best_score = None, 0.5
+    for position, line in enumerate(lines):
+        score = title_score(line, position)
+        if score is None:
+            continue
+        # A title wrapped onto the next line continues with a word like "of" or "in"
+        for next_line in lines[position + 1:position + 3]:
+            if next_line.split()[0].lower() not in CONTINUATION_WORDS or title_score(next_line, position) is None:
+                break
+            line = f"{line} {next_line}"
+            score = title_score(line, position)
+        if score > best_score:
+            best, best_score = line, score
+    return best
+
+def guess_authors(page_text, title=None, limit=3):
+    authors = []
+    for match in AUTHOR_PATTERN.finditer(page_text):
+        for name in re.split(r"\s*(?:,|\band\b|\by\b|&)\s*", match.group(1)):
+            name = name.strip(" .")
+            if len(name.split()) >= 2 and name not in authors:
+                authors.append(name)
+    if not authors and title:
+        # A line of two to four capitalised words right below the title is often the author
+        lines = [line.strip() for line in page_text.splitlines() if line.strip()]
+        title_line = next((i for i, line in enumerate(lines) if line in title or title.startswith(line)), None)
+        if title_line is not None:
+            for line in lines[title_line + 1:title_line + 4]:
+                words = line.split()
+                if 2 <= len(words) <= 4 and all(word[0].isupper() and word.strip(".").isalpha() for word in words) \
+                        and not any(word.lower() in ALL_STOPWORDS for word in words) and line not in title:
+                    authors.append(line)
+    return authors[:limit]
+
+def text_units(text, max_words=60):
+    # Sentences (or OCR lines), with overlong ones cut into pieces of max_words words
+    units = []
+    for sentence in SENTENCE_PATTERN.split(text):
+        words = sentence.split()
+        for start in range(0, len(words), max_words):
+            units.append(" ".join(words[start:start + max_words]))
+    return units
+
+def representative_excerpt(text, term_weights, max_tokens, count_tokens, lead_tokens=300):
+    # The opening of the document plus its highest-scoring sentences, in document order, within
+    # max_tokens. term_weights: {term: weight} of the document's keywords.
+    sentences = text_units(text)
+    sizes = [count_tokens(sentence) for sentence in sentences]
+    chosen = set()
+    used = 0
+    # The opening: title page, authors, abstract
+    for index, size in enumerate(sizes):
+        if used + size > min(lead_tokens, max_tokens):
+            break
+        chosen.add(index)
+        used += size
+    scores = []
+    for index, sentence in enumerate(sentences):
+        if index in chosen:
+            continue
+        terms = set(keyword_terms(words_of(sentence)))
+        score = sum(term_weights.get(term, 0.0) for term in terms)
+        if score:
+            scores.append((score / math.sqrt(sizes[index] + 1), index))
+    for _, index in sorted(scores, reverse=True):
+        if used + sizes[index] <= max_tokens:
+            chosen.add(index)
+            used += sizes[index]
+    parts = []
+    previous = None
+    for index in sorted(chosen):
+        if previous is not None and index != previous + 1:
+            parts.append("[...]")
+        parts.append(sentences[index])
+        previous = index
+    return " ".join(parts), used
+
+class DocumentHints:
+    # What the pre-pass found for one document
+    def __init__(self, language, title, authors, keywords, phrases, excerpt, excerpt_tokens, text_tokens):
+        self.language = language
+        self.title = title
+        self.authors = authors
+        self.keywords = keywords
+        self.phrases = phrases
+        self.excerpt = excerpt
+        self.excerpt_tokens = excerpt_tokens
+        self.text_tokens = text_tokens
+
+    def prompt_section(self):
+        lines = ["Candidates found locally in the document (verify them against the text; they may be wrong):"]
+        if self.language != "und":
+            lines.append(f"- Language: {LANGUAGE_NAMES.get(self.language, self.language)}")
+        if self.title:
+            lines.append(f"- Title candidate: {self.title}")
+        if self.authors:
+            lines.append(f"- Author candidates: {'; '.join(self.authors)}")
+        if self.keywords:
+            lines.append(f"- Keyword candidates (most distinctive first): {', '.join(self.keywords)}")
+        if self.phrases:
+            lines.append(f"- Key phrases: {', '.join(self.phrases)}")
+        if self.excerpt_tokens < self.text_tokens:
+            lines.append("")
+            lines.append(f"The text below is an excerpt of the OCR text ({self.excerpt_tokens} of {self.text_tokens} "
+                         f"tokens): the opening of the document and the passages richest in its keywords, in "
+                         f"document order; [...] marks left-out text.")
+        return "\n".join(lines)
+
+def extract_hints(text, profile, count_tokens, max_excerpt_tokens=1500, keyword_count=15, phrase_count=8):
+    # Pre-extract the metadata candidates and the excerpt of one document. count_tokens(text) gives
+    # the prompt token count of a piece of text.
+    words = words_of(text)
+    language, _ = detect_language(words)
+    page = first_page(text)
+    title = guess_title(page)
+    authors = guess_authors(page, title)
+    keywords = profile.keywords(words, keyword_count)
+    phrases = profile.keywords(words, phrase_count, phrases=True)
+
+    text_tokens = count_tokens(text)
+    if text_tokens <= max_excerpt_tokens:
+        excerpt, excerpt_tokens = text, text_tokens
+    else:
+        ids, weights, _ = profile.term_weights(words)
+        # The strongest terms decide which sentences are representative
+        top = np.argsort(-weights)[:200]
+        term_weights = {profile.terms[term_id]: weight for term_id, weight in zip(ids[top].tolist(), weights[top].tolist())}
+        excerpt, excerpt_tokens = representative_excerpt(text, term_weights, max_excerpt_tokens, count_tokens)
+    return DocumentHints(language, title, authors, keywords, phrases, excerpt, excerpt_tokens, text_tokens)
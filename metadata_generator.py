@@ -1,171 +1,642 @@
 import os
-import subprocess
+import re
 import json
 import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
-import random
-from tenacity import retry, stop_after_attempt, wait_exponential
-
-# Step 0: Function to ensure required packages are installed
-def ensure_required_packages():
-    required_packages = {
-        "openai": "openai==0.28",
-        "tqdm": "tqdm",
-        "tenacity": "tenacity"
-    }
-
-    for package, install_name in required_packages.items():
-        try:
-            __import__(package)
-            print(f"Debug: {package} is already installed.")
-        except ImportError:
-            print(f"Debug: {package} is not installed. Installing...")
-            subprocess.check_call(['pip', 'install', install_name])
-
-# Step 1: Ensure required packages are installed
-ensure_required_packages()
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
-# Step 2: Import the required packages
-import openai
+import metrics
+from lazy_imports import LazyModule
+from metadata_extract import CorpusProfile, extract_hints
+from metadata_validation import METADATA_SCHEMA, parse_metadata_response, validate_metadata
 
-# Step 3: Ensure proper version of OpenAI is installed (re-affirmation)
-print("Debug: Ensuring proper version of OpenAI package is installed")
-subprocess.check_call(['pip', 'install', 'openai==0.28'])
+# Step 1: openai and tiktoken are imported on first use, so importing this module (from the pipeline
+# or a worker) is fast. Packages are not installed here; run "python cli.py install-deps" once.
+openai = LazyModule("openai", "openai==0.28")
+tiktoken = LazyModule("tiktoken")
 
-# Step 4: Set OpenAI API key
-print("Debug: Setting OpenAI API key")
-openai.api_key = "YOUR_API_KEY_HERE" 
+# Step 2: OpenAI API key, sent with every request
+openai_api_key = "YOUR_API_KEY_HERE"
 
-# Step 5: Set folder paths
-print("Debug: Setting folder paths")
+# Step 3: Set folder paths
 ocr_folder = ""  # Folder where OCR text files are saved
 metadata_folder = "" # Folder where metadata JSON files are saved
 
-print("Debug: Checking folder existence")
-if not os.path.exists(ocr_folder):
-    raise SystemExit("OCR folder not found. Please ensure the OCR text files are saved in the correct folder.")
-if not os.path.exists(metadata_folder):
-    os.makedirs(metadata_folder)
+# Results are appended to a JSONL file as each document finishes and compacted into
+# metadata_results.json at the end. With resume on, files that already have metadata are skipped.
+resume = True
+metadata_jsonl_filename = os.path.join(metadata_folder, 'metadata_results.jsonl')
+llm_cache_folder = os.path.join(metadata_folder, '.llm_cache')
+
+def load_metadata_records(jsonl_filename):
+    # Latest record per file name from the JSONL results; a truncated last line from a crash is ignored
+    records = {}
+    if not os.path.exists(jsonl_filename):
+        return records
+    with open(jsonl_filename, 'r', encoding="utf-8") as jsonl_file:
+        for line in jsonl_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[record["file_name"]] = record
+    return records
+
+def has_metadata(record):
+    # Failed documents are recorded with only their file name (and the keys that were invalid)
+    return any(key not in ("file_name", "invalid_fields") for key in record)
+
+def is_complete(record):
+    # Metadata with every documented key valid; resume asks again only for the keys of other records
+    return has_metadata(record) and not record.get("invalid_fields")
+
+# Concurrency and rate limits shared by all requests of the run.
+# Set OPENAI_API_BASE (e.g. http://127.0.0.1:8765/v1 for mock_openai_server.py) to test locally.
+max_concurrent_files = 8
+max_concurrent_chunks = 8
+requests_per_minute = 200
+tokens_per_minute = 40000
+
+# Token budget of the model. Documents whose prompt would not fit are summarised chunk by chunk
+# (map) and the metadata is generated from the chunk summaries (reduce), so no text is dropped.
+metadata_model = "gpt-4"
+model_context_tokens = 8192
+metadata_max_tokens = 500
+chunk_tokens = 3000
+chunk_summary_max_tokens = 300
+
+# Local pre-extraction (metadata_extract.py): TF-IDF keywords over the whole corpus, title, author
+# and language candidates are found on this machine, and the prompt carries them plus an excerpt of
+# at most preextract_text_tokens tokens instead of the full text (or its chunk summaries). The prompt
+# size of every file, with and without pre-extraction, is written to prompt_savings_filename.
+preextract = True
+preextract_text_tokens = 1500
+preextract_keywords = 15
+prompt_savings_filename = os.path.join(metadata_folder, 'metadata_prompt_savings.json')
+
+# Every answer is parsed and checked against the documented keys (metadata_validation.py). Fenced,
+# chatty or slightly malformed JSON is repaired locally; only the keys that are still missing or
+# invalid are asked for again, in a short follow-up prompt, up to metadata_followup_attempts times.
+# Keys that stay invalid are listed under "invalid_fields" in the file's record, and resume asks
+# only for those. The follow-up carries the metadata found so far and, unless the abstract is
+# enough to go on, an excerpt of at most metadata_followup_text_tokens tokens.
+metadata_followup_attempts = 1
+metadata_followup_text_tokens = 1000
+
+# Per-stage timings (LLM requests, rate-limit waits, summarisation) and request, token, retry and
+# cache counters are written to metrics_filename (".json", or ".prom" for Prometheus text format)
+metrics_enabled = True
+metrics_filename = os.path.join(metadata_folder, 'metadata_metrics.json')
+debug_output = False
+
+# Step 3b: Shared token-bucket rate limiter
+class TokenBucketLimiter:
+    # Two token buckets (requests and tokens per minute) shared by every worker thread.
+    # A Retry-After from the API pauses all workers, not just the one that got the 429.
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.request_allowance = float(requests_per_minute)
+        self.token_allowance = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.request_allowance = min(self.request_capacity, self.request_allowance + elapsed * self.request_capacity / 60)
+        self.token_allowance = min(self.token_capacity, self.token_allowance + elapsed * self.token_capacity / 60)
+
+    def acquire(self, tokens):
+        # Block until one request and the given number of tokens may be spent
+        tokens = min(tokens, self.token_capacity)
+        wait_start = time.perf_counter()
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self.paused_until and self.request_allowance >= 1 and self.token_allowance >= tokens:
+                    self.request_allowance -= 1
+                    self.token_allowance -= tokens
+                    metrics.observe("rate_limit_wait", time.perf_counter() - wait_start)
+                    return
+                wait = max(
+                    self.paused_until - now,
+                    (1 - self.request_allowance) * 60 / self.request_capacity,
+                    (tokens - self.token_allowance) * 60 / self.token_capacity,
+                )
+            time.sleep(max(wait, 0.01))
+
+    def pause(self, seconds):
+        # Stop all workers from sending requests for the given number of seconds
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+# Custom exception for prompts that don't fit in the model's context window
+class ContextLengthExceededError(Exception):
+    pass
+
+class ApproximateEncoding:
+    # Stand-in for the model's encoding when its BPE tables can't be loaded (e.g. offline): a token
+    # per word piece of up to four characters, which errs on the high side for English text.
+    # decode() restores the text exactly, so chunking still cuts on token boundaries.
+    pattern = re.compile(r"\s*\S{1,4}|\s+")
+
+    def encode(self, text, disallowed_special=()):
+        return self.pattern.findall(text)
+
+    def decode(self, tokens):
+        return "".join(tokens)
+
+token_encoding = None
+token_encoding_lock = threading.Lock()
+
+def get_token_encoding():
+    # Loading the encoding reads (and on first use downloads) the BPE tables, so do it on demand
+    global token_encoding
+    with token_encoding_lock:
+        if token_encoding is None:
+            try:
+                token_encoding = tiktoken.encoding_for_model(metadata_model)
+            except Exception as e:
+                print(f"Could not load the {metadata_model} token encoding ({type(e).__name__}: {e}); "
+                      f"using approximate token counts")
+                token_encoding = ApproximateEncoding()
+    return token_encoding
+
+def estimate_tokens(text):
+    # Token count of a prompt for the rate limiter and the chunking budget
+    return len(get_token_encoding().encode(text, disallowed_special=()))
+
+rate_limiter = TokenBucketLimiter(requests_per_minute, tokens_per_minute)
+
+# Step 4: Helper function to fetch response from OpenAI
+system_message = "You are an expert metadata generator."
+llm_cache_stats = {"hits": 0, "misses": 0}
+llm_cache_lock = threading.Lock()
+
+def llm_cache_key(prompt, model, max_tokens, temperature):
+    # The prompt already contains the OCR text and the prompt template
+    request = json.dumps([system_message, prompt, model, max_tokens, temperature], ensure_ascii=False)
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
 
-print("Debug: Reading OCR text files from folder: {}".format(ocr_folder))
-ocr_files = [f for f in os.listdir(ocr_folder) if f.endswith('.txt')]
-while True:
+def fetch_response(prompt, model, max_tokens, temperature):
+    # Answer from the persistent response cache when the exact same request was made before
+    cache_path = os.path.join(llm_cache_folder, llm_cache_key(prompt, model, max_tokens, temperature) + ".json")
     try:
-        num_files_to_process = int(input("Enter the number of files to process (or enter -1 to process all files, or specify a number to process up to that limit): "))
-        if num_files_to_process == -1 or num_files_to_process > 0:
-            break
-        else:
-            print("Please enter a valid number greater than 0 or -1 to process all files.")
-    except ValueError:
-        print("Invalid input. Please enter a numeric value.")
-
-if num_files_to_process > 0:
-    ocr_files = ocr_files[:min(len(ocr_files), num_files_to_process)]
-if len(ocr_files) == 0:
-    raise SystemExit("No OCR text files found in the OCR folder. Please run the OCR extraction first.")
-
-print("Debug: Number of OCR files to process: {}".format(len(ocr_files)))
-
-# Step 6: Helper function to fetch response from OpenAI
-print("Debug: Defining helper function to fetch response from OpenAI")
-@retry(stop=stop_after_attempt(5), wait=wait_exponential(multiplier=1, min=4, max=60))
-def fetch_response(prompt, model, max_tokens, temperature, retry_attempt=0):
-    print("Debug: Fetching response from OpenAI")
+        with open(cache_path, 'r', encoding="utf-8") as cache_file:
+            response = json.load(cache_file)
+        with llm_cache_lock:
+            llm_cache_stats["hits"] += 1
+        metrics.incr("llm_cache_hits")
+        return response
+    except (FileNotFoundError, json.JSONDecodeError):
+        with llm_cache_lock:
+            llm_cache_stats["misses"] += 1
+        metrics.incr("llm_cache_misses")
+
+    response = request_completion(prompt, model, max_tokens, temperature)
+    if response:
+        os.makedirs(llm_cache_folder, exist_ok=True)
+        temp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w', encoding="utf-8") as cache_file:
+            json.dump(response, cache_file)
+        os.replace(temp_path, cache_path)
+    return response
+
+def forget_response(prompt, model, max_tokens, temperature):
+    # Drop a cached answer that turned out to be unusable, so the next run asks again
+    cache_path = os.path.join(llm_cache_folder, llm_cache_key(prompt, model, max_tokens, temperature) + ".json")
     try:
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=[{"role": "system", "content": "You are an expert metadata generator."}, {"role": "user", "content": prompt}],
-            max_tokens=max_tokens,
-            temperature=temperature,
-            request_timeout=30
-        )
-        delay = random.uniform(1, 3)
-        print(f"Waiting for {delay:.2f} seconds to avoid rate limit...")
-        time.sleep(delay)
+        os.remove(cache_path)
+    except FileNotFoundError:
+        pass
+
+def count_retry(retry_state):
+    metrics.incr("llm_retries")
+
+def is_retryable(error):
+    # Invalid requests (including prompts that are too long) fail the same way every time, so they are
+    # not retried. Checked at call time so that defining the retry policy doesn't import openai.
+    return not isinstance(error, (ContextLengthExceededError, openai.error.InvalidRequestError))
+
+@retry(stop=stop_after_attempt(5), wait=wait_exponential(multiplier=1, min=4, max=60),
+       retry=retry_if_exception(is_retryable), before_sleep=count_retry)
+def request_completion(prompt, model, max_tokens, temperature):
+    metrics.debug("Fetching response from OpenAI")
+    prompt_tokens = estimate_tokens(prompt)
+    rate_limiter.acquire(prompt_tokens + max_tokens)
+    metrics.incr("llm_requests")
+    metrics.incr("llm_prompt_tokens", prompt_tokens)
+    try:
+        with metrics.span("llm_request"):
+            response = openai.ChatCompletion.create(
+                model=model,
+                messages=[{"role": "system", "content": system_message}, {"role": "user", "content": prompt}],
+                max_tokens=max_tokens,
+                temperature=temperature,
+                api_key=openai_api_key,
+                request_timeout=30
+            )
+        usage = response.get('usage') or {}
+        metrics.incr("llm_completion_tokens", usage.get('completion_tokens', 0))
         return response
     except openai.error.InvalidRequestError as e:
-        if 'maximum context length' in str(e) and retry_attempt < 3:
-            print("Token limit exceeded, retrying with additional chunking...")
-            reduced_prompt = prompt[:len(prompt) // 2]  # Reduce the prompt size by half
-            return fetch_response(reduced_prompt, model, max_tokens // 2, temperature, retry_attempt + 1)
+        if 'maximum context length' in str(e):
+            # Let the caller split the text further instead of silently cutting the prompt
+            raise ContextLengthExceededError(str(e)) from e
         raise
     except openai.error.RateLimitError as e:
-        retry_after = int(e.headers.get('Retry-After', 60))
-        print(f"Rate limit reached. Waiting for {retry_after} seconds before retrying...")
-        time.sleep(retry_after)
+        metrics.incr("llm_rate_limited")
+        retry_after = float((e.headers or {}).get('Retry-After', 60))
+        print(f"Rate limit reached. Pausing all requests for {retry_after} seconds before retrying...")
+        rate_limiter.pause(retry_after)
         raise
     except openai.error.OpenAIError as e:
+        metrics.incr("llm_errors")
         print(f"Error during API request: {e}")
         return None
 
-# Step 7: Function to process a single file
-print("Debug: Defining function to process a single file")
-def process_file(ocr_file):
-    print(f"Debug: Processing file: {ocr_file}")
-    try:
-        with open(os.path.join(ocr_folder, ocr_file), 'r') as file:
-            ocr_text = file.read()
-    except FileNotFoundError as e:
-        print(f"Error reading file {ocr_file}: {e}")
-        return None
+# Step 4b: The documented metadata keys as the prompts describe them
+metadata_field_descriptions = {
+    "Abstract": "Abstract (Resumen): A concise summary (150-200 words) of the document's primary themes and content.",
+    "Keywords": "Keywords (Palabras Clave): A list of relevant keywords (6-10) summarizing the document's core topics.",
+    "Description": "Description: A brief (1-2 sentence) description capturing the essence of the document.",
+    "Title": "Title: The main title of the document.",
+    "Creator": "Creator (Autor): The name(s) of the document's author(s).",
+    "Subject": "Subject: The general subject or field the document pertains to.",
+    "Basic Keywords": "Basic Keywords: A list of simple keywords summarizing the document.",
+    "Long-tail keywords": "Long-tail keywords: Detailed, descriptive keyword phrases related to the document's content.",
+    "SEO Keywords": "SEO Keywords: Keywords optimized for search engines, capturing both broad and niche aspects of the document.",
+}
 
-    # Split text into manageable chunks if it exceeds token limits
-    print("Debug: Splitting text into manageable chunks")
-    def chunk_text(text, chunk_size):
-        for i in range(0, len(text), chunk_size):
-            yield text[i:i + chunk_size]
+def describe_fields(fields):
+    return "\n".join("- " + metadata_field_descriptions[field] for field in fields)
 
-    chunks = list(chunk_text(ocr_text, 2000))
-    batched_chunks = ['\n'.join(chunks[i:i + min(5, len(chunks) - i)]) for i in range(0, len(chunks), 5)]  # Batch chunks into groups of 5
-
-    # Generate metadata fields for the document
-    print(f"Debug: Generating metadata for the entire document: {ocr_file}")
-    prompt = f"""
+# Step 5: Token-aware map-reduce helpers
+def build_metadata_prompt(document_text, hints_text=""):
+    return f"""
     You are an expert metadata curator and librarian specializing in media studies. Your task is to analyze the provided OCR text from a document and generate structured metadata in JSON format. Please ensure the metadata is detailed, contextually accurate, and adheres to the following keys:
 
-- Abstract (Resumen): A concise summary (150-200 words) of the document's primary themes and content.
-- Keywords (Palabras Clave): A list of relevant keywords (6-10) summarizing the document's core topics.
-- Description: A brief (1-2 sentence) description capturing the essence of the document.
-- Title: The main title of the document.
-- Creator (Autor): The name(s) of the document's author(s).
-- Subject: The general subject or field the document pertains to.
-- Basic Keywords: A list of simple keywords summarizing the document.
-- Long-tail keywords: Detailed, descriptive keyword phrases related to the document's content.
-- SEO Keywords: Keywords optimized for search engines, capturing both broad and niche aspects of the document.
+{describe_fields(METADATA_SCHEMA)}
 
 **Output:**
 The metadata should be returned as a well-structured JSON object with all keys filled. Use "Unknown" or "Not Available" for any fields that cannot be determined from the input text.
 
-{''.join(chunks)}
+{hints_text}{document_text}
 """
 
-    response = fetch_response(prompt, "gpt-4", 500, 0.5)
-    if response:
-        metadata_content = response['choices'][0]['message']['content'].strip()
-        # Convert metadata_content to a dictionary
+def build_summary_prompt(section_text, section_label):
+    return f"""
+    The following is {section_label} of an OCR'd document. Summarize its content in at most 200 words. Also list any title, author names, dates, subjects and key terms that appear in it. Only report what the text supports.
+
+{section_text}
+"""
+
+metadata_text_budget = None
+
+def get_metadata_text_budget():
+    # Largest amount of document text that still fits in a metadata prompt with room for the answer
+    global metadata_text_budget
+    if metadata_text_budget is None:
+        metadata_text_budget = model_context_tokens - estimate_tokens(build_metadata_prompt("")) - metadata_max_tokens - 100
+    return metadata_text_budget
+
+def chunk_text_by_tokens(text, max_tokens):
+    # Split text into pieces of at most max_tokens tokens, cutting on token boundaries
+    encoding = get_token_encoding()
+    tokens = encoding.encode(text, disallowed_special=())
+    return [encoding.decode(tokens[i:i + max_tokens]) for i in range(0, len(tokens), max_tokens)]
+
+def summarize_section(section_text, section_label):
+    # Map step for one chunk; a chunk that still overflows the context is split in half
+    try:
+        response = fetch_response(build_summary_prompt(section_text, section_label), metadata_model,
+                                  chunk_summary_max_tokens, 0.3)
+    except ContextLengthExceededError:
+        halves = chunk_text_by_tokens(section_text, max(1, estimate_tokens(section_text) // 2 + 1))
+        return "\n".join(summarize_section(half, section_label) for half in halves)
+    if not response:
+        raise openai.error.OpenAIError(f"No summary returned for {section_label}")
+    return response['choices'][0]['message']['content'].strip()
+
+chunk_executor = ThreadPoolExecutor(max_workers=max_concurrent_chunks)
+
+def summarize_for_metadata(ocr_text, ocr_file):
+    # Map-reduce until the text fits in one metadata prompt: summarise chunks concurrently, then
+    # summarise groups of summaries if they are still too long together. Each round shrinks the
+    # text several-fold, so even long books need only a few rounds.
+    text = ocr_text
+    round_number = 1
+    while estimate_tokens(text) > get_metadata_text_budget():
+        chunks = chunk_text_by_tokens(text, chunk_tokens)
+        metrics.debug(f"{ocr_file}: summarising {len(chunks)} chunks (round {round_number})")
+        labels = [f"part {i + 1} of {len(chunks)}" for i in range(len(chunks))]
+        with metrics.span("summarize_round"):
+            summaries = list(chunk_executor.map(summarize_section, chunks, labels))
+        metrics.incr("summarized_chunks", len(chunks))
+        summarised_text = "\n\n".join(f"[Part {i + 1}]\n{summary}" for i, summary in enumerate(summaries))
+        if estimate_tokens(summarised_text) >= estimate_tokens(text):
+            raise openai.error.OpenAIError(f"Chunk summaries of {ocr_file} are not shorter than the text")
+        text = summarised_text
+        round_number += 1
+    if round_number > 1:
+        text = "Section summaries of the document (the full text is too long to include):\n\n" + text
+    return text
+
+# Step 5b: Local pre-extraction
+corpus_profile = CorpusProfile()
+prompt_savings = {}
+prompt_savings_lock = threading.Lock()
+
+def build_corpus_profile(folder, text_files, batch_size=100):
+    # Count the document frequencies of the whole corpus up front, a batch of files at a time
+    with metrics.span("corpus_profile"):
+        for start in range(0, len(text_files), batch_size):
+            documents = []
+            for text_file in text_files[start:start + batch_size]:
+                with open(os.path.join(folder, text_file), 'r', encoding="utf-8") as file:
+                    documents.append((text_file, file.read()))
+            corpus_profile.add_documents(documents)
+    metrics.debug(f"Corpus profile: {corpus_profile.documents} documents, {len(corpus_profile.terms)} terms")
+
+def build_preextracted_prompt(ocr_text, ocr_file):
+    # Metadata prompt with the locally found candidates and a representative excerpt. A document
+    # that arrives after the corpus pass (streaming pipeline) is added to the profile first.
+    # A document that fits in preextract_text_tokens goes out whole, without candidates.
+    with metrics.span("preextract"):
+        corpus_profile.add_document(ocr_file, ocr_text)
+        hints = extract_hints(ocr_text, corpus_profile, estimate_tokens, preextract_text_tokens, preextract_keywords)
+        if hints.excerpt_tokens < hints.text_tokens:
+            prompt = build_metadata_prompt(hints.excerpt, hints.prompt_section() + "\n\n")
+        else:
+            prompt = build_metadata_prompt(ocr_text)
+
+    # What sending the whole text would have cost; longer documents would have needed even more
+    # tokens for their chunk summaries
+    full_tokens = estimate_tokens(build_metadata_prompt(ocr_text))
+    prompt_tokens = estimate_tokens(prompt)
+    saved_tokens = max(0, full_tokens - prompt_tokens)
+    metrics.incr("preextract_prompt_tokens_saved", saved_tokens)
+    metrics.debug(f"{ocr_file}: metadata prompt {prompt_tokens} tokens instead of {full_tokens}")
+    with prompt_savings_lock:
+        prompt_savings[ocr_file] = {
+            "full_text_prompt_tokens": full_tokens,
+            "prompt_tokens": prompt_tokens,
+            "saved_tokens": saved_tokens,
+            "saved_percent": round(100 * saved_tokens / full_tokens, 1) if full_tokens else 0.0,
+            "language": hints.language,
+        }
+    return prompt
+
+def report_prompt_savings():
+    # Print the total and write the per-file prompt sizes of this run
+    with prompt_savings_lock:
+        if not prompt_savings:
+            return
+        savings = dict(prompt_savings)
+    full_tokens = sum(entry["full_text_prompt_tokens"] for entry in savings.values())
+    prompt_tokens = sum(entry["prompt_tokens"] for entry in savings.values())
+    print(f"Local pre-extraction: {len(savings)} files, {prompt_tokens} prompt tokens instead of {full_tokens} "
+          f"({100 * (full_tokens - prompt_tokens) / full_tokens if full_tokens else 0:.0f}% fewer)")
+    with open(prompt_savings_filename, 'w', encoding="utf-8") as savings_file:
+        json.dump(savings, savings_file, indent=4)
+
+# Step 5c: Validation of the answers, and follow-up requests for the keys that failed
+validation_stats = {"responses": 0, "invalid": 0, "unparseable": 0, "repaired": 0, "invalid_fields": 0,
+                    "followups": 0, "recovered_fields": 0, "unresolved_fields": 0, "wasted_tokens": 0,
+                    "followup_tokens": 0}
+validation_lock = threading.Lock()
+
+# Keys a follow-up can fill in from the metadata already found, once the abstract is known
+abstract_derived_fields = {"Keywords", "Description", "Subject", "Basic Keywords", "Long-tail keywords", "SEO Keywords"}
+
+def count_validation(**counts):
+    with validation_lock:
+        for name, value in counts.items():
+            validation_stats[name] += value
+    for name, value in counts.items():
+        metrics.incr(f"metadata_{name}", value)
+
+def response_tokens(prompt, response):
+    # Tokens a request used, from the answer's usage when the API reported it
+    usage = response.get('usage') or {}
+    return usage.get('total_tokens') or estimate_tokens(prompt) + estimate_tokens(response['choices'][0]['message']['content'])
+
+def check_metadata_response(response, prompt, ocr_file):
+    # Parse and validate the answer to a metadata prompt; returns (metadata, invalid keys)
+    metadata_dict, invalid_fields, recovery = parse_metadata_response(response['choices'][0]['message']['content'].strip())
+    counts = {"responses": 1, "invalid_fields": len(invalid_fields)}
+    if recovery is None:
+        print(f"Error: The metadata content for {ocr_file} is not valid JSON.")
+        counts["unparseable"] = 1
+    elif recovery != "clean":
+        counts["repaired"] = 1
+    if invalid_fields:
+        counts["invalid"] = 1
+        metrics.debug(f"{ocr_file}: invalid metadata keys {', '.join(invalid_fields)} ({recovery or 'no JSON'})")
+    if len(invalid_fields) == len(METADATA_SCHEMA):
+        # Nothing of the answer could be used, and a cached copy would fail the same way on the next run
+        counts["wasted_tokens"] = response_tokens(prompt, response)
+        forget_response(prompt, metadata_model, metadata_max_tokens, 0.5)
+    count_validation(**counts)
+    return metadata_dict, invalid_fields
+
+def build_followup_prompt(fields, metadata_dict, context_text):
+    known = {key: value for key, value in metadata_dict.items() if key in METADATA_SCHEMA}
+    known_text = f"Metadata already found for the document:\n{json.dumps(known, ensure_ascii=False)}\n\n" if known else ""
+    return f"""
+    You are an expert metadata curator and librarian specializing in media studies. Complete the metadata of a document by returning a JSON object with exactly these keys and nothing else:
+
+{describe_fields(fields)}
+
+Use "Unknown" or "Not Available" for any field that cannot be determined. Return only the JSON object, without markdown or comments.
+
+{known_text}{context_text}
+"""
+
+def followup_context(ocr_text, ocr_file, metadata_dict, fields):
+    # No document text when the abstract already tells enough; otherwise the locally found candidates
+    # and an excerpt (or the opening of the text) of at most metadata_followup_text_tokens tokens
+    if "Abstract" in metadata_dict and set(fields) <= abstract_derived_fields:
+        return ""
+    if preextract:
+        corpus_profile.add_document(ocr_file, ocr_text)
+        hints = extract_hints(ocr_text, corpus_profile, estimate_tokens, metadata_followup_text_tokens, preextract_keywords)
+        if hints.excerpt_tokens < hints.text_tokens:
+            return hints.prompt_section() + "\n\n" + hints.excerpt
+        return ocr_text
+    return chunk_text_by_tokens(ocr_text, metadata_followup_text_tokens)[0] if ocr_text else ""
+
+def followup_max_tokens(fields):
+    # The abstract takes up to 200 words; every other key a line or a short list
+    return min(metadata_max_tokens, sum(320 if field == "Abstract" else 80 for field in fields))
+
+def request_missing_fields(ocr_text, ocr_file, metadata_dict, invalid_fields):
+    # Ask only for the invalid keys and merge the valid ones of each answer into metadata_dict;
+    # returns (metadata, keys that are still invalid)
+    for _ in range(metadata_followup_attempts):
+        if not invalid_fields:
+            break
+        metrics.debug(f"{ocr_file}: follow-up request for {', '.join(invalid_fields)}")
+        prompt = build_followup_prompt(invalid_fields, metadata_dict,
+                                       followup_context(ocr_text, ocr_file, metadata_dict, invalid_fields))
+        max_tokens = followup_max_tokens(invalid_fields)
         try:
-            metadata_dict = json.loads(metadata_content)
-            metadata_dict["file_name"] = ocr_file  # Add the file name to the metadata dictionary
-        except json.JSONDecodeError:
-            print("Error: The metadata content is not valid JSON.")
-            metadata_dict = {"file_name": ocr_file}
+            response = fetch_response(prompt, metadata_model, max_tokens, 0.3)
+        except ContextLengthExceededError as e:
+            print(f"Error: The follow-up prompt for {ocr_file} is too long: {e}")
+            break
+        if not response:
+            break
+        answer, _, _ = parse_metadata_response(response['choices'][0]['message']['content'].strip())
+        recovered = [field for field in invalid_fields if field in answer]
+        for field in recovered:
+            metadata_dict[field] = answer[field]
+        count_validation(followups=1, recovered_fields=len(recovered), followup_tokens=response_tokens(prompt, response))
+        invalid_fields = [field for field in invalid_fields if field not in recovered]
+        if invalid_fields:
+            # The cached answer would fail the same way on the next run
+            forget_response(prompt, metadata_model, max_tokens, 0.3)
+    count_validation(unresolved_fields=len(invalid_fields))
+    return metadata_dict, invalid_fields
+
+def report_validation():
+    # Print how many answers needed repair or a follow-up, and the tokens that cost
+    with validation_lock:
+        stats = dict(validation_stats)
+    if not stats["responses"] and not stats["followups"]:
+        return
+    invalid_percent = 100 * stats["invalid"] / stats["responses"] if stats["responses"] else 0.0
+    print(f"Metadata answers: {stats['responses']}, {stats['invalid']} with invalid keys ({invalid_percent:.1f}%), "
+          f"{stats['unparseable']} without JSON, {stats['repaired']} repaired locally")
+    print(f"Follow-up requests: {stats['followups']}, {stats['recovered_fields']} keys recovered, "
+          f"{stats['unresolved_fields']} still invalid; {stats['wasted_tokens']} tokens spent on unusable answers, "
+          f"{stats['followup_tokens']} on follow-ups")
+
+# Step 6: Function to process a single file
+def process_file(ocr_file, folder=None, previous=None):
+    # previous: the file's record from an earlier run; if it has invalid keys, only those are asked for
+    metrics.debug(f"Processing file: {ocr_file}")
+    try:
+        with open(os.path.join(folder or ocr_folder, ocr_file), 'r', encoding="utf-8") as file:
+            ocr_text = file.read()
+    except FileNotFoundError as e:
+        print(f"Error reading file {ocr_file}: {e}")
+        return None
+
+    if previous and has_metadata(previous) and previous.get("invalid_fields"):
+        metadata_dict, invalid_fields = validate_metadata(
+            {key: value for key, value in previous.items() if key not in ("file_name", "invalid_fields")})
     else:
-        metadata_dict = {"file_name": ocr_file}
+        if preextract:
+            prompt = build_preextracted_prompt(ocr_text, ocr_file)
+        else:
+            # Reduce long documents to chunk summaries that fit in the model's context window
+            try:
+                document_text = summarize_for_metadata(ocr_text, ocr_file)
+            except openai.error.OpenAIError as e:
+                print(f"Error summarising {ocr_file}: {e}")
+                return {"file_name": ocr_file}
+            prompt = build_metadata_prompt(document_text)
+
+        # Generate metadata fields for the document
+        metrics.debug(f"Generating metadata for the entire document: {ocr_file}")
 
+        try:
+            response = fetch_response(prompt, metadata_model, metadata_max_tokens, 0.5)
+        except ContextLengthExceededError as e:
+            print(f"Error: The metadata prompt for {ocr_file} is too long: {e}")
+            response = None
+        if not response:
+            return {"file_name": ocr_file}
+        metadata_dict, invalid_fields = check_metadata_response(response, prompt, ocr_file)
+
+    if invalid_fields:
+        metadata_dict, invalid_fields = request_missing_fields(ocr_text, ocr_file, metadata_dict, invalid_fields)
+    metadata_dict["file_name"] = ocr_file  # Add the file name to the metadata dictionary
+    if invalid_fields:
+        metadata_dict["invalid_fields"] = invalid_fields
     return metadata_dict
 
-# Step 8: Process OCR files sequentially
-print("Debug: Starting to process OCR files sequentially")
-metadata_results = []
-for ocr_file in tqdm(ocr_files, desc="Processing OCR Files", bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]"):
-    result = process_file(ocr_file)
+# Step 7: Process OCR files concurrently behind the shared rate limiter
+jsonl_lock = threading.Lock()
+
+def process_and_record(ocr_file, folder=None, previous=None):
+    # Append each document's metadata as soon as it is done, so a crash loses at most the files in flight
+    with metrics.span("document"):
+        result = process_file(ocr_file, folder, previous)
+    metrics.incr("documents")
     if result:
-        metadata_results.append(result)
+        with jsonl_lock, open(metadata_jsonl_filename, 'a', encoding="utf-8") as jsonl_file:
+            jsonl_file.write(json.dumps(result, ensure_ascii=False) + "\n")
+            jsonl_file.flush()
+    return result
+
+def compact_metadata(jsonl_filename, json_filename):
+    # Write the latest record of every file from the JSONL results to the JSON results file
+    records = load_metadata_records(jsonl_filename)
+    with open(json_filename, 'w', encoding="utf-8") as json_file:
+        json.dump(list(records.values()), json_file, indent=4)
+    return records
+
+# Step 8: Run the metadata generation for the OCR folder
+def main():
+    metrics.configure(enabled=metrics_enabled, debug=debug_output)
+    metrics.debug("Checking folder existence")
+    if not os.path.exists(ocr_folder):
+        raise SystemExit("OCR folder not found. Please ensure the OCR text files are saved in the correct folder.")
+    if not os.path.exists(metadata_folder):
+        os.makedirs(metadata_folder)
+
+    metrics.debug("Reading OCR text files from folder: {}".format(ocr_folder))
+    ocr_files = [f for f in os.listdir(ocr_folder) if f.endswith('.txt')]
+    previous_records = load_metadata_records(metadata_jsonl_filename) if resume else {}
+    finished_files = {name for name, record in previous_records.items() if is_complete(record)}
+    if finished_files:
+        metrics.debug(f"Resuming: skipping {len(finished_files & set(ocr_files))} files that already have metadata")
+        ocr_files = [f for f in ocr_files if f not in finished_files]
+    while True:
+        try:
+            num_files_to_process = int(input("Enter the number of files to process (or enter -1 to process all files, or specify a number to process up to that limit): "))
+            if num_files_to_process == -1 or num_files_to_process > 0:
+                break
+            else:
+                print("Please enter a valid number greater than 0 or -1 to process all files.")
+        except ValueError:
+            print("Invalid input. Please enter a numeric value.")
+
+    if num_files_to_process > 0:
+        ocr_files = ocr_files[:min(len(ocr_files), num_files_to_process)]
+    if not any(f.endswith('.txt') for f in os.listdir(ocr_folder)):
+        raise SystemExit("No OCR text files found in the OCR folder. Please run the OCR extraction first.")
+
+    metrics.debug("Number of OCR files to process: {}".format(len(ocr_files)))
+    if preextract:
+        # TF-IDF weighs terms by how many documents of the whole corpus use them
+        build_corpus_profile(ocr_folder, [f for f in os.listdir(ocr_folder) if f.endswith('.txt')])
+
+    metrics.debug(f"Starting to process OCR files with {max_concurrent_files} workers")
+    with ThreadPoolExecutor(max_workers=max_concurrent_files) as executor:
+        results = executor.map(lambda ocr_file: process_and_record(ocr_file, previous=previous_records.get(ocr_file)), ocr_files)
+        for result in tqdm(results, total=len(ocr_files), desc="Processing OCR Files", bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]"):
+            pass
+
+    print(f"LLM response cache: {llm_cache_stats['hits']} hits, {llm_cache_stats['misses']} misses")
+    report_prompt_savings()
+    report_validation()
+
+    # Compact the JSONL results into the metadata JSON file
+    metadata_filename = os.path.join(metadata_folder, 'metadata_results.json')
+    print(f"Saving metadata to file: {metadata_filename}")
+    metadata_results = compact_metadata(metadata_jsonl_filename, metadata_filename)
 
-# Step 9: Save metadata to a JSON file
-metadata_filename = os.path.join(metadata_folder, 'metadata_results.json')
-print(f"Saving metadata to file: {metadata_filename}")
-with open(metadata_filename, 'w', encoding="utf-8") as json_file:
-    json.dump(metadata_results, json_file, indent=4)
+    print(f"Metadata for {len(metadata_results)} files saved to {metadata_filename}")
+    metrics.export(metrics_filename)
 
-print(f"Metadata saved to {metadata_filename}")
+if __name__ == "__main__":
+    main()
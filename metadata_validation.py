@@ -0,0 +1,154 @@
+import re
+import ast
+import json
+
+# Parsing, repair and validation of the metadata the model returns.
+# Answers often arrive wrapped in markdown fences, with a sentence before or after the JSON, with
+# trailing commas or smart quotes, or cut off at max_tokens. parse_metadata_response() recovers the
+# JSON object where it can, maps key variants ("Abstract (Resumen)", "long_tail_keywords") to the
+# documented keys and checks every field against METADATA_SCHEMA, so only the fields that are
+# missing or malformed need to be asked for again.
+
+# Documented metadata keys and the kind of value each must have
+METADATA_SCHEMA = {
+    "Abstract": "text",
+    "Keywords": "list",
+    "Description": "text",
+    "Title": "text",
+    "Creator": "names",
+    "Subject": "text",
+    "Basic Keywords": "list",
+    "Long-tail keywords": "list",
+    "SEO Keywords": "list",
+}
+
+FENCE_PATTERN = re.compile(r"```(?:json|JSON)?\s*(.*?)```", re.DOTALL)
+SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "‘": "'", "’": "'"})
+
+def normalise_key(key):
+    # "Abstract (Resumen)", "long_tail_keywords" and "SEO keywords" all name a documented key
+    key = re.sub(r"\s*\(.*?\)\s*", " ", str(key))
+    return re.sub(r"[\s_-]+", " ", key).strip().lower()
+
+SCHEMA_KEYS = {normalise_key(key): key for key in METADATA_SCHEMA}
+
+def close_truncated_json(text):
+    # Close the strings, arrays and objects left open by an answer cut off at max_tokens, dropping a
+    # dangling key or comma. Returns (closed text, True if anything had to be closed).
+    stack = []
+    in_string = False
+    escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in "[{":
+            stack.append("]" if char == "[" else "}")
+        elif char in "]}" and stack:
+            stack.pop()
+    if not stack and not in_string:
+        return text, False
+    if in_string:
+        text += '"'
+    text = text.rstrip()
+    # A key without its value, or a trailing comma, can't be completed
+    text = re.sub(r',?\s*"[^"]*"\s*:\s*$', "", text)
+    if stack and stack[-1] == "}":
+        text = re.sub(r',\s*"[^"]*"$', "", text)
+    text = re.sub(r",\s*$", "", text)
+    return text + "".join(reversed(stack)), True
+
+def extract_json(content):
+    # Return (parsed object or None, how it was recovered: "clean", "repaired" or "truncated")
+    try:
+        return json.loads(content), "clean"
+    except (json.JSONDecodeError, TypeError):
+        pass
+    fenced = FENCE_PATTERN.search(content)
+    text = fenced.group(1) if fenced else content
+    # Drop any prose before the object (and after it, when the object is complete)
+    start = text.find("{")
+    if start < 0:
+        return None, None
+    text = text[start:]
+    # A complete object, whatever follows it
+    try:
+        value, _ = json.JSONDecoder().raw_decode(text)
+        if isinstance(value, dict):
+            return value, "repaired"
+    except json.JSONDecodeError:
+        pass
+    end = text.rfind("}")
+    candidates = [text[:end + 1]] if end >= 0 else []
+    candidates.append(text)
+    for candidate in candidates:
+        candidate = candidate.translate(SMART_QUOTES)
+        candidate = re.sub(r",\s*([}\]])", r"\1", candidate)
+        closed, truncated = close_truncated_json(candidate)
+        for attempt in (closed, candidate):
+            try:
+                return json.loads(attempt), "truncated" if truncated and attempt is closed else "repaired"
+            except json.JSONDecodeError:
+                pass
+        # Python-style literals: single quotes, None, True
+        try:
+            value = ast.literal_eval(closed)
+            if isinstance(value, dict):
+                return value, "truncated" if truncated else "repaired"
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            pass
+    return None, None
+
+def clean_value(value, kind):
+    # The value in the shape its kind requires, or None if it can't be used
+    if kind == "list":
+        if isinstance(value, str):
+            value = [item for item in re.split(r"\s*[,;\n]\s*", value)]
+        if not isinstance(value, list):
+            return None
+        items = [str(item).strip() for item in value if isinstance(item, (str, int, float)) and str(item).strip()]
+        return items or None
+    if kind == "names":
+        if isinstance(value, list):
+            names = [str(item).strip() for item in value if isinstance(item, str) and item.strip()]
+            return names or None
+        return value.strip() or None if isinstance(value, str) else None
+    if isinstance(value, list) and all(isinstance(item, str) for item in value):
+        value = " ".join(value)
+    return value.strip() or None if isinstance(value, str) else None
+
+def validate_metadata(data, truncated=False):
+    # Return (metadata with the documented keys, keys that are missing or invalid). Keys outside the
+    # schema are kept as they are. In a truncated answer the last field may be cut short, so it is
+    # treated as invalid.
+    metadata = {}
+    invalid = []
+    if not isinstance(data, dict):
+        return metadata, list(METADATA_SCHEMA)
+    last_key = None
+    for key, value in data.items():
+        schema_key = SCHEMA_KEYS.get(normalise_key(key))
+        if schema_key is None:
+            metadata[key] = value
+            continue
+        cleaned = clean_value(value, METADATA_SCHEMA[schema_key])
+        if cleaned is not None:
+            metadata[schema_key] = cleaned
+            last_key = schema_key
+    if truncated and last_key is not None:
+        del metadata[last_key]
+    invalid = [key for key in METADATA_SCHEMA if key not in metadata]
+    return metadata, invalid
+
+def parse_metadata_response(content):
+    # Return (metadata, invalid keys, recovery): recovery is "clean", "repaired", "truncated" or
+    # None when no JSON object could be found at all
+    data, recovery = extract_json(content)
+    metadata, invalid = validate_metadata(data, truncated=recovery == "truncated")
+    return metadata, invalid, recovery
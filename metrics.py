@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import threading
+
+# Lightweight run instrumentation shared by the OCR scripts and metadata_generator.py.
+#   - span("stage") times a block; durations are aggregated per stage (count, total, percentiles)
+#     and, with per-page recording on, also kept per document and page
+#   - incr("counter", n) counts API calls, bytes uploaded, retries, cache hits, ...
+#   - debug("...") replaces the old unconditional "Debug: ..." prints
+# Everything is off by default: span() then returns a shared no-op context manager and incr() and
+# debug() return immediately, so instrumented code pays almost nothing.
+# export() writes JSON, or Prometheus text format if the file name ends in ".prom".
+
+_enabled = False
+_debug = False
+_record_pages = False
+_lock = threading.Lock()
+_stage_durations = {}
+_counters = {}
+_page_spans = []
+_current_document = None
+
+def configure(enabled=True, debug=False, record_pages=False):
+    global _enabled, _debug, _record_pages
+    _enabled = enabled
+    _debug = debug
+    _record_pages = enabled and record_pages
+
+def is_enabled():
+    return _enabled
+
+def debug(message):
+    if _debug:
+        print(f"Debug: {message}")
+
+def set_document(name):
+    # Document that per-page spans are attributed to
+    global _current_document
+    _current_document = name
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class _Span:
+    __slots__ = ("stage", "page", "start_time")
+
+    def __init__(self, stage, page):
+        self.stage = stage
+        self.page = page
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        observe(self.stage, time.perf_counter() - self.start_time, self.page)
+        return False
+
+def span(stage, page=None):
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(stage, page)
+
+def observe(stage, seconds, page=None):
+    if not _enabled:
+        return
+    with _lock:
+        _stage_durations.setdefault(stage, []).append(seconds)
+        if _record_pages and page is not None:
+            _page_spans.append((_current_document, page, stage, seconds))
+
+def incr(counter, value=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[counter] = _counters.get(counter, 0) + value
+
+def reset():
+    with _lock:
+        _stage_durations.clear()
+        _counters.clear()
+        _page_spans.clear()
+
+def snapshot():
+    # Raw measurements of this process, picklable so worker processes can hand them to the parent
+    with _lock:
+        return {
+            "stage_durations": {stage: list(values) for stage, values in _stage_durations.items()},
+            "counters": dict(_counters),
+            "page_spans": list(_page_spans),
+        }
+
+def merge(other):
+    # Add the measurements of another process (a snapshot()) to this one
+    if not _enabled or not other:
+        return
+    with _lock:
+        for stage, values in other["stage_durations"].items():
+            _stage_durations.setdefault(stage, []).extend(values)
+        for counter, value in other["counters"].items():
+            _counters[counter] = _counters.get(counter, 0) + value
+        _page_spans.extend(other["page_spans"])
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def stage_summary(values):
+    ordered = sorted(values)
+    if not ordered:
+        return {"count": 0, "total_s": 0.0, "mean_ms": 0.0, "p50_ms": 0.0, "p90_ms": 0.0, "p99_ms": 0.0, "max_ms": 0.0}
+    return {
+        "count": len(ordered),
+        "total_s": sum(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "p50_ms": _percentile(ordered, 0.50) * 1000,
+        "p90_ms": _percentile(ordered, 0.90) * 1000,
+        "p99_ms": _percentile(ordered, 0.99) * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+def summary():
+    data = snapshot()
+    return {
+        "stages": {stage: stage_summary(values) for stage, values in data["stage_durations"].items()},
+        "counters": data["counters"],
+        "pages": [{"document": document, "page": page, "stage": stage, "seconds": seconds}
+                  for document, page, stage, seconds in data["page_spans"]],
+    }
+
+def _prometheus_text(result, prefix):
+    lines = [f"# TYPE {prefix}_stage_seconds summary"]
+    for stage, stats in result["stages"].items():
+        for quantile, key in (("0.5", "p50_ms"), ("0.9", "p90_ms"), ("0.99", "p99_ms")):
+            lines.append(f'{prefix}_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {stats[key] / 1000:.6f}')
+        lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {stats["total_s"]:.6f}')
+        lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+    for counter, value in sorted(result["counters"].items()):
+        lines.append(f"# TYPE {prefix}_{counter}_total counter")
+        lines.append(f"{prefix}_{counter}_total {value}")
+    return "\n".join(lines) + "\n"
+
+def export(path, prefix="cwis"):
+    # Write the run's metrics; does nothing when instrumentation is off
+    if not _enabled:
+        return None
+    result = summary()
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as metrics_file:
+        if path.endswith(".prom"):
+            metrics_file.write(_prometheus_text(result, prefix))
+        else:
+            json.dump(result, metrics_file, indent=4)
+    print(f"Metrics written to {path}")
+    return result
@@ -0,0 +1,93 @@
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the OpenAI chat completions endpoint, for running metadata_generator.py
+# without credentials or cost. Point the openai package at it with:
+#   OPENAI_API_BASE=http://127.0.0.1:8765/v1
+# It answers every request with a fixed metadata JSON after a configurable latency and can
+# inject 429 responses with a Retry-After header to exercise the shared rate limiter.
+
+MOCK_METADATA = {
+    "Abstract": "Mock abstract.",
+    "Keywords": ["mock", "metadata"],
+    "Description": "Mock description.",
+    "Title": "Mock Title",
+    "Creator": "Unknown",
+    "Subject": "Media studies",
+    "Basic Keywords": ["mock"],
+    "Long-tail keywords": ["mock metadata response"],
+    "SEO Keywords": ["mock"],
+}
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    latency = 0.5
+    rate_limit_rate = 0.0
+    retry_after = 2
+    request_count = 0
+    count_lock = threading.Lock()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with self.count_lock:
+            MockOpenAIHandler.request_count += 1
+
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+            return
+        if random.random() < self.rate_limit_rate:
+            self._send_json(429, {"error": {"message": "Rate limit reached (mock)", "type": "rate_limit_error"}},
+                            {"Retry-After": str(self.retry_after)})
+            return
+
+        time.sleep(self.latency)
+        request = json.loads(body or b"{}")
+        prompt_tokens = sum(len(message.get("content", "")) // 4 for message in request.get("messages", []))
+        content = json.dumps(MOCK_METADATA)
+        self._send_json(200, {
+            "id": f"chatcmpl-mock-{self.request_count}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4,
+                      "total_tokens": prompt_tokens + len(content) // 4},
+        })
+
+    def _send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock OpenAI chat completions server.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds to wait before answering")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=2, help="Retry-After seconds sent with 429 responses")
+    args = parser.parse_args()
+
+    MockOpenAIHandler.latency = args.latency
+    MockOpenAIHandler.rate_limit_rate = args.rate_limit_rate
+    MockOpenAIHandler.retry_after = args.retry_after
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), MockOpenAIHandler)
+    print(f"Mock OpenAI server listening on http://127.0.0.1:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"Served {MockOpenAIHandler.request_count} requests.")
+
+if __name__ == "__main__":
+    main()
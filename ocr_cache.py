@@ -0,0 +1,111 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import metrics
+
+# Bump when the cached word box format or the bounding box extraction changes
+# 2: boxes are the words' own outlines; version 1 Vision boxes were shifted (see OCREngine.legacy_vertex_offset)
+CACHE_FORMAT_VERSION = 2
+
+# Persistent, content-addressed cache of OCR word boxes.
+# Entries are keyed by a hash of the rendered page pixels plus the DPI, the Vision feature and the
+# upload encoding, so a rerun with different overlay settings reuses the paid OCR results.
+# Each entry is a small JSON file; the least recently used entries are evicted once the cache
+# grows past max_bytes.
+class OCRCache:
+    def __init__(self, cache_folder, max_bytes=1024 ** 3):
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> size in bytes, least recently used first
+        self._total_bytes = 0
+        os.makedirs(cache_folder, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        # Rebuild the LRU order from file modification times (bumped on every hit)
+        found = []
+        for root, _, files in os.walk(self.cache_folder):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                found.append((stat.st_mtime, name[:-len(".json")], stat.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._total_bytes += size
+        metrics.debug(f"OCR cache at {self.cache_folder} holds {len(self._entries)} entries ({self._total_bytes} bytes).")
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_folder, key[:2], f"{key}.json")
+
+    @staticmethod
+    def make_key(page_bytes, dpi, feature="DOCUMENT_TEXT_DETECTION", image_format="png", image_quality=None,
+                 version=CACHE_FORMAT_VERSION):
+        # Hash the raw rendered page (e.g. pixmap.samples_mv) together with everything that
+        # changes what Vision sees or returns
+        digest = hashlib.blake2b(digest_size=32)
+        digest.update(f"v{version}|{dpi}|{feature}|{image_format}|{image_quality}|".encode("utf-8"))
+        digest.update(page_bytes)
+        return digest.hexdigest()
+
+    def get(self, key):
+        # Return the cached bounding boxes for key, or None on a miss
+        path = self._entry_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as cache_file:
+                entries = json.load(cache_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Mark the entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return [(word, [tuple(vertex) for vertex in vertices]) for word, vertices in entries]
+
+    def put(self, key, bounding_boxes):
+        # Store the bounding boxes for key and evict old entries if the cache is over its size limit
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps([[word, [list(vertex) for vertex in vertices]] for word, vertices in bounding_boxes])
+
+        # Write to a temporary file first so other processes never read a partial entry
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as cache_file:
+            cache_file.write(data)
+        os.replace(temp_path, path)
+
+        size = os.path.getsize(path)
+        with self._lock:
+            self._total_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self._entry_path(key))
+            except FileNotFoundError:
+                pass
+
+    def report(self):
+        # Print hit/miss counts for the run
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0.0
+        print(f"OCR cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), "
+              f"{len(self._entries)} entries, {self._total_bytes} bytes.")
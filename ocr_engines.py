@@ -0,0 +1,236 @@
+import io
+import os
+import threading
+
+import metrics
+from lazy_imports import LazyModule
+
+# OCR engines behind one interface.
+# Every engine turns encoded page images (PNG/JPEG bytes) into the same word-box structure: a list
+# of (word text, vertices) tuples in reading order, with the vertices in pixels of the submitted
+# image and vertices[0] / vertices[2] the top-left / bottom-right corners of the word. Punctuation
+# that follows a word is merged into it (merge_punctuation), the same way for every engine.
+# Each engine declares its own limits: how many requests may run at once and how many images fit
+# in one request. create_hybrid_ocr_pdf caps its concurrency and batch size accordingly.
+#   "vision"    - Google Cloud Vision DOCUMENT_TEXT_DETECTION (paid, network bound)
+#   "tesseract" - local Tesseract through pytesseract (free, CPU bound, needs the tesseract binary)
+
+vision = LazyModule("google.cloud.vision", "google-cloud-vision")
+pytesseract = LazyModule("pytesseract")
+PIL_Image = LazyModule("PIL.Image", "pillow")
+
+# Tesseract language(s), e.g. "eng+spa", and extra command-line options
+TESSERACT_LANGUAGE = "eng"
+TESSERACT_CONFIG = ""
+
+# Custom exception for errors reported inside a Google Vision response
+class VisionAPIError(Exception):
+    pass
+
+# Custom exception for an unknown engine name
+class UnknownOCREngineError(Exception):
+    pass
+
+def read_image_content(image):
+    # Accept encoded image bytes, a binary file-like object, or a path to an image file
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return bytes(image)
+    if hasattr(image, "read"):
+        return image.read()
+    with io.open(image, 'rb') as image_file:
+        return image_file.read()
+
+def merge_punctuation(words):
+    # words: (text, vertices) of one paragraph in reading order. A punctuation mark directly after a
+    # word is appended to that word and its vertices to the word's, so the word's own corners stay
+    # at vertices[0] and vertices[2].
+    bounding_boxes = []
+    current_word = ""
+    current_vertices = []
+    for word_text, vertices in words:
+        if current_word and word_text in ".,;!?":
+            bounding_boxes.append((current_word + word_text, current_vertices + vertices))
+            current_word = ""
+            current_vertices = []
+        else:
+            if current_word:
+                bounding_boxes.append((current_word, current_vertices))
+            current_word = word_text
+            current_vertices = vertices
+    if current_word:
+        bounding_boxes.append((current_word, current_vertices))
+    return bounding_boxes
+
+class OCREngine:
+    # Base class: subclasses implement recognize() and may override recognize_batch()
+    name = None
+    max_concurrent_requests = 1
+    max_batch_size = 1
+    # Word boxes are the words' own outlines in image pixels. Version 1 OCR cache entries stored
+    # them shifted by this many rendered-page pixels; the shift is taken out when they are reused.
+    legacy_vertex_offset = (0, 0)
+
+    @property
+    def cache_feature(self):
+        # Part of the OCR cache key, so results of different engines are never mixed up
+        return self.name
+
+    def recognize(self, image):
+        raise NotImplementedError
+
+    def recognize_batch(self, images):
+        # One word-box list per image, in the order given
+        return [self.recognize(image) for image in images]
+
+class VisionEngine(OCREngine):
+    name = "vision"
+    # Requests in flight are bounded by the project quota rather than by this machine
+    max_concurrent_requests = 16
+    # batch_annotate_images accepts at most 16 images per call
+    max_batch_size = 16
+    cache_feature = "DOCUMENT_TEXT_DETECTION"
+    legacy_vertex_offset = (10, 35)
+
+    def __init__(self, client=None):
+        self._client = client
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        # Creating a client sets up a new gRPC channel, so it is done once per engine, not per page
+        with self._client_lock:
+            if self._client is None:
+                metrics.debug("Creating Google Vision client.")
+                self._client = vision.ImageAnnotatorClient()
+            return self._client
+
+    @client.setter
+    def client(self, client):
+        # E.g. a local fake annotator with document_text_detection(image=...) and batch_annotate_images(requests=...)
+        with self._client_lock:
+            self._client = client
+
+    @staticmethod
+    def check_response(response):
+        # Vision reports per-image failures inside the response instead of raising
+        error = getattr(response, "error", None)
+        if error is not None and error.message:
+            metrics.incr("vision_errors")
+            raise VisionAPIError(f"Google Vision error {error.code}: {error.message}")
+
+    def extract_bounding_boxes(self, full_text_annotation):
+        # Turn a Vision full_text_annotation into word boxes, one paragraph at a time
+        bounding_boxes = []
+        for page in full_text_annotation.pages:
+            for block in page.blocks:
+                for paragraph in block.paragraphs:
+                    words = []
+                    for word in paragraph.words:
+                        word_text = ''.join([symbol.text for symbol in word.symbols])
+                        vertices = [(int(vertex.x), int(vertex.y)) for vertex in word.bounding_box.vertices]
+                        words.append((word_text, vertices))
+                    bounding_boxes.extend(merge_punctuation(words))
+        return bounding_boxes
+
+    def recognize(self, image):
+        content = read_image_content(image)
+        metrics.incr("vision_requests")
+        metrics.incr("vision_images")
+        metrics.incr("bytes_uploaded", len(content))
+        with metrics.span("vision_request"):
+            response = self.client.document_text_detection(image=vision.Image(content=content))
+        self.check_response(response)
+        with metrics.span("parse"):
+            return self.extract_bounding_boxes(response.full_text_annotation)
+
+    def recognize_batch(self, images):
+        # A single image goes out as a plain request; more go out in batch_annotate_images calls
+        # of up to max_batch_size images each
+        if len(images) == 1:
+            return [self.recognize(images[0])]
+        feature = vision.Feature(type_=vision.Feature.Type.DOCUMENT_TEXT_DETECTION)
+        results = []
+        for start in range(0, len(images), self.max_batch_size):
+            batch = images[start:start + self.max_batch_size]
+            requests = [
+                vision.AnnotateImageRequest(image=vision.Image(content=read_image_content(image)), features=[feature])
+                for image in batch
+            ]
+            metrics.debug(f"Sending batch of {len(requests)} images to Google Vision.")
+            metrics.incr("vision_requests")
+            metrics.incr("vision_images", len(requests))
+            metrics.incr("bytes_uploaded", sum(len(request.image.content) for request in requests))
+            with metrics.span("vision_batch_request"):
+                batch_response = self.client.batch_annotate_images(requests=requests)
+
+            # Responses come back in request order
+            if len(batch_response.responses) != len(requests):
+                raise VisionAPIError(f"Expected {len(requests)} responses from Google Vision, got {len(batch_response.responses)}")
+            for response in batch_response.responses:
+                self.check_response(response)
+                with metrics.span("parse"):
+                    results.append(self.extract_bounding_boxes(response.full_text_annotation))
+        return results
+
+class TesseractEngine(OCREngine):
+    name = "tesseract"
+    # Each call runs its own tesseract process, so one per CPU keeps the machine busy
+    max_concurrent_requests = os.cpu_count() or 1
+    max_batch_size = 1
+    # Words Tesseract is less confident about than this (0-100) are dropped
+    min_confidence = 0
+
+    def __init__(self, language=None, config=None):
+        self.language = language or TESSERACT_LANGUAGE
+        self.config = TESSERACT_CONFIG if config is None else config
+
+    @property
+    def cache_feature(self):
+        return f"tesseract|{self.language}|{self.config}"
+
+    def recognize(self, image):
+        content = read_image_content(image)
+        metrics.incr("tesseract_images")
+        with metrics.span("tesseract_request"):
+            data = pytesseract.image_to_data(PIL_Image.open(io.BytesIO(content)), lang=self.language,
+                                             config=self.config, output_type=pytesseract.Output.DICT)
+        with metrics.span("parse"):
+            return self.extract_bounding_boxes(data)
+
+    def extract_bounding_boxes(self, data):
+        # image_to_data returns one row per layout element; words are level 5 and carry their
+        # block and paragraph numbers, which group them the way Vision groups paragraphs
+        paragraphs = {}
+        for index, word_text in enumerate(data["text"]):
+            word_text = word_text.strip()
+            if data["level"][index] != 5 or not word_text or float(data["conf"][index]) < self.min_confidence:
+                continue
+            left, top = data["left"][index], data["top"][index]
+            right, bottom = left + data["width"][index], top + data["height"][index]
+            key = (data["page_num"][index], data["block_num"][index], data["par_num"][index])
+            paragraphs.setdefault(key, []).append((word_text, [(left, top), (right, top), (right, bottom), (left, bottom)]))
+        bounding_boxes = []
+        for words in paragraphs.values():
+            bounding_boxes.extend(merge_punctuation(words))
+        return bounding_boxes
+
+OCR_ENGINES = {
+    VisionEngine.name: VisionEngine,
+    TesseractEngine.name: TesseractEngine,
+}
+
+# One engine instance per name and process, shared by all documents and threads
+_engines = {}
+_engines_lock = threading.Lock()
+
+def get_ocr_engine(name):
+    with _engines_lock:
+        if name not in _engines:
+            if name not in OCR_ENGINES:
+                raise UnknownOCREngineError(f"Unknown OCR engine {name!r}; choose one of {', '.join(OCR_ENGINES)}")
+            _engines[name] = OCR_ENGINES[name]()
+        return _engines[name]
+
+def set_vision_client(client):
+    # Replace the Vision client of this process's Vision engine, e.g. with a local fake for testing
+    get_ocr_engine(VisionEngine.name).client = client
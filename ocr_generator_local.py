@@ -1,47 +1,143 @@
-import importlib
-import subprocess
-
-# List of packages that need to be checked/installed
-packages = [
-    ("openai", "openai"),
-    ("fitz", "pymupdf"),
-    ("google.cloud.vision", "google-cloud-vision"),
-    ("PIL", "pillow"),
-    ("tqdm", "tqdm")
-]
-
-def check_and_install(package_name, install_name):
-    # Check if the package is installed, if not, install it
-    try:
-        importlib.import_module(package_name)
-        print(f"{package_name} is already installed.")
-    except ImportError:
-        print(f"{package_name} is not installed. Installing...")
-        subprocess.check_call(["pip", "install", install_name])
-        print(f"{package_name} has been installed.")
-
-# Iterate through the list of packages and ensure they are installed
-for package_name, install_name in packages:
-    check_and_install(package_name, install_name)
-
 import os
-import io
-import re
+import json
+import sys
+import glob
+import argparse
+import fnmatch
+import difflib
+import math
 import time
-import openai
-import fitz # PyMuPDF
-from google.cloud import vision
-from PIL import Image
+import itertools
+import multiprocessing
+from collections import deque, namedtuple
+from functools import partial
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from tqdm import tqdm  # For progress bars
-import os
+from ocr_cache import CACHE_FORMAT_VERSION, OCRCache
+from job_manifest import JobManifest
+from lazy_imports import LazyModule
+from ocr_engines import OCR_ENGINES, get_ocr_engine, set_vision_client
+from ocr_preprocess import PagePreprocessor
+from page_screen import PageScreener
+from word_index import WordIndex
+import metrics
+
+# Imported on first use, so importing this module (e.g. in a worker process or for --help) is fast
+np = LazyModule("numpy")
+fitz = LazyModule("fitz", "pymupdf")  # PyMuPDF
+
+# OCR engine for the page images: "vision" (Google Cloud Vision) or "tesseract" (local, free).
+# Documents whose path or file name matches an OCR_ENGINE_ROUTES pattern go to that route's engine
+# instead, e.g. [("*/bulk scans/*", "tesseract")] sends low-value bulk material to Tesseract.
+OCR_ENGINE = "vision"
+OCR_ENGINE_ROUTES = []
+
+# Maximum number of OCR requests in flight per PDF (1 processes pages sequentially), capped by the
+# engine's own limit
+MAX_CONCURRENT_REQUESTS = 4
+
+# Encoding of the page image sent to Google Vision: "png", "jpeg" or "gray" (grayscale JPEG).
+# The quality setting only applies to the JPEG encodings.
+OCR_IMAGE_FORMAT = "png"
+OCR_IMAGE_QUALITY = 85
+
+# Optional clean-up of the page image before OCR to shrink uploads (see ocr_preprocess.py):
+# grayscale ("gray") or 1-bit Otsu binarisation ("binary"), deskew, border cropping and
+# downscaling to at most PREPROCESS_MAX_PIXELS. Word boxes are mapped back to the rendered page.
+PREPROCESS_PAGES = False
+PREPROCESS_MODE = "gray"
+PREPROCESS_DESKEW = True
+PREPROCESS_CROP_BORDERS = True
+PREPROCESS_MAX_PIXELS = 12_000_000
+# Every PREPROCESS_SAMPLE_EVERY-th preprocessed page is also encoded unprocessed, to report how much
+# smaller the uploads got. That extra full-size encode costs about as much as the OCR encode itself,
+# so it is off (0) unless asked for.
+PREPROCESS_SAMPLE_EVERY = 0
+
+# Pre-screen every page on a low-resolution render (see page_screen.py): near-blank pages are copied
+# through without OCR. SCREEN_BLANK_INK is the ink coverage below which a page counts as blank.
+# With SCREEN_DUPLICATES, pages that match an earlier page of the run everywhere (repeated cover
+# sheets, rescans) also reuse its word boxes. SCREEN_MAX_TILE_DIFFERENCE is the number of unmatched
+# ink pixels (at 100 dpi) any 32-pixel tile of a duplicate may have; a changed word is well above it,
+# but a single changed character may not be, so duplicate screening is off by default.
+SCREEN_PAGES = True
+SCREEN_DUPLICATES = False
+SCREEN_DPI = 100
+SCREEN_BLANK_INK = 0.0005
+SCREEN_MAX_TILE_DIFFERENCE = 14
+
+# Number of pages sent in one OCR request, capped by the engine (Vision accepts at most 16 per
+# batch_annotate_images call; Tesseract takes one page at a time)
+OCR_BATCH_SIZE = 1
+
+# Copy pages that already have a clean text layer through untouched instead of OCRing them, and
+# render scanned pages at the resolution of their embedded image (capped at the dpi setting)
+SKIP_BORN_DIGITAL_PAGES = True
+ADAPTIVE_DPI = True
+
+# How OCR'd pages are drawn in the output PDF:
+#   "original"   - the original page content with the invisible text layer on top (no raster); an
+#                  old invisible text layer is removed first, and pages with visible text are
+#                  embedded as in "compressed", so no word appears twice
+#   "compressed" - the rendered page embedded as a JPEG at EMBED_DPI / EMBED_QUALITY
+#   "raster"     - the rendered page embedded losslessly at the OCR resolution
+OVERLAY_MODE = "original"
+EMBED_DPI = 200
+EMBED_QUALITY = 75
+
+# Size limit of the persistent OCR result cache kept in the output folder (None disables it)
+OCR_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Record document and page progress in a job manifest in the output folder, so an interrupted
+# run resumes where it stopped and finished PDFs are skipped
+USE_JOB_MANIFEST = True
+
+# Write each document's recognised text to "<output folder>/text/<name>.txt" as soon as the
+# document is finished, for metadata_generator.py and the streaming pipeline
+WRITE_OCR_TEXT = True
+
+# Add every document's words, with page numbers and rectangles, to a full-text index in the output
+# folder as soon as it is finished, so "python cli.py search" finds phrases across all output PDFs
+USE_WORD_INDEX = True
+WORD_INDEX_FILE = "ocr_word_index.sqlite3"
+
+# Per-stage timings and API/byte counters, written to METRICS_FILE in the output folder at the end
+# of a run (".json", or ".prom" for Prometheus text format). RECORD_PAGE_METRICS also keeps the
+# timings of every page. "Debug:" messages are only printed with --debug.
+METRICS_ENABLED = True
+METRICS_FILE = "ocr_metrics.json"
+RECORD_PAGE_METRICS = False
+
+# Write the output PDF to disk every OUTPUT_CHUNK_PAGES pages (incremental saves) so memory stays
+# flat however long the document is; 0 keeps the whole output in memory until one final save
+OUTPUT_CHUNK_PAGES = 100
 
 # Custom exception for invalid file types
 class InvalidFileTypeError(Exception):
     pass
+
+# Custom exception for input PDFs that would be written to the same output files
+class DuplicateOutputNameError(Exception):
+    pass
+
+# The invisible text layer is set in Helvetica, one of the base-14 fonts every PDF reader has, so no
+# font is embedded. Its ascender and descender, in units of the font size:
+TEXT_LAYER_ASCENDER = 1.075
+TEXT_LAYER_DESCENDER = -0.299
+
+# Stands in for a pixmap whose pixels are no longer needed, only its size (for box scaling)
+RenderedSize = namedtuple("RenderedSize", "width height")
+
+# OCR cache, job manifest, engine override, page screener and word index of a batch-mode worker process
+_worker_cache = None
+_worker_manifest = None
+_worker_engine = None
+_worker_screener = None
+_worker_word_index = None
     
 def setup_environment():
     # Set up environment variables
-    print("Debug: Setting up environment variables.")
+    metrics.debug("Setting up environment variables.")
     json_key_path = r"C:\Second Brain\Resources\OCR Testing\genuine-eon-439419-v8-0e94968a952b.json"  # Update path for local environment
     os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = json_key_path
 
@@ -50,12 +146,12 @@ def setup_environment():
     ocr_output_folder_path = r"C:\Second Brain\Resources\OCR Testing\Output OCR"
     os.makedirs(ocr_output_folder_path, exist_ok=True)
 
-    print(f"Debug: PDF folder path: {pdf_folder_path}, OCR output folder path: {ocr_output_folder_path}")
+    metrics.debug(f"PDF folder path: {pdf_folder_path}, OCR output folder path: {ocr_output_folder_path}")
     return pdf_folder_path, ocr_output_folder_path
 
 def list_pdfs(pdf_folder):
     # List all PDF files in the specified folder
-    print(f"Debug: Listing PDFs in folder: {pdf_folder}")
+    metrics.debug(f"Listing PDFs in folder: {pdf_folder}")
     pdf_files = [f for f in os.listdir(pdf_folder) if f.endswith('.pdf')]
     for idx, pdf_file in enumerate(pdf_files):
         print(f"{idx + 1}: {pdf_file}")
@@ -64,26 +160,27 @@ def list_pdfs(pdf_folder):
     while True:
         user_input = input("Enter the file number(s) to process (e.g., '1', '1-3', 'all'): ").strip().lower()
         if user_input == 'all':
-            print("Debug: User selected all PDFs.")
+            metrics.debug("User selected all PDFs.")
             return pdf_files
         elif '-' in user_input:
             try:
                 start, end = map(int, user_input.split('-'))
-                print(f"Debug: User selected range from {start} to {end}.")
+                metrics.debug(f"User selected range from {start} to {end}.")
                 return pdf_files[start - 1:end]
             except ValueError:
                 print("Invalid range. Please try again.")
         else:
             try:
                 indices = list(map(int, user_input.split(',')))
-                print(f"Debug: User selected individual files: {indices}")
+                metrics.debug(f"User selected individual files: {indices}")
                 return [pdf_files[i - 1] for i in indices]
             except (ValueError, IndexError):
                 print("Invalid input. Please try again.")
 
-def main(debug=False):
+def main(debug=False, ocr_engine=None):
     # Main function to orchestrate the OCR process
-    print("Debug: Starting main function.")
+    metrics.configure(enabled=METRICS_ENABLED, debug=debug, record_pages=RECORD_PAGE_METRICS)
+    metrics.debug("Starting main function.")
     pdf_folder, ocr_output_folder = setup_environment()
     selected_pdfs = list_pdfs(pdf_folder)
 
@@ -91,117 +188,934 @@ def main(debug=False):
         print("No PDFs selected for processing.")
         return
 
+    # Reuse OCR results from earlier runs so only new or changed pages are sent to Google Vision
+    cache = open_ocr_cache(ocr_output_folder)
+    manifest = open_job_manifest(ocr_output_folder)
+    # One screener for the whole run, so duplicates are found across documents
+    screener = create_page_screener()
+    word_index = open_word_index(ocr_output_folder)
+
     # Process each selected PDF
     for pdf_file in tqdm(selected_pdfs, desc="Processing PDFs"):
         print(f"Processing {pdf_file}...")
-        create_hybrid_ocr_pdf(os.path.join(pdf_folder, pdf_file), ocr_output_folder)
+        process_pdf(os.path.join(pdf_folder, pdf_file), ocr_output_folder, cache, manifest, ocr_engine, screener,
+                    word_index)
+
+    if cache:
+        cache.report()
+    if manifest:
+        print(f"Job manifest: {manifest.summary()}")
+        manifest.close()
+    if word_index:
+        print(f"Word index: {word_index.summary()}")
+        word_index.close()
+    report_preprocessing()
+    report_screening()
+    metrics.export(os.path.join(ocr_output_folder, METRICS_FILE))
+
+def open_ocr_cache(ocr_output_folder):
+    # The OCR cache lives in the output folder; returns None when caching is disabled
+    if not OCR_CACHE_MAX_BYTES:
+        return None
+    return OCRCache(os.path.join(ocr_output_folder, ".ocr_cache"), max_bytes=OCR_CACHE_MAX_BYTES)
+
+def open_job_manifest(ocr_output_folder):
+    # The job manifest lives in the output folder; returns None when it is disabled
+    if not USE_JOB_MANIFEST:
+        return None
+    return JobManifest(os.path.join(ocr_output_folder, "ocr_manifest.sqlite3"))
+
+def open_word_index(ocr_output_folder):
+    # The word index lives in the output folder; returns None when it is disabled
+    if not USE_WORD_INDEX:
+        return None
+    return WordIndex(os.path.join(ocr_output_folder, WORD_INDEX_FILE))
+
+def create_page_screener():
+    # The page screener of a run; returns None when screening is disabled
+    if not SCREEN_PAGES:
+        return None
+    return PageScreener(dpi=SCREEN_DPI, blank_ink=SCREEN_BLANK_INK, detect_duplicates=SCREEN_DUPLICATES,
+                        max_tile_difference=SCREEN_MAX_TILE_DIFFERENCE)
+
+def ocr_text_path(pdf_path, text_output_folder):
+    # Where the recognised text of a PDF is written
+    return os.path.join(text_output_folder, f"{os.path.splitext(os.path.basename(pdf_path))[0]}.txt")
+
+def select_ocr_engine(pdf_path, ocr_engine=None):
+    # An explicit engine wins, then the first matching OCR_ENGINE_ROUTES pattern, then OCR_ENGINE
+    if ocr_engine:
+        return ocr_engine
+    pdf_path = os.path.abspath(pdf_path)
+    for pattern, route_engine in OCR_ENGINE_ROUTES:
+        if fnmatch.fnmatch(pdf_path, pattern) or fnmatch.fnmatch(os.path.basename(pdf_path), pattern):
+            return route_engine
+    return OCR_ENGINE
+
+def process_pdf(pdf_path, ocr_output_folder, cache=None, manifest=None, ocr_engine=None, screener=None,
+                word_index=None):
+    # Create the hybrid OCR PDF for one file with the settings configured at the top of this script.
+    # Returns the path of the recognised text file, or None if text output is disabled.
+    text_output_folder = os.path.join(ocr_output_folder, "text") if WRITE_OCR_TEXT else None
+    preprocessor = PagePreprocessor(mode=PREPROCESS_MODE, deskew=PREPROCESS_DESKEW, crop_borders=PREPROCESS_CROP_BORDERS,
+                                    max_pixels=PREPROCESS_MAX_PIXELS) if PREPROCESS_PAGES else None
+    create_hybrid_ocr_pdf(pdf_path, ocr_output_folder, ocr_engine=select_ocr_engine(pdf_path, ocr_engine),
+                          max_concurrent_requests=MAX_CONCURRENT_REQUESTS,
+                          image_format=OCR_IMAGE_FORMAT, image_quality=OCR_IMAGE_QUALITY,
+                          batch_size=OCR_BATCH_SIZE, cache=cache, manifest=manifest,
+                          skip_born_digital=SKIP_BORN_DIGITAL_PAGES, adaptive_dpi=ADAPTIVE_DPI,
+                          overlay_mode=OVERLAY_MODE, embed_dpi=EMBED_DPI, embed_quality=EMBED_QUALITY,
+                          text_output_folder=text_output_folder, preprocessor=preprocessor,
+                          output_chunk_pages=OUTPUT_CHUNK_PAGES, screener=screener, word_index=word_index)
+    return ocr_text_path(pdf_path, text_output_folder) if text_output_folder else None
+
+def collect_pdfs(inputs):
+    # Expand files, folders and glob patterns into a list of PDF paths, largest first so one long
+    # document started last doesn't leave the other workers idle at the end of the run
+    pdf_paths = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, f) for f in os.listdir(pattern)]
+        else:
+            matches = glob.glob(pattern, recursive=True)
+        pdf_paths.update(os.path.abspath(path) for path in matches
+                         if path.lower().endswith(".pdf") and os.path.isfile(path))
+    return sorted(pdf_paths, key=lambda path: (-os.path.getsize(path), path))
+
+def check_output_names(pdf_paths):
+    # Outputs are named after the file name alone (ocr_<name>.pdf, text/<name>.txt), so PDFs of the
+    # same name from different folders would overwrite each other's output, and both would then be
+    # marked done. Names are compared case-insensitively for case-insensitive file systems. Only runs
+    # that write those outputs need the check.
+    by_name = {}
+    for pdf_path in pdf_paths:
+        by_name.setdefault(os.path.splitext(os.path.basename(pdf_path))[0].lower(), []).append(pdf_path)
+    duplicates = [sorted(paths) for paths in by_name.values() if len(paths) > 1]
+    if duplicates:
+        listing = "\n".join("  " + ", ".join(paths) for paths in sorted(duplicates))
+        raise DuplicateOutputNameError(f"These PDFs would be written to the same output files; rename them or "
+                                       f"process them into separate output folders:\n{listing}")
+
+def init_batch_worker(ocr_output_folder, debug=False, ocr_engine=None):
+    # Each worker process opens its own fitz documents per file and its own Vision client;
+    # a client inherited from a forked parent would share its gRPC channel, so drop it
+    global _worker_cache, _worker_manifest, _worker_engine, _worker_screener, _worker_word_index
+    metrics.configure(enabled=METRICS_ENABLED, debug=debug, record_pages=RECORD_PAGE_METRICS)
+    set_vision_client(None)
+    _worker_cache = open_ocr_cache(ocr_output_folder)
+    _worker_manifest = open_job_manifest(ocr_output_folder)
+    _worker_engine = ocr_engine
+    _worker_screener = create_page_screener()
+    _worker_word_index = open_word_index(ocr_output_folder)
+
+def process_pdf_in_worker(pdf_path, ocr_output_folder):
+    # Returns a result record instead of raising so one bad PDF doesn't stop the batch
+    hits_before = _worker_cache.hits if _worker_cache else 0
+    misses_before = _worker_cache.misses if _worker_cache else 0
+    # Each result carries the metrics of its own document for the parent to merge
+    metrics.reset()
+    start_time = time.perf_counter()
+    error = None
+    text_path = None
+    pages = 0
+    try:
+        with fitz.open(pdf_path) as pdf_document:
+            pages = pdf_document.page_count
+        text_path = process_pdf(pdf_path, ocr_output_folder, _worker_cache, _worker_manifest, _worker_engine,
+                                _worker_screener, _worker_word_index)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return {
+        "pdf": pdf_path,
+        "pages": pages,
+        "text_path": text_path,
+        "seconds": time.perf_counter() - start_time,
+        "cache_hits": (_worker_cache.hits - hits_before) if _worker_cache else 0,
+        "cache_misses": (_worker_cache.misses - misses_before) if _worker_cache else 0,
+        "error": error,
+        "metrics": metrics.snapshot(),
+    }
+
+def run_batch(inputs, ocr_output_folder, workers, debug=False, ocr_engine=None):
+    # Non-interactive mode: spread the PDFs across a pool of worker processes
+    pdf_paths = collect_pdfs(inputs)
+    if not pdf_paths:
+        print("No PDFs found for processing.")
+        return []
+    check_output_names(pdf_paths)
+    os.makedirs(ocr_output_folder, exist_ok=True)
+    metrics.configure(enabled=METRICS_ENABLED, debug=debug, record_pages=RECORD_PAGE_METRICS)
+    workers = max(1, min(workers, len(pdf_paths)))
+    metrics.debug(f"Processing {len(pdf_paths)} PDFs with {workers} worker processes.")
+
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker,
+                             initargs=(ocr_output_folder, debug, ocr_engine)) as executor:
+        # The pool hands out work in submission order, so the largest PDFs start first
+        futures = [executor.submit(process_pdf_in_worker, pdf_path, ocr_output_folder) for pdf_path in pdf_paths]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Processing PDFs"):
+            result = future.result()
+            if result["error"]:
+                print(f"Error processing {result['pdf']}: {result['error']}")
+            metrics.merge(result.pop("metrics"))
+            results.append(result)
+
+    failed = [result for result in results if result["error"]]
+    hits = sum(result["cache_hits"] for result in results)
+    misses = sum(result["cache_misses"] for result in results)
+    print(f"Processed {len(results) - len(failed)} of {len(results)} PDFs ({len(failed)} failed). "
+          f"OCR cache: {hits} hits, {misses} misses.")
+    if USE_JOB_MANIFEST:
+        manifest = open_job_manifest(ocr_output_folder)
+        print(f"Job manifest: {manifest.summary()}")
+        manifest.close()
+    if USE_WORD_INDEX:
+        word_index = open_word_index(ocr_output_folder)
+        print(f"Word index: {word_index.summary()}")
+        word_index.close()
+    report_preprocessing()
+    report_screening()
+    metrics.export(os.path.join(ocr_output_folder, METRICS_FILE))
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Create hybrid OCR PDFs with Google Vision or Tesseract.")
+    parser.add_argument("inputs", nargs="*",
+                        help="PDF files, folders or glob patterns to process without prompting; "
+                             "omit to pick files interactively")
+    parser.add_argument("-o", "--output", help="output folder (defaults to the configured OCR output folder)")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("-e", "--engine", choices=sorted(OCR_ENGINES),
+                        help="OCR engine for every document (default: OCR_ENGINE and OCR_ENGINE_ROUTES)")
+    parser.add_argument("--compare-engines", nargs="+", metavar="ENGINE", choices=sorted(OCR_ENGINES),
+                        help="instead of creating PDFs, OCR the inputs' pages with each engine and compare "
+                             "speed and agreement with the first one")
+    parser.add_argument("--compare-overlay-modes", action="store_true",
+                        help="instead of a batch run, build each input PDF with every overlay mode and compare "
+                             "output size and peak RSS (OCR results are cached, so each page is OCR'd once)")
+    parser.add_argument("--debug", action="store_true", help="print debug messages")
+    return parser.parse_args(argv)
         
-# Fetch OCR Bounding Boxes from Google Vision API
-def get_ocr_bounding_boxes(image_path):
-    client = vision.ImageAnnotatorClient()
-    with io.open(image_path, 'rb') as image_file:
-        content = image_file.read()
-    image = vision.Image(content=content)
-    response = client.document_text_detection(image=image)
-
-    bounding_boxes = []
-    print("Bounding box extraction starts")
-
-    # Scaling factors can help adjust bounding box positions to better align with the image
-    for page in response.full_text_annotation.pages:
-        for block in page.blocks:
-            for paragraph in block.paragraphs:
-                current_word = ""
-                current_vertices = []
-
-                for word in paragraph.words:
-                    # Extract the word symbols
-                    word_text = ''.join([symbol.text for symbol in word.symbols])
-
-                    # Get word bounding box vertices
-                    word_vertices = [(vertex.x, vertex.y) for vertex in word.bounding_box.vertices]
-
-                    # Apply scaling factors to vertices to help with alignment
-                    scaled_vertices = [(int(vertex[0] + 10), int(vertex[1] + 35)) for vertex in word_vertices]
-
-                    # Check if the current word should be concatenated with punctuation
-                    if current_word and word_text in ".,;!?":
-                        current_word += word_text
-                        current_vertices.extend(scaled_vertices)
-                        bounding_boxes.append((current_word, current_vertices))
-                        current_word = ""
-                        current_vertices = []
-                    else:
-                        if current_word:
-                            bounding_boxes.append((current_word, current_vertices))
-                        current_word = word_text
-                        current_vertices = scaled_vertices
-
-                # Append any remaining word
-                if current_word:
-                    bounding_boxes.append((current_word, current_vertices))
-
-    print("Bounding box extraction ends")
-    return bounding_boxes
-
-def create_hybrid_ocr_pdf(pdf_path, output_folder, dpi=600):
-    # Create a hybrid OCR PDF by adding text overlay to the images
-    print(f"Debug: Creating hybrid OCR PDF for: {pdf_path}")
-    pdf_document = fitz.open(pdf_path)
-    ocr_pdf_filename = os.path.join(output_folder, f"ocr_{os.path.basename(pdf_path)}")
-    new_pdf = fitz.open()
+def encode_pixmap(pixmap, image_format="png", quality=85):
+    # JPEG and grayscale trade a little fidelity for much smaller, faster-to-encode payloads
+    if image_format == "png":
+        return pixmap.tobytes("png")
+    if image_format == "jpeg":
+        return pixmap.tobytes("jpeg", jpg_quality=quality)
+    if image_format == "gray":
+        gray_pixmap = fitz.Pixmap(fitz.csGRAY, pixmap)
+        return gray_pixmap.tobytes("jpeg", jpg_quality=quality)
+    raise InvalidFileTypeError(f"Unsupported OCR image format: {image_format}")
+
+def encode_page_image(pixmap, image_format="png", quality=85):
+    # Encode a rendered page in memory for upload to the OCR engine
+    with metrics.span("encode"):
+        image_bytes = encode_pixmap(pixmap, image_format, quality)
+    metrics.incr("encoded_image_bytes", len(image_bytes))
+    return image_bytes
+
+# Preprocessed pages of this process, for PREPROCESS_SAMPLE_EVERY
+_preprocessed_pages = itertools.count(1)
+
+def prepare_page_image(pixmap, image_format="png", quality=85, preprocessor=None):
+    # Return (image bytes for the OCR engine, PageTransform or None). Without a preprocessor the
+    # page goes out as rendered and its word boxes need no mapping.
+    if preprocessor is None:
+        return encode_page_image(pixmap, image_format, quality), None
+    with metrics.span("preprocess"):
+        gray_pixmap = pixmap if pixmap.n == 1 else fitz.Pixmap(fitz.csGRAY, pixmap)
+        gray = np.frombuffer(gray_pixmap.samples_mv, dtype=np.uint8).reshape(gray_pixmap.height, gray_pixmap.width)
+        image_bytes, transform = preprocessor.process(gray, image_format, quality)
+    metrics.incr("preprocessed_pages")
+    metrics.incr("upload_bytes_after", len(image_bytes))
+    # What a sample of the pages would have cost unprocessed
+    if PREPROCESS_SAMPLE_EVERY > 0 and metrics.is_enabled() and next(_preprocessed_pages) % PREPROCESS_SAMPLE_EVERY == 0:
+        bytes_before = len(encode_pixmap(pixmap, image_format, quality))
+        metrics.incr("upload_sampled_pages")
+        metrics.incr("upload_sampled_bytes_before", bytes_before)
+        metrics.incr("upload_sampled_bytes_after", len(image_bytes))
+        metrics.debug(f"Preprocessed page: {bytes_before / 1024:.0f} KB -> {len(image_bytes) / 1024:.0f} KB")
+    return image_bytes, transform
+
+def report_preprocessing():
+    # Upload size per page, and with PREPROCESS_SAMPLE_EVERY the size before and after on the sampled
+    # pages, from this run's metrics
+    counters = metrics.summary()["counters"]
+    pages = counters.get("preprocessed_pages", 0)
+    if not pages:
+        return
+    report = f"Preprocessing: {pages} pages, upload {counters.get('upload_bytes_after', 0) / pages / 1024:.0f} KB/page"
+    sampled = counters.get("upload_sampled_pages", 0)
+    if sampled:
+        before = counters["upload_sampled_bytes_before"] / sampled
+        after = counters["upload_sampled_bytes_after"] / sampled
+        report += (f"; {sampled} sampled pages {before / 1024:.0f} KB/page before, {after / 1024:.0f} KB/page after "
+                   f"({(1 - after / before) * 100 if before else 0:.0f}% smaller)")
+    print(report)
+
+def report_screening():
+    # OCR calls the page pre-screen saved, from this run's metrics
+    counters = metrics.summary()["counters"]
+    screened = counters.get("screened_pages", 0)
+    if not screened:
+        return
+    blank = counters.get("blank_pages", 0)
+    duplicates = counters.get("duplicate_pages", 0)
+    print(f"Page pre-screen: {screened} pages screened, {blank} blank, {duplicates} duplicates; "
+          f"{blank + duplicates} OCR calls and {counters.get('screen_renders_skipped', 0)} full renders saved")
+
+def embed_page_image(new_page, page, pixmap, embed_dpi, embed_quality):
+    # Embed the rendered page as a JPEG, downsampled to embed_dpi if it was rendered finer
+    render_dpi = pixmap.width / (page.rect.width / 72)
+    if embed_dpi and render_dpi > embed_dpi:
+        scale = embed_dpi / render_dpi
+        width, height = max(1, round(pixmap.width * scale)), max(1, round(pixmap.height * scale))
+        pixmap = fitz.Pixmap(pixmap, width, height, None)
+    new_page.insert_image(page.rect, stream=pixmap.tobytes("jpeg", jpg_quality=embed_quality))
+
+def show_original_page(new_page, page, pixmap, embed_dpi, embed_quality):
+    # Reuse the original page content (vector or its own embedded scan) instead of a raster. The
+    # page's own text would end up next to the OCR layer, every word twice in search and copy:
+    # an invisible text layer (an earlier OCR run) is stripped from a copy of the page, keeping its
+    # images and graphics, and a page with visible text is embedded as an image as in "compressed"
+    # mode, since its text can't be removed without changing how it looks.
+    spans = page.get_texttrace()
+    if not spans:
+        new_page.show_pdf_page(new_page.rect, page.parent, page.number)
+        return
+    # Text render mode 3 is invisible
+    if any(span["type"] != 3 for span in spans):
+        metrics.incr("original_pages_embedded")
+        if not isinstance(pixmap, fitz.Pixmap):
+            # Only the rendered size was kept; render the page again at the embedding resolution
+            render_dpi = pixmap.width / (page.rect.width / 72)
+            pixmap = page.get_pixmap(dpi=round(min(render_dpi, embed_dpi or render_dpi)))
+        embed_page_image(new_page, page, pixmap, embed_dpi, embed_quality)
+        return
+    metrics.incr("original_pages_text_stripped")
+    with fitz.open() as page_copy:
+        page_copy.insert_pdf(page.parent, from_page=page.number, to_page=page.number)
+        copied_page = page_copy[0]
+        copied_page.add_redact_annot(copied_page.rect)
+        copied_page.apply_redactions(images=fitz.PDF_REDACT_IMAGE_NONE, graphics=fitz.PDF_REDACT_LINE_ART_NONE,
+                                     text=fitz.PDF_REDACT_TEXT_REMOVE_INVISIBLE)
+        new_page.show_pdf_page(new_page.rect, page_copy, 0)
+
+def write_text_layer(new_page, bounding_boxes, scale_x, scale_y):
+    # Write all OCR words of a page as invisible text in one batch.
+    # Box corners are scaled to PDF coordinates as one array operation, and a single Shape emits one
+    # content stream for the whole page instead of one fragment per word.
+    if not bounding_boxes:
+        return
+    corners = np.array([(*vertices[0], *vertices[2]) for _, vertices in bounding_boxes], dtype=float)
+    corners *= (scale_x, scale_y, scale_x, scale_y)
+    # Each word fills its box from the font's ascender to its descender, so the text layer lines up
+    # with the words at any render resolution and for every engine
+    font_sizes = (corners[:, 3] - corners[:, 1]) / (TEXT_LAYER_ASCENDER - TEXT_LAYER_DESCENDER)
+    baselines = corners[:, 3] + TEXT_LAYER_DESCENDER * font_sizes
+
+    shape = new_page.new_shape()
+    for (word_text, _), x0, baseline, font_size in zip(bounding_boxes, corners[:, 0].tolist(), baselines.tolist(),
+                                                       font_sizes.tolist()):
+        # Degenerate boxes can't carry text
+        if font_size <= 0:
+            continue
+        shape.insert_text((x0, baseline), word_text, fontname="helv", fontsize=font_size, color=(0, 0, 0),
+                          render_mode=3)
+    shape.commit()
+
+def page_content_size(new_pdf, new_page):
+    # Total size of a page's content streams in bytes
+    return sum(len(new_pdf.xref_stream(xref)) for xref in new_page.get_contents())
+
+def compose_ocr_page(new_pdf, page, pixmap, bounding_boxes, overlay_mode="raster", embed_dpi=None,
+                     embed_quality=75, stats=None):
+    # Add a page to the output PDF with the page image and the invisible OCR text layer.
+    # If a stats dict is given, composition time and text-layer content size are added to it.
+    start_time = time.perf_counter()
+    img_width, img_height = pixmap.width, pixmap.height
+    pdf_width, pdf_height = page.rect.width, page.rect.height
+    scale_x = pdf_width / img_width
+    scale_y = pdf_height / img_height
+
+    # Create a new page in the output PDF and draw the page content on it
+    new_page = new_pdf.new_page(width=pdf_width, height=pdf_height)
+    if overlay_mode == "original":
+        show_original_page(new_page, page, pixmap, embed_dpi, embed_quality)
+    elif overlay_mode == "compressed":
+        embed_page_image(new_page, page, pixmap, embed_dpi, embed_quality)
+    elif overlay_mode == "raster":
+        new_page.insert_image(page.rect, pixmap=pixmap)
+    else:
+        raise ValueError(f"Unknown overlay mode: {overlay_mode}")
+
+    # Insert extracted text at appropriate locations on the page
+    content_size_before = page_content_size(new_pdf, new_page) if stats is not None else 0
+    write_text_layer(new_page, bounding_boxes, scale_x, scale_y)
+
+    if stats is not None:
+        stats["pages"] += 1
+        stats["words"] += len(bounding_boxes)
+        stats["text_layer_bytes"] += page_content_size(new_pdf, new_page) - content_size_before
+        stats["seconds"] += time.perf_counter() - start_time
+
+def report_composition_stats(stats):
+    if not stats["pages"]:
+        return
+    metrics.incr("ocr_words", stats["words"])
+    metrics.incr("text_layer_bytes", stats["text_layer_bytes"])
+    metrics.debug(f"Composed {stats['pages']} OCR pages ({stats['words']} words) in {stats['seconds']:.2f} s "
+                  f"({stats['seconds'] / stats['pages'] * 1000:.1f} ms/page), "
+                  f"text layer {stats['text_layer_bytes'] / 1024:.1f} KB "
+                  f"({stats['text_layer_bytes'] / stats['pages'] / 1024:.1f} KB/page)")
+
+def lookup_cached_ocr(cache, pixmap, dpi, image_format, image_quality, feature="DOCUMENT_TEXT_DETECTION",
+                      legacy_vertex_offset=None):
+    # Return (cache key, cached bounding boxes or None); both are None when caching is off.
+    # With legacy_vertex_offset, an entry of cache format version 1 is reused too: the engine's old
+    # shift is taken out and the entry is stored again under the current key.
+    if cache is None:
+        return None, None
+    quality = image_quality if image_format != "png" else None
+    cache_key = cache.make_key(pixmap.samples_mv, dpi, feature=feature, image_format=image_format, image_quality=quality)
+    bounding_boxes = cache.get(cache_key)
+    if bounding_boxes is None and legacy_vertex_offset is not None:
+        legacy_boxes = cache.get(cache.make_key(pixmap.samples_mv, dpi, feature=feature, image_format=image_format,
+                                                image_quality=quality, version=1))
+        if legacy_boxes is not None:
+            offset_x, offset_y = legacy_vertex_offset
+            bounding_boxes = [(word_text, [(x - offset_x, y - offset_y) for x, y in vertices])
+                              for word_text, vertices in legacy_boxes]
+            cache.put(cache_key, bounding_boxes)
+            metrics.incr("ocr_cache_legacy_hits")
+    metrics.incr("ocr_cache_hits" if bounding_boxes is not None else "ocr_cache_misses")
+    return cache_key, bounding_boxes
+
+def classify_page(page, min_text_chars=50, image_coverage_threshold=0.5):
+    # Classify a page as "born-digital" (clean text layer, little imagery), "scanned" (no usable
+    # text layer) or "mixed" (usable text plus images covering a large part of the page)
+    text = page.get_text().strip()
+    usable_chars = sum(1 for char in text if char.isprintable() and char != "\ufffd")
+    has_text_layer = usable_chars >= min_text_chars and usable_chars >= 0.9 * len(text)
+
+    page_area = abs(page.rect) or 1
+    image_area = sum(abs(fitz.Rect(info["bbox"]) & page.rect) for info in page.get_image_info())
+    image_coverage = min(image_area / page_area, 1.0)
+
+    if not has_text_layer:
+        return "scanned"
+    if image_coverage < image_coverage_threshold:
+        return "born-digital"
+    return "mixed"
+
+def classify_pages(pdf_document):
+    # Pre-pass over the whole document so the page mix is known before any rendering starts
+    with metrics.span("classify"):
+        page_kinds = [classify_page(page) for page in pdf_document]
+    counts = {kind: page_kinds.count(kind) for kind in ("born-digital", "scanned", "mixed")}
+    for kind, count in counts.items():
+        metrics.incr(f"pages_{kind.replace('-', '_')}", count)
+    metrics.debug(f"Page classification: {counts}")
+    return page_kinds
+
+def adaptive_page_dpi(page, max_dpi, min_dpi=150, max_pixels=40_000_000):
+    # Choose the render DPI for a scanned page from the resolution of its largest embedded image,
+    # so a 300-dpi scan is not upsampled to 600 dpi, and from the page size, so oversized pages
+    # stay within a pixel budget
+    dpi = max_dpi
+    images = page.get_image_info()
+    if images:
+        largest = max(images, key=lambda info: abs(fitz.Rect(info["bbox"])))
+        bbox = fitz.Rect(largest["bbox"])
+        if bbox.width > 0 and bbox.height > 0:
+            image_dpi = max(largest["width"] / (bbox.width / 72), largest["height"] / (bbox.height / 72))
+            dpi = min(dpi, max(min_dpi, math.ceil(image_dpi)))
+
+    page_square_inches = (page.rect.width / 72) * (page.rect.height / 72)
+    if page_square_inches > 0:
+        dpi = min(dpi, int(math.sqrt(max_pixels / page_square_inches)))
+    return max(dpi, 1)
+
+def screen_page(screener, page):
+    # Pre-screen a page on a low-resolution grayscale render: "blank", "duplicate" or None
+    with metrics.span("screen", page=page.number):
+        pixmap = page.get_pixmap(dpi=screener.dpi, colorspace=fitz.csGRAY)
+        gray = np.frombuffer(pixmap.samples_mv, dtype=np.uint8).reshape(pixmap.height, pixmap.stride)[:, :pixmap.width]
+        verdict = screener.screen(gray, (page.parent.name, page.number))
+    metrics.incr("screened_pages")
+    if verdict:
+        metrics.incr(f"{verdict}_pages")
+        metrics.debug(f"Page {page.number} screened as {verdict}")
+    return verdict
+
+def rendered_size(page, dpi):
+    # Pixel size get_pixmap(dpi=dpi) would produce, without rendering
+    zoom = dpi / 72
+    rect = (page.rect * fitz.Matrix(zoom, zoom)).irect
+    return RenderedSize(rect.width, rect.height)
+
+def render_pages(pdf_document, pdf_path, dpi, skip_born_digital, adaptive_dpi, screener=None, render_duplicates=True):
+    # Yield (page, pixmap, render_dpi) for every page to output, in page order.
+    # Pages copied through untouched are yielded with a pixmap of None.
+    # With a screener, blank pages are copied through as well, and duplicates are only rendered if
+    # render_duplicates is set (otherwise they get a RenderedSize, as their pixels are never used).
+    page_kinds = classify_pages(pdf_document) if (skip_born_digital or adaptive_dpi) else None
 
     # Iterate through each page in the PDF
     for page_num in tqdm(range(len(pdf_document)), desc="Processing pages in PDF"):
-        print(f"Debug: Processing page number: {page_num}")
+        metrics.debug(f"Processing page number: {page_num}")
         page = pdf_document[page_num]
+        page_kind = page_kinds[page_num] if page_kinds else None
+        if skip_born_digital and page_kind == "born-digital":
+            yield page, None, None
+            continue
+
+        render_dpi = adaptive_page_dpi(page, dpi) if adaptive_dpi and page_kind == "scanned" else dpi
+        verdict = screen_page(screener, page) if screener is not None else None
+        if verdict == "blank":
+            metrics.incr("screen_renders_skipped")
+            yield page, None, None
+            continue
+        if verdict == "duplicate" and not render_duplicates:
+            metrics.incr("screen_renders_skipped")
+            yield page, rendered_size(page, render_dpi), render_dpi
+            continue
         try:
-            pixmap = page.get_pixmap(dpi=dpi)
+            with metrics.span("render", page=page_num):
+                pixmap = page.get_pixmap(dpi=render_dpi)
         except Exception as e:
             print(f"Error generating pixmap for page {page_num} of {pdf_path}: {e}")
             continue
-        image_path = "./temp_image.png"
-        pixmap.save(image_path)
+        yield page, pixmap, render_dpi
 
-        # Get bounding boxes from OCR results
-        bounding_boxes = get_ocr_bounding_boxes(image_path)
+def copy_original_page(new_pdf, page):
+    # Copy a born-digital page into the output PDF as-is; it needs no OCR text layer
+    new_pdf.insert_pdf(page.parent, from_page=page.number, to_page=page.number)
 
-        # Remove the temporary image file after processing
-        os.remove(image_path)
+def text_from_bounding_boxes(bounding_boxes):
+    # Plain text of an OCR'd page; a word that starts left of the previous one begins a new line
+    lines = []
+    line = []
+    previous_x = None
+    for word_text, vertices in bounding_boxes:
+        x = vertices[0][0]
+        if line and x < previous_x:
+            lines.append(" ".join(line))
+            line = []
+        line.append(word_text)
+        previous_x = x
+    if line:
+        lines.append(" ".join(line))
+    return "\n".join(lines)
 
-        img_width, img_height = pixmap.width, pixmap.height
-        pdf_width, pdf_height = page.rect.width, page.rect.height
-        scale_x = pdf_width / img_width
-        scale_y = pdf_height / img_height
+def page_words(page, pixmap, bounding_boxes):
+    # OCR words of a page with their rectangles in PDF points, for the word index
+    scale_x = page.rect.width / pixmap.width
+    scale_y = page.rect.height / pixmap.height
+    return [(word_text, (vertices[0][0] * scale_x, vertices[0][1] * scale_y,
+                         vertices[2][0] * scale_x, vertices[2][1] * scale_y))
+            for word_text, vertices in bounding_boxes]
 
-        # Create a new page in the output PDF and insert the image
-        new_page = new_pdf.new_page(width=pdf_width, height=pdf_height)
-        new_page.insert_image(page.rect, pixmap=pixmap)
+def text_layer_words(page):
+    # Words of a page copied through with its own text layer, for the word index
+    return [(word[4], tuple(word[:4])) for word in page.get_text("words", sort=True)]
+
+def write_ocr_text(text_path, page_texts):
+    # Write the document text in page order; the temporary file keeps readers from seeing partial text
+    os.makedirs(os.path.dirname(text_path), exist_ok=True)
+    temp_path = f"{text_path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as text_file:
+        text_file.write("\n\n".join(page_texts[page_num] for page_num in sorted(page_texts)))
+    os.replace(temp_path, text_path)
+
+def create_hybrid_ocr_pdf(pdf_path, output_folder, dpi=600, max_concurrent_requests=1,
+                          image_format="png", image_quality=85, batch_size=1, cache=None, manifest=None,
+                          skip_born_digital=False, adaptive_dpi=False,
+                          overlay_mode="raster", embed_dpi=None, embed_quality=75, text_output_folder=None,
+                          ocr_engine="vision", preprocessor=None, output_chunk_pages=0, screener=None,
+                          word_index=None):
+    # Create a hybrid OCR PDF by adding text overlay to the images.
+    # ocr_engine is an engine name from ocr_engines.OCR_ENGINES or an OCREngine instance.
+    # With max_concurrent_requests > 1 or batch_size > 1, pages are rendered on this thread while
+    # up to max_concurrent_requests OCR requests of batch_size pages each run on a thread pool;
+    # both are capped by the engine's own limits. Pages are composed back in page order, so the
+    # output is the same as the sequential path.
+    # With an OCRCache, the engine is only called for pages that are not already cached.
+    # With a JobManifest, finished PDFs are skipped and every OCR'd page is checkpointed, so a
+    # rerun after a crash only sends the pages that were never finished.
+    # skip_born_digital copies pages with a clean text layer through without OCR, and
+    # adaptive_dpi renders scanned pages at their native resolution, capped at dpi.
+    # With a PagePreprocessor, pages are cleaned up and shrunk before OCR and the word boxes are
+    # mapped back to the rendered page.
+    # overlay_mode picks how the page itself is drawn (see OVERLAY_MODE).
+    # With text_output_folder, the recognised text is also written to <name>.txt once the PDF is saved.
+    # With output_chunk_pages, the output is written to disk every that many pages instead of being
+    # held in memory until the end (see ChunkedPDFWriter).
+    # With a PageScreener, blank pages skip OCR and near-duplicates of earlier pages reuse their word boxes.
+    # With a WordIndex, every page's words are added to the index as the page is composed; the
+    # document becomes searchable once its PDF is saved.
+    ocr_pdf_filename = os.path.join(output_folder, f"ocr_{os.path.basename(pdf_path)}")
+    engine = get_ocr_engine(ocr_engine) if isinstance(ocr_engine, str) else ocr_engine
+    max_concurrent_requests = max(1, min(max_concurrent_requests, engine.max_concurrent_requests))
+    batch_size = max(1, min(batch_size, engine.max_batch_size))
+    cache_feature = engine.cache_feature if preprocessor is None else f"{engine.cache_feature}|{preprocessor.cache_tag}"
+    # Page checkpoints also record the word box format, so boxes in an older one are not reused
+    checkpoint_feature = f"{cache_feature}|v{CACHE_FORMAT_VERSION}"
+    # Everything that changes the output file; a document made with other settings is redone
+    output_settings = json.dumps({
+        "ocr": checkpoint_feature, "dpi": dpi, "adaptive_dpi": adaptive_dpi, "skip_born_digital": skip_born_digital,
+        "overlay_mode": overlay_mode, "embed_dpi": embed_dpi, "embed_quality": embed_quality,
+        "screen": None if screener is None else "duplicates" if screener.detect_duplicates else "blank",
+    }, sort_keys=True)
+
+    document_id = None
+    if manifest is not None:
+        document_id, previous_state = manifest.start_document(pdf_path, ocr_pdf_filename)
+        if manifest.is_done(document_id, previous_state, output_settings):
+            print(f"Skipping {pdf_path}: already processed to {ocr_pdf_filename}")
+            return
+
+    def lookup_ocr(page, pixmap, render_dpi):
+        # Return (cache key, known bounding boxes or None), checking screened duplicates and page
+        # checkpoints first
+        if screener is not None:
+            bounding_boxes = screener.reuse_boxes((page.parent.name, page.number), pixmap.width, pixmap.height)
+            if bounding_boxes is not None:
+                return None, bounding_boxes
+        if manifest is not None:
+            bounding_boxes = manifest.get_page(document_id, page.number, render_dpi, checkpoint_feature)
+            if bounding_boxes is not None:
+                metrics.incr("checkpoint_hits")
+                return None, bounding_boxes
+        return lookup_cached_ocr(cache, pixmap, render_dpi, image_format, image_quality, cache_feature,
+                                 engine.legacy_vertex_offset)
+
+    def store_ocr(page, render_dpi, cache_key, bounding_boxes):
+        # Record fresh OCR results for reruns
+        if cache is not None:
+            cache.put(cache_key, bounding_boxes)
+        if manifest is not None:
+            manifest.checkpoint_page(document_id, page.number, render_dpi, bounding_boxes, checkpoint_feature)
+
+    metrics.debug(f"Creating hybrid OCR PDF for: {pdf_path} (OCR engine: {engine.name})")
+    metrics.set_document(os.path.basename(pdf_path))
+    document_start_time = time.perf_counter()
+    pdf_document = fitz.open(pdf_path)
+    output = ChunkedPDFWriter(ocr_pdf_filename, output_chunk_pages)
+    index_document_id = word_index.start_document(pdf_path, ocr_pdf_filename) if word_index is not None else None
+    try:
+        # Only the raster overlay modes draw the rendered pixels into the output
+        keep_pixmaps = overlay_mode != "original"
+        pages = render_pages(pdf_document, pdf_path, dpi, skip_born_digital, adaptive_dpi, screener=screener,
+                             render_duplicates=keep_pixmaps)
+        # Measuring the text layer reads back the content streams, so only do it when instrumented
+        composition_stats = {"pages": 0, "words": 0, "seconds": 0.0, "text_layer_bytes": 0} if metrics.is_enabled() else None
+        prepare_image = partial(prepare_page_image, image_format=image_format, quality=image_quality,
+                                preprocessor=preprocessor)
+        page_texts = {}
+
+        def compose_page(page, pixmap, bounding_boxes):
+            with metrics.span("compose", page=page.number):
+                compose_ocr_page(output.document, page, pixmap, bounding_boxes, overlay_mode=overlay_mode,
+                                 embed_dpi=embed_dpi, embed_quality=embed_quality, stats=composition_stats)
+            if text_output_folder:
+                page_texts[page.number] = text_from_bounding_boxes(bounding_boxes)
+            if screener is not None:
+                screener.record((page.parent.name, page.number), pixmap.width, pixmap.height, bounding_boxes)
+            if word_index is not None:
+                with metrics.span("index", page=page.number):
+                    word_index.add_page(index_document_id, page.number, page_words(page, pixmap, bounding_boxes))
+            output.page_added()
+
+        def copy_page(page):
+            with metrics.span("copy_page", page=page.number):
+                copy_original_page(output.document, page)
+            if text_output_folder:
+                page_texts[page.number] = page.get_text().strip()
+            if word_index is not None:
+                with metrics.span("index", page=page.number):
+                    word_index.add_page(index_document_id, page.number, text_layer_words(page))
+            output.page_added()
 
-        # Insert extracted text at appropriate locations on the page
-        for word_text, vertices in bounding_boxes:
-            x0, y0 = vertices[0]
-            x1, y1 = vertices[2]
-            x0, y0 = x0 * scale_x, y0 * scale_y
-            x1, y1 = x1 * scale_x, y1 * scale_y
-
-            box_height = y1 - y0
-            font_size = box_height * 0.8
-            new_page.insert_text(
-                (x0, y0),
-                word_text,
-                fontsize=font_size,
-                fontname="helv",
-                color=(0, 0, 0),
-                render_mode=3
-            )
-
-    # Save the new PDF with OCR text overlay
-    new_pdf.save(ocr_pdf_filename)
-    new_pdf.close()
-    pdf_document.close()
+        if max_concurrent_requests > 1 or batch_size > 1:
+            _create_pages_pipelined(pages, compose_page, copy_page, lookup_ocr, store_ocr, prepare_image,
+                                    engine, max_concurrent_requests, batch_size, keep_pixmaps=keep_pixmaps)
+        else:
+            for page, pixmap, render_dpi in pages:
+                if pixmap is None:
+                    copy_page(page)
+                    continue
+
+                cache_key, bounding_boxes = lookup_ocr(page, pixmap, render_dpi)
+                if bounding_boxes is None:
+                    # Encode the page in memory; no temporary image file is written
+                    image_bytes, transform = prepare_image(pixmap)
+
+                    # Get bounding boxes from OCR results, in rendered-page pixels
+                    bounding_boxes = engine.recognize(image_bytes)
+                    if transform is not None:
+                        bounding_boxes = transform.map_boxes(bounding_boxes)
+                    store_ocr(page, render_dpi, cache_key, bounding_boxes)
+
+                compose_page(page, pixmap, bounding_boxes)
+                pixmap = None
+
+        if composition_stats is not None:
+            report_composition_stats(composition_stats)
+
+        # Save the new PDF with OCR text overlay
+        output.finish()
+        if text_output_folder:
+            write_ocr_text(ocr_text_path(pdf_path, text_output_folder), page_texts)
+        if word_index is not None:
+            word_index.finish_document(index_document_id)
+    except Exception as e:
+        if manifest is not None:
+            manifest.fail_document(document_id, e)
+        if word_index is not None:
+            word_index.discard_document(index_document_id)
+        raise
+    finally:
+        output.close()
+        pdf_document.close()
+
+    if manifest is not None:
+        manifest.finish_document(document_id, output_settings)
+    metrics.observe("document", time.perf_counter() - document_start_time)
+    metrics.incr("documents")
     print(f"Hybrid OCR'd PDF saved to: {ocr_pdf_filename}")
 
+class ChunkedPDFWriter:
+    # Output PDF that is written to disk every chunk_pages pages. The first chunk is saved in full,
+    # later ones as incremental updates, and the document is reopened from disk after each save so
+    # the pages already written are no longer held in memory. The file is written under a temporary
+    # name and only moved into place by finish(), so a crash never leaves a truncated output.
+    def __init__(self, output_path, chunk_pages=0):
+        self.output_path = output_path
+        self.temp_path = f"{output_path}.partial"
+        self.chunk_pages = chunk_pages
+        self.document = fitz.open()
+        self.pages_in_memory = 0
+        self.on_disk = False
+
+    def page_added(self):
+        self.pages_in_memory += 1
+        if self.chunk_pages and self.pages_in_memory >= self.chunk_pages:
+            self.flush()
+
+    def flush(self):
+        if not self.pages_in_memory:
+            return
+        with metrics.span("save"):
+            if self.on_disk:
+                self.document.saveIncr()
+            else:
+                self.document.save(self.temp_path)
+                self.on_disk = True
+            self.document.close()
+            self.document = fitz.open(self.temp_path)
+        metrics.incr("output_chunks")
+        self.pages_in_memory = 0
+
+    def finish(self):
+        if self.on_disk:
+            self.flush()
+        else:
+            with metrics.span("save"):
+                self.document.save(self.temp_path)
+        self.document.close()
+        os.replace(self.temp_path, self.output_path)
+
+    def close(self):
+        # Release the document; after a failure the partial file is removed as well
+        if not self.document.is_closed:
+            self.document.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+def _create_pages_pipelined(pages, compose_page, copy_page, lookup_ocr, store_ocr, prepare_image,
+                            engine, max_concurrent_requests, batch_size, keep_pixmaps=True):
+    # PyMuPDF objects are not thread-safe, so rendering and composing stay on this thread and
+    # only the OCR calls go to the pool. At most max_concurrent_requests requests are in
+    # flight, plus the batch currently being rendered.
+    # Without keep_pixmaps, a page's pixels are dropped as soon as it is encoded, since composing
+    # it only needs the rendered size; otherwise they are dropped once the page is composed.
+    pending = deque()
+    batch_pages = []
+    batch_images = []
+
+    def submit_batch():
+        if batch_images:
+            future = executor.submit(engine.recognize_batch, list(batch_images))
+        else:
+            # Every page in the batch was already known or copied through
+            future = Future()
+            future.set_result([])
+        pending.append((list(batch_pages), future))
+        batch_pages.clear()
+        batch_images.clear()
+
+    def compose_oldest_batch():
+        pages, future = pending.popleft()
+        ocr_results = iter(future.result())
+        for index, (page, pixmap, render_dpi, cache_key, known_boxes, transform) in enumerate(pages):
+            pages[index] = None
+            if pixmap is None:
+                copy_page(page)
+                continue
+            bounding_boxes = known_boxes
+            if bounding_boxes is None:
+                bounding_boxes = next(ocr_results)
+                if transform is not None:
+                    bounding_boxes = transform.map_boxes(bounding_boxes)
+                store_ocr(page, render_dpi, cache_key, bounding_boxes)
+            compose_page(page, pixmap, bounding_boxes)
+
+    with ThreadPoolExecutor(max_workers=max_concurrent_requests) as executor:
+        try:
+            for page, pixmap, render_dpi in pages:
+                if pixmap is None:
+                    batch_pages.append((page, None, None, None, None, None))
+                else:
+                    cache_key, known_boxes = lookup_ocr(page, pixmap, render_dpi)
+                    transform = None
+                    if known_boxes is None:
+                        image_bytes, transform = prepare_image(pixmap)
+                        batch_images.append(image_bytes)
+                    if not keep_pixmaps:
+                        pixmap = RenderedSize(pixmap.width, pixmap.height)
+                    batch_pages.append((page, pixmap, render_dpi, cache_key, known_boxes, transform))
+                if len(batch_pages) >= batch_size:
+                    submit_batch()
+
+                # Compose the oldest pages once the in-flight limit is exceeded
+                while len(pending) > max_concurrent_requests:
+                    compose_oldest_batch()
+
+            if batch_pages:
+                submit_batch()
+            while pending:
+                compose_oldest_batch()
+        finally:
+            # Don't leave requests running for pages that will never be composed
+            for _, future in pending:
+                future.cancel()
+
+def peak_rss_bytes():
+    # Peak resident set size of the current process, or None if it can't be measured here
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS reports bytes
+        return peak if sys.platform == "darwin" else peak * 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset  # Windows
+    except (ImportError, AttributeError):
+        return None
+
+def _measure_overlay_mode(pdf_path, output_folder, overlay_mode, cache_folder, dpi, worker_setup):
+    # Runs in a fresh process so the peak RSS belongs to this mode alone
+    if worker_setup is not None:
+        worker_setup()
+    mode_folder = os.path.join(output_folder, f"overlay_{overlay_mode}")
+    os.makedirs(mode_folder, exist_ok=True)
+    cache = OCRCache(cache_folder) if cache_folder else None
+    start_time = time.perf_counter()
+    create_hybrid_ocr_pdf(pdf_path, mode_folder, dpi=dpi, cache=cache, skip_born_digital=SKIP_BORN_DIGITAL_PAGES,
+                          adaptive_dpi=ADAPTIVE_DPI, overlay_mode=overlay_mode,
+                          embed_dpi=EMBED_DPI, embed_quality=EMBED_QUALITY)
+    elapsed = time.perf_counter() - start_time
+    output_size = os.path.getsize(os.path.join(mode_folder, f"ocr_{os.path.basename(pdf_path)}"))
+    return output_size, peak_rss_bytes(), elapsed
+
+def compare_overlay_modes(pdf_path, output_folder, modes=("raster", "compressed", "original"), cache_folder=None,
+                          dpi=600, worker_setup=None):
+    # Build the same PDF with each overlay mode and print output size and peak RSS side by side.
+    # Pass a cache folder so the OCR results are paid for once and reused by the other modes.
+    # worker_setup, a picklable callable, runs first in each measuring process, e.g. to install a
+    # fake Vision client (see benchmark.py --compare-overlay-modes).
+    metrics.debug(f"Comparing overlay modes for: {pdf_path}")
+    input_size = os.path.getsize(pdf_path)
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for overlay_mode in modes:
+        with context.Pool(1) as pool:
+            results[overlay_mode] = pool.apply(_measure_overlay_mode,
+                                               (pdf_path, output_folder, overlay_mode, cache_folder, dpi, worker_setup))
+
+    print(f"Input size: {input_size / 1024 ** 2:.1f} MB")
+    for overlay_mode, (output_size, peak_rss, elapsed) in results.items():
+        peak_rss_text = f"{peak_rss / 1024 ** 2:.0f} MB" if peak_rss else "n/a"
+        print(f"{overlay_mode:>10}: output {output_size / 1024 ** 2:.1f} MB "
+              f"({output_size / input_size:.2f}x input), peak RSS {peak_rss_text}, {elapsed:.1f} s")
+    return results
+
+def compare_ocr_engines(pdf_paths, engines=("vision", "tesseract"), dpi=300):
+    # OCR every page that would be OCR'd with each engine and print the time per page and how
+    # closely each engine's words agree with the first engine's (a word-sequence similarity from
+    # 0 to 1), to decide which corpora can go to the cheaper engine. No PDFs are written.
+    engines = [get_ocr_engine(name) for name in engines]
+    seconds = {engine.name: 0.0 for engine in engines}
+    agreement = {engine.name: [] for engine in engines}
+    words = {engine.name: 0 for engine in engines}
+    pages = 0
+    for pdf_path in pdf_paths:
+        metrics.debug(f"Comparing OCR engines on: {pdf_path}")
+        with fitz.open(pdf_path) as pdf_document:
+            for page, pixmap, render_dpi in render_pages(pdf_document, pdf_path, dpi, SKIP_BORN_DIGITAL_PAGES, ADAPTIVE_DPI):
+                if pixmap is None:
+                    continue
+                image_bytes = encode_page_image(pixmap, OCR_IMAGE_FORMAT, OCR_IMAGE_QUALITY)
+                pages += 1
+                reference_words = None
+                for engine in engines:
+                    start_time = time.perf_counter()
+                    recognized_words = [word for word, _ in engine.recognize(image_bytes)]
+                    seconds[engine.name] += time.perf_counter() - start_time
+                    words[engine.name] += len(recognized_words)
+                    if reference_words is None:
+                        reference_words = recognized_words
+                    agreement[engine.name].append(
+                        difflib.SequenceMatcher(None, reference_words, recognized_words, autojunk=False).ratio())
+
+    if not pages:
+        print("No pages to OCR in the given PDFs.")
+        return {}
+    results = {}
+    print(f"Compared {len(engines)} OCR engines on {pages} pages (agreement is relative to {engines[0].name}):")
+    for engine in engines:
+        results[engine.name] = {
+            "seconds_per_page": seconds[engine.name] / pages,
+            "words": words[engine.name],
+            "agreement": sum(agreement[engine.name]) / pages,
+        }
+        print(f"{engine.name:>10}: {results[engine.name]['seconds_per_page']:.2f} s/page, "
+              f"{words[engine.name]} words, agreement {results[engine.name]['agreement']:.3f}")
+    return results
+
+def cli(argv=None):
+    # Command-line entry point, also reached through "python cli.py ocr"
+    args = parse_args(argv)
+    metrics.configure(enabled=METRICS_ENABLED, debug=args.debug)
+    metrics.debug("Starting the script.")
+    if args.compare_engines:
+        setup_environment()
+        compare_ocr_engines(collect_pdfs(args.inputs), args.compare_engines)
+    elif args.compare_overlay_modes:
+        _, default_output_folder = setup_environment()
+        output_folder = args.output or default_output_folder
+        for pdf_path in collect_pdfs(args.inputs):
+            compare_overlay_modes(pdf_path, output_folder, cache_folder=os.path.join(output_folder, ".ocr_cache"))
+    elif args.inputs:
+        _, default_output_folder = setup_environment()
+        run_batch(args.inputs, args.output or default_output_folder, args.workers, debug=args.debug,
+                  ocr_engine=args.engine)
+    else:
+        main(debug=args.debug, ocr_engine=args.engine)
+
 if __name__ == "__main__":
-    print("Debug: Starting the script.")
-    main(debug=True)
+    cli()
@@ -0,0 +1,172 @@
+import os
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import metrics
+import ocr_generator_local as ocr
+import metadata_generator as metadata
+
+# Streaming OCR -> metadata pipeline.
+# OCR worker processes turn PDFs into hybrid PDFs plus recognised text; each finished document's
+# text file goes onto a bounded queue, and metadata worker threads generate its metadata while the
+# remaining PDFs are still being OCR'd. A full queue stops new OCR work until metadata catches up,
+# which caps how much finished-but-unprocessed work piles up.
+
+# Custom exception for pipeline configuration problems
+class PipelineConfigError(Exception):
+    pass
+
+class StageStats:
+    # Throughput counters of one pipeline stage, safe to update from several threads
+    def __init__(self, name):
+        self.name = name
+        self.documents = 0
+        self.pages = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds, pages=0, failed=False):
+        with self.lock:
+            self.documents += 1
+            self.pages += pages
+            self.failed += int(failed)
+            self.busy_seconds += seconds
+
+    def report(self, wall_seconds):
+        wall_seconds = max(wall_seconds, 1e-9)
+        average = self.busy_seconds / self.documents if self.documents else 0.0
+        pages_text = f", {self.pages / wall_seconds:.2f} pages/s" if self.pages else ""
+        print(f"{self.name}: {self.documents} documents ({self.failed} failed), "
+              f"{self.documents / wall_seconds:.2f} documents/s{pages_text}, {average:.1f} s per document")
+
+def produce_ocr_text(pdf_paths, ocr_output_folder, ocr_workers, text_queue, ocr_stats, debug=False):
+    # OCR the PDFs on a process pool, keeping at most ocr_workers documents in flight, and queue
+    # each document's text file as soon as it is written
+    pdf_iterator = iter(pdf_paths)
+    in_flight = set()
+    with ProcessPoolExecutor(max_workers=ocr_workers, initializer=ocr.init_batch_worker,
+                             initargs=(ocr_output_folder, debug)) as executor:
+        def submit_next():
+            pdf_path = next(pdf_iterator, None)
+            if pdf_path is not None:
+                in_flight.add(executor.submit(ocr.process_pdf_in_worker, pdf_path, ocr_output_folder))
+
+        for _ in range(ocr_workers):
+            submit_next()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                in_flight.remove(future)
+                result = future.result()
+                ocr_stats.record(result["seconds"], pages=result["pages"], failed=bool(result["error"]))
+                metrics.merge(result["metrics"])
+                if result["error"]:
+                    print(f"Error processing {result['pdf']}: {result['error']}")
+                elif result["text_path"]:
+                    # Blocks while the metadata stage is behind
+                    text_queue.put(result["text_path"])
+                submit_next()
+
+def consume_ocr_text(text_queue, metadata_stats, previous_records):
+    # Generate and record metadata for each queued text file until the end marker arrives. Files with
+    # complete metadata from an earlier run are skipped; for partly invalid ones only the invalid keys
+    # are asked for.
+    while True:
+        text_path = text_queue.get()
+        if text_path is None:
+            return
+        text_file = os.path.basename(text_path)
+        previous = previous_records.get(text_file)
+        if previous and metadata.is_complete(previous):
+            metrics.debug(f"Skipping {text_file}: metadata already exists")
+            continue
+        start_time = time.perf_counter()
+        failed = False
+        try:
+            result = metadata.process_and_record(text_file, os.path.dirname(text_path), previous)
+            failed = not (result and metadata.has_metadata(result))
+        except Exception as e:
+            print(f"Error generating metadata for {text_file}: {e}")
+            failed = True
+        metadata_stats.record(time.perf_counter() - start_time, failed=failed)
+
+def run_pipeline(inputs, ocr_output_folder, ocr_workers, metadata_workers, queue_depth, debug=False):
+    if not ocr.WRITE_OCR_TEXT:
+        raise PipelineConfigError("WRITE_OCR_TEXT must be enabled in ocr_generator_local.py for the pipeline")
+    pdf_paths = ocr.collect_pdfs(inputs)
+    if not pdf_paths:
+        print("No PDFs found for processing.")
+        return
+    ocr.check_output_names(pdf_paths)
+    os.makedirs(ocr_output_folder, exist_ok=True)
+    os.makedirs(metadata.metadata_folder or ".", exist_ok=True)
+    metrics.configure(enabled=ocr.METRICS_ENABLED, debug=debug, record_pages=ocr.RECORD_PAGE_METRICS)
+    ocr_workers = max(1, min(ocr_workers, len(pdf_paths)))
+    metrics.debug(f"Pipeline: {len(pdf_paths)} PDFs, {ocr_workers} OCR processes, "
+                  f"{metadata_workers} metadata threads, queue depth {queue_depth}")
+
+    previous_records = metadata.load_metadata_records(metadata.metadata_jsonl_filename) if metadata.resume else {}
+
+    text_folder = os.path.join(ocr_output_folder, "text")
+    if metadata.preextract and os.path.isdir(text_folder):
+        # Text of earlier runs seeds the corpus statistics; new documents are added as they arrive
+        metadata.build_corpus_profile(text_folder, [f for f in os.listdir(text_folder) if f.endswith('.txt')])
+
+    text_queue = queue.Queue(maxsize=queue_depth)
+    ocr_stats = StageStats("OCR")
+    metadata_stats = StageStats("Metadata")
+    start_time = time.perf_counter()
+
+    consumers = [threading.Thread(target=consume_ocr_text, args=(text_queue, metadata_stats, previous_records), daemon=True)
+                 for _ in range(metadata_workers)]
+    for consumer in consumers:
+        consumer.start()
+    try:
+        produce_ocr_text(pdf_paths, ocr_output_folder, ocr_workers, text_queue, ocr_stats, debug)
+    finally:
+        # One end marker per consumer, after everything the producer queued
+        for _ in consumers:
+            text_queue.put(None)
+        for consumer in consumers:
+            consumer.join()
+
+    wall_seconds = time.perf_counter() - start_time
+    print(f"Pipeline finished in {wall_seconds:.1f} s")
+    ocr_stats.report(wall_seconds)
+    metadata_stats.report(wall_seconds)
+    print(f"LLM response cache: {metadata.llm_cache_stats['hits']} hits, {metadata.llm_cache_stats['misses']} misses")
+    metadata.report_prompt_savings()
+    metadata.report_validation()
+
+    metadata_filename = os.path.join(metadata.metadata_folder, 'metadata_results.json')
+    metadata_results = metadata.compact_metadata(metadata.metadata_jsonl_filename, metadata_filename)
+    print(f"Metadata for {len(metadata_results)} files saved to {metadata_filename}")
+    # OCR worker and metadata thread measurements end up in one file
+    metrics.export(os.path.join(ocr_output_folder, "pipeline_metrics.json"))
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="OCR PDFs and generate their metadata in one streaming run.")
+    parser.add_argument("inputs", nargs="+", help="PDF files, folders or glob patterns")
+    parser.add_argument("-o", "--output", help="OCR output folder (defaults to the configured OCR output folder)")
+    parser.add_argument("--ocr-workers", type=int, default=os.cpu_count() or 1,
+                        help="number of OCR worker processes (default: number of CPUs)")
+    parser.add_argument("--metadata-workers", type=int, default=metadata.max_concurrent_files,
+                        help="number of metadata worker threads")
+    parser.add_argument("--queue-depth", type=int, default=16,
+                        help="maximum number of OCR'd documents waiting for metadata")
+    parser.add_argument("--debug", action="store_true", help="print debug messages")
+    return parser.parse_args(argv)
+
+def cli(argv=None):
+    # Command-line entry point, also reached through "python cli.py pipeline"
+    args = parse_args(argv)
+    _, default_output_folder = ocr.setup_environment()
+    run_pipeline(args.inputs, args.output or default_output_folder, args.ocr_workers,
+                 args.metadata_workers, max(1, args.queue_depth), debug=args.debug)
+
+if __name__ == "__main__":
+    cli()
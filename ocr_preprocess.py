@@ -0,0 +1,163 @@
+import io
+import math
+
+from lazy_imports import LazyModule
+
+np = LazyModule("numpy")
+PIL_Image = LazyModule("PIL.Image", "pillow")
+
+# Clean-up of rendered pages before OCR, to cut upload size and encode time.
+# A grayscale page goes through (each step optional):
+#   border crop - cut the blank margins and dark scanner edges around the text
+#   deskew      - rotate so text lines are horizontal (estimated from row projection profiles)
+#   downscale   - shrink to at most max_pixels pixels
+#   binarise    - Otsu threshold to a 1-bit PNG (mode "binary"), otherwise 8-bit grayscale
+# The OCR engine then sees a different image than the rendered page, so every processed page comes
+# with a PageTransform that maps the returned word boxes back to rendered-page pixels.
+
+# Custom exception for an unknown preprocessing mode
+class InvalidPreprocessModeError(Exception):
+    pass
+
+class PageTransform:
+    # Crop offset, deskew rotation (degrees counter-clockwise; the rotated image is enlarged to keep
+    # the corners, so the centre of the cropped image moves to the centre of the rotated one) and
+    # downscale factors applied to a page, in that order
+    def __init__(self, crop_left, crop_top, crop_size, angle, rotated_size, scale_x, scale_y):
+        self.crop_left = crop_left
+        self.crop_top = crop_top
+        self.center_x = crop_size[0] / 2
+        self.center_y = crop_size[1] / 2
+        self.rotated_center_x = rotated_size[0] / 2
+        self.rotated_center_y = rotated_size[1] / 2
+        self.angle = angle
+        self.scale_x = scale_x
+        self.scale_y = scale_y
+        self._cos = math.cos(math.radians(angle))
+        self._sin = math.sin(math.radians(angle))
+
+    def to_page(self, x, y):
+        # Point on the processed image -> point on the rendered page. Pixel centres are at +0.5, so
+        # the downscale is undone around them.
+        x = (x + 0.5) / self.scale_x - 0.5
+        y = (y + 0.5) / self.scale_y - 0.5
+        if self.angle:
+            dx, dy = x - self.rotated_center_x, y - self.rotated_center_y
+            x = self.center_x + dx * self._cos - dy * self._sin
+            y = self.center_y + dx * self._sin + dy * self._cos
+        return x + self.crop_left, y + self.crop_top
+
+    def map_boxes(self, bounding_boxes):
+        # Map word boxes back to the rendered page
+        mapped = []
+        for word_text, vertices in bounding_boxes:
+            page_vertices = []
+            for x, y in vertices:
+                page_x, page_y = self.to_page(x, y)
+                page_vertices.append((int(round(page_x)), int(round(page_y))))
+            mapped.append((word_text, page_vertices))
+        return mapped
+
+def otsu_threshold(gray):
+    # Threshold between ink and paper that maximises the between-class variance of the histogram
+    histogram = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256, dtype=np.float64)
+    weight_dark = np.cumsum(histogram)
+    weight_light = weight_dark[-1] - weight_dark
+    sum_dark = np.cumsum(histogram * levels)
+    mean_dark = sum_dark / np.maximum(weight_dark, 1)
+    mean_light = (sum_dark[-1] - sum_dark) / np.maximum(weight_light, 1)
+    between_variance = weight_dark * weight_light * (mean_dark - mean_light) ** 2
+    return int(np.argmax(between_variance))
+
+def content_bounds(ink, margin_fraction=0.01, min_ink=0.002, max_ink=0.6):
+    # (top, bottom, left, right) of the rows and columns holding text. Rows and columns that are
+    # nearly empty are margin; nearly solid ones are scanner edges or gutter shadows.
+    height, width = ink.shape
+    # Solid edges would otherwise put ink into every row (or column) crossing them
+    solid_rows = ink.mean(axis=1) >= max_ink
+    solid_columns = ink.mean(axis=0) >= max_ink
+    row_ink = ink[:, ~solid_columns].mean(axis=1) if not solid_columns.all() else np.zeros(height)
+    column_ink = ink[~solid_rows, :].mean(axis=0) if not solid_rows.all() else np.zeros(width)
+    rows = np.flatnonzero((row_ink > min_ink) & (row_ink < max_ink))
+    columns = np.flatnonzero((column_ink > min_ink) & (column_ink < max_ink))
+    if not len(rows) or not len(columns):
+        return 0, height, 0, width
+    margin = max(10, int(margin_fraction * max(height, width)))
+    return (max(0, rows[0] - margin), min(height, rows[-1] + 1 + margin),
+            max(0, columns[0] - margin), min(width, columns[-1] + 1 + margin))
+
+def estimate_skew(ink, max_angle=5.0, step=0.25, max_points=200_000):
+    # Rotation (degrees counter-clockwise) that makes the text lines horizontal: the candidate angle
+    # whose row projection profile of the ink pixels is the most sharply peaked
+    ys, xs = np.nonzero(ink)
+    if len(ys) < 100:
+        return 0.0
+    if len(ys) > max_points:
+        keep = np.random.default_rng(0).choice(len(ys), max_points, replace=False)
+        ys, xs = ys[keep], xs[keep]
+    ys = ys - ink.shape[0] / 2
+    xs = xs - ink.shape[1] / 2
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-max_angle, max_angle + step / 2, step):
+        radians = math.radians(angle)
+        rows = np.round(ys * math.cos(radians) - xs * math.sin(radians)).astype(np.int64)
+        profile = np.bincount(rows - rows.min())
+        score = float(np.dot(profile, profile))
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+class PagePreprocessor:
+    def __init__(self, mode="gray", deskew=True, crop_borders=True, max_pixels=12_000_000):
+        if mode not in ("gray", "binary"):
+            raise InvalidPreprocessModeError(f"Unknown preprocessing mode: {mode}")
+        self.mode = mode
+        self.deskew = deskew
+        self.crop_borders = crop_borders
+        self.max_pixels = max_pixels
+
+    @property
+    def cache_tag(self):
+        # Part of the OCR cache key: different preprocessing can give different OCR results
+        return f"pre|{self.mode}|{int(self.deskew)}|{int(self.crop_borders)}|{self.max_pixels}"
+
+    def process(self, gray, image_format="png", quality=85):
+        # gray: 2-D uint8 array of the rendered page. Returns (encoded image bytes, PageTransform).
+        height, width = gray.shape
+        # Statistics come from a subsample; full resolution adds time but no accuracy
+        step = max(1, int(math.sqrt(height * width / 4_000_000)))
+        threshold = otsu_threshold(gray[::step, ::step])
+
+        top, bottom, left, right = 0, height, 0, width
+        if self.crop_borders:
+            top, bottom, left, right = (value * step for value in content_bounds(gray[::step, ::step] < threshold))
+            bottom, right = min(bottom, height), min(width, right)
+        image = PIL_Image.fromarray(np.ascontiguousarray(gray[top:bottom, left:right]))
+        crop_width, crop_height = image.size
+
+        angle = 0.0
+        if self.deskew:
+            sample_step = max(1, int(math.sqrt(crop_width * crop_height / 1_000_000)))
+            angle = estimate_skew(np.asarray(image)[::sample_step, ::sample_step] < threshold)
+            if angle:
+                image = image.rotate(angle, resample=PIL_Image.BILINEAR, expand=True, fillcolor=255)
+        rotated_size = image.size
+
+        if self.max_pixels and rotated_size[0] * rotated_size[1] > self.max_pixels:
+            scale = math.sqrt(self.max_pixels / (rotated_size[0] * rotated_size[1]))
+            image = image.resize((max(1, round(rotated_size[0] * scale)), max(1, round(rotated_size[1] * scale))),
+                                 resample=PIL_Image.BOX)
+
+        buffer = io.BytesIO()
+        if self.mode == "binary":
+            # Bilevel pages compress best as 1-bit PNG, whatever the configured format
+            image.point(lambda value: 255 if value > threshold else 0).convert("1").save(buffer, format="PNG", optimize=True)
+        elif image_format == "png":
+            image.save(buffer, format="PNG")
+        else:
+            image.save(buffer, format="JPEG", quality=quality)
+
+        transform = PageTransform(left, top, (crop_width, crop_height), angle, rotated_size,
+                                  image.size[0] / rotated_size[0], image.size[1] / rotated_size[1])
+        return buffer.getvalue(), transform
@@ -0,0 +1,192 @@
+import zlib
+
+from lazy_imports import LazyModule
+
+np = LazyModule("numpy")
+PIL_Image = LazyModule("PIL.Image", "pillow")
+
+# Cheap pre-screen of pages before the full-resolution render and the OCR call.
+# Scanned archives hold many blank separator sheets, repeated cover sheets and rescans of the same
+# page. Each page is first rendered at a low resolution (dpi, grayscale) and checked for:
+#   blank     - ink covers less than blank_ink of the page (margins ignored); the page is copied
+#               through without OCR
+#   duplicate - only with detect_duplicates: an earlier page of the run has the same ink everywhere.
+#               Difference hashes within max_hash_distance bits pick up to max_candidates earlier
+#               pages, which are then compared tile by tile: the ink masks are aligned (globally from
+#               their ink profiles, then per tile within local_shift pixels), and ink of either page
+#               without ink of the other within one pixel counts as unmatched. A single tile with
+#               more than max_tile_difference unmatched pixels makes the pages different, however
+#               much of them (a shared letterhead or form) is the same. The earlier page's word
+#               boxes are reused, scaled to this page.
+# Sizes are given for 100 dpi and scaled to dpi. At 100 dpi a changed word is well above the
+# threshold while rescans (shifted, rotated, noisier, JPEG) stay below it, but a change of a single
+# character can go unnoticed, which is why duplicate detection is off unless asked for.
+# A page only counts as a duplicate once the earlier page's word boxes are known; pages whose
+# original is still waiting for its OCR result are recognised normally.
+
+class PageFingerprint:
+    # Difference hash, compressed ink mask and, once the page is OCR'd, the word boxes of a page
+    __slots__ = ("hash", "compressed_ink", "shape", "bounding_boxes", "width", "height")
+
+    def __init__(self, hash_value, ink):
+        self.hash = hash_value
+        # A bit per pixel, deflated: a text page at 100 dpi takes a few KB, so thousands of
+        # fingerprints stay affordable
+        self.compressed_ink = zlib.compress(np.packbits(ink, axis=None).tobytes(), 1)
+        self.shape = ink.shape
+        self.bounding_boxes = None
+        self.width = None
+        self.height = None
+
+    @property
+    def ink(self):
+        packed = np.frombuffer(zlib.decompress(self.compressed_ink), dtype=np.uint8)
+        return np.unpackbits(packed, count=self.shape[0] * self.shape[1]).reshape(self.shape).astype(bool)
+
+def ink_mask(gray, background):
+    # Pixels clearly darker than the paper
+    return gray < 0.65 * background
+
+def difference_hash(image, hash_size=16):
+    # hash_size x hash_size bits: whether each cell of a (hash_size + 1) x hash_size thumbnail is
+    # brighter than its right-hand neighbour
+    cells = np.asarray(image.resize((hash_size + 1, hash_size), resample=PIL_Image.BOX), dtype=np.int16)
+    bits = (cells[:, 1:] > cells[:, :-1]).ravel()
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+def dilate(mask):
+    # The mask grown by one pixel in every direction
+    grown = mask.copy()
+    grown[1:] |= mask[:-1]
+    grown[:-1] |= mask[1:]
+    wide = grown.copy()
+    wide[:, 1:] |= grown[:, :-1]
+    wide[:, :-1] |= grown[:, 1:]
+    return wide
+
+def profile_shift(a, b, axis, max_shift):
+    # Offset (within max_shift) at which the ink profile of a along the other axis best matches b's
+    profile_a = a.sum(axis=axis, dtype=np.float64)
+    profile_b = b.sum(axis=axis, dtype=np.float64)
+    length = min(len(profile_a), len(profile_b))
+    profile_a, profile_b = profile_a[:length], profile_b[:length]
+    best_score, best_shift = -1.0, 0
+    for shift in range(-max_shift, max_shift + 1):
+        if shift >= 0:
+            score = float(np.dot(profile_a[shift:], profile_b[:length - shift]))
+        else:
+            score = float(np.dot(profile_a[:length + shift], profile_b[-shift:]))
+        if score > best_score:
+            best_score, best_shift = score, shift
+    return best_shift
+
+def worst_tile_difference(a, b, max_shift, local_shift, tile_size, limit=0):
+    # Unmatched ink pixels in the worst tile of two ink masks, each tile at its best alignment.
+    # Stops as soon as every tile is within limit, so only different pages pay for the whole search.
+    shift_y = profile_shift(a, b, 1, max_shift)
+    shift_x = profile_shift(a, b, 0, max_shift)
+    margin = max_shift + local_shift + 1
+    height, width = min(a.shape[0], b.shape[0]), min(a.shape[1], b.shape[1])
+    rows, columns = (height - 2 * margin) // tile_size, (width - 2 * margin) // tile_size
+    if rows <= 0 or columns <= 0:
+        return float("inf")
+    tiles_height, tiles_width = rows * tile_size, columns * tile_size
+
+    fixed = b[margin:margin + tiles_height, margin:margin + tiles_width]
+    fixed_uncovered = ~dilate(b)[margin:margin + tiles_height, margin:margin + tiles_width]
+    moved_covered = dilate(a)
+    best = None
+    for dy in range(-local_shift, local_shift + 1):
+        for dx in range(-local_shift, local_shift + 1):
+            top, left = margin + shift_y + dy, margin + shift_x + dx
+            moved = a[top:top + tiles_height, left:left + tiles_width]
+            unmatched = (moved & fixed_uncovered) | (fixed & ~moved_covered[top:top + tiles_height, left:left + tiles_width])
+            counts = unmatched.reshape(rows, tile_size, columns, tile_size).sum(axis=(1, 3))
+            best = counts if best is None else np.minimum(best, counts)
+            if best.max() <= limit:
+                return int(best.max())
+    return int(best.max())
+
+class PageScreener:
+    def __init__(self, dpi=100, blank_ink=0.0005, detect_duplicates=False, max_hash_distance=64,
+                 max_tile_difference=14, tile_size=32, max_shift=12, local_shift=4, max_candidates=4,
+                 max_fingerprints=2000):
+        self.dpi = dpi
+        self.blank_ink = blank_ink
+        self.detect_duplicates = detect_duplicates
+        self.max_hash_distance = max_hash_distance
+        # Pixel sizes and counts are given for 100 dpi
+        scale = dpi / 100
+        self.max_tile_difference = max_tile_difference * scale * scale
+        self.tile_size = max(4, round(tile_size * scale))
+        self.max_shift = max(1, round(max_shift * scale))
+        self.local_shift = max(1, round(local_shift * scale))
+        # Closest hashes whose ink masks are compared, at most
+        self.max_candidates = max_candidates
+        # Distinct pages seen this run, oldest first; the oldest are forgotten beyond max_fingerprints
+        self.max_fingerprints = max_fingerprints
+        self.fingerprints = []
+        # Fingerprint of each screened page that is waiting for OCR (its own), or whose word boxes
+        # are to be reused (an earlier page's), by page key
+        self._new_pages = {}
+        self._duplicates = {}
+
+    def screen(self, gray, key):
+        # gray: 2-D uint8 array of the low-resolution render; key identifies the page, e.g.
+        # (pdf path, page number). Returns "blank", "duplicate" or None.
+        height, width = gray.shape
+        background = float(np.percentile(gray, 90)) or 1.0
+        margin_y, margin_x = height // 20, width // 20
+        inner = gray[margin_y:height - margin_y, margin_x:width - margin_x]
+        if not inner.size or ink_mask(inner, background).mean() < self.blank_ink:
+            return "blank"
+        if not self.detect_duplicates:
+            return None
+
+        hash_value = difference_hash(PIL_Image.fromarray(np.ascontiguousarray(gray)))
+        # Ink relative to the paper, so a darker or lighter rescan still matches
+        ink = ink_mask(gray, background)
+
+        candidates = []
+        for fingerprint in self.fingerprints:
+            if fingerprint.bounding_boxes is None:
+                continue
+            if abs(fingerprint.shape[0] - height) > 0.02 * height or abs(fingerprint.shape[1] - width) > 0.02 * width:
+                continue
+            distance = hamming_distance(fingerprint.hash, hash_value)
+            if distance <= self.max_hash_distance:
+                candidates.append((distance, fingerprint))
+        candidates.sort(key=lambda candidate: candidate[0])
+        for _, fingerprint in candidates[:self.max_candidates]:
+            difference = worst_tile_difference(fingerprint.ink, ink, self.max_shift, self.local_shift, self.tile_size,
+                                               limit=self.max_tile_difference)
+            if difference <= self.max_tile_difference:
+                self._duplicates[key] = fingerprint
+                return "duplicate"
+
+        fingerprint = PageFingerprint(hash_value, ink)
+        self.fingerprints.append(fingerprint)
+        if len(self.fingerprints) > self.max_fingerprints:
+            del self.fingerprints[0]
+        self._new_pages[key] = fingerprint
+        return None
+
+    def reuse_boxes(self, key, width, height):
+        # Word boxes for a page screened as a duplicate, scaled to its rendered size, or None
+        fingerprint = self._duplicates.pop(key, None)
+        if fingerprint is None:
+            return None
+        scale_x, scale_y = width / fingerprint.width, height / fingerprint.height
+        return [(word_text, [(int(round(x * scale_x)), int(round(y * scale_y))) for x, y in vertices])
+                for word_text, vertices in fingerprint.bounding_boxes]
+
+    def record(self, key, width, height, bounding_boxes):
+        # Word boxes of a screened page in pixels of its width x height render, for later duplicates
+        fingerprint = self._new_pages.pop(key, None)
+        if fingerprint is not None:
+            fingerprint.bounding_boxes = bounding_boxes
+            fingerprint.width = width
+            fingerprint.height = height
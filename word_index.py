@@ -0,0 +1,229 @@
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import argparse
+
+# Persistent full-text index of the OCR'd words, for finding a phrase across all output PDFs
+# without opening them.
+# Every page's text goes into an SQLite FTS5 table, and its words are stored with their rectangles
+# in PDF points (the same geometry as the source and the output PDF), so a search returns the
+# matching documents and pages plus the rectangles to highlight.
+# Pages are written as they are composed, each in its own short transaction, under a new document
+# row that only becomes visible once the document is finished; the previous version of the same
+# document is then replaced. Worker processes of a batch run can share the database.
+
+DEFAULT_INDEX_FILE = "ocr_word_index.sqlite3"
+
+# Custom exception for an SQLite build without FTS5 or a malformed search query
+class WordIndexError(Exception):
+    pass
+
+def query_terms(text):
+    # Lowercased word tokens, matching how the unicode61 tokenizer splits words
+    return re.findall(r"\w+", text.lower())
+
+class WordIndex:
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.connection = sqlite3.connect(index_path, timeout=60, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        try:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS documents (
+                    id INTEGER PRIMARY KEY,
+                    path TEXT NOT NULL,
+                    output_path TEXT,
+                    state TEXT NOT NULL,
+                    pages INTEGER NOT NULL DEFAULT 0,
+                    words INTEGER NOT NULL DEFAULT 0,
+                    indexed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS documents_path ON documents(path);
+                CREATE TABLE IF NOT EXISTS pages (
+                    id INTEGER PRIMARY KEY,
+                    document_id INTEGER NOT NULL REFERENCES documents(id) ON DELETE CASCADE,
+                    page_num INTEGER NOT NULL,
+                    text TEXT NOT NULL,
+                    words TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS pages_document ON pages(document_id);
+                CREATE VIRTUAL TABLE IF NOT EXISTS page_text USING fts5(
+                    text, content='pages', content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+                );
+                CREATE TRIGGER IF NOT EXISTS pages_insert AFTER INSERT ON pages BEGIN
+                    INSERT INTO page_text (rowid, text) VALUES (new.id, new.text);
+                END;
+                CREATE TRIGGER IF NOT EXISTS pages_delete AFTER DELETE ON pages BEGIN
+                    INSERT INTO page_text (page_text, rowid, text) VALUES ('delete', old.id, old.text);
+                END;
+            """)
+        except sqlite3.OperationalError as e:
+            raise WordIndexError(f"The word index needs SQLite with FTS5 support: {e}") from e
+        self.connection.commit()
+
+    def _delete_documents(self, document_ids):
+        for document_id in document_ids:
+            self.connection.execute("DELETE FROM pages WHERE document_id = ?", (document_id,))
+            self.connection.execute("DELETE FROM documents WHERE id = ?", (document_id,))
+
+    def start_document(self, pdf_path, output_path=None):
+        # Open a new, not yet searchable version of a document and return its id. Leftovers of an
+        # interrupted earlier attempt are removed.
+        pdf_path = os.path.abspath(pdf_path)
+        stale = self.connection.execute(
+            "SELECT id FROM documents WHERE path = ? AND state = 'indexing'", (pdf_path,)
+        ).fetchall()
+        self._delete_documents(document_id for document_id, in stale)
+        cursor = self.connection.execute(
+            "INSERT INTO documents (path, output_path, state, indexed_at) VALUES (?, ?, 'indexing', ?)",
+            (pdf_path, output_path, time.time()),
+        )
+        self.connection.commit()
+        return cursor.lastrowid
+
+    def add_page(self, document_id, page_num, words):
+        # words: (text, (x0, y0, x1, y1)) in reading order, rectangles in PDF points
+        text = " ".join(word_text for word_text, _ in words)
+        data = json.dumps([[word_text, *(round(value, 1) for value in rect)] for word_text, rect in words],
+                          separators=(",", ":"))
+        self.connection.execute(
+            "INSERT INTO pages (document_id, page_num, text, words) VALUES (?, ?, ?, ?)",
+            (document_id, page_num, text, data),
+        )
+        self.connection.execute(
+            "UPDATE documents SET pages = pages + 1, words = words + ? WHERE id = ?", (len(words), document_id)
+        )
+        self.connection.commit()
+
+    def finish_document(self, document_id):
+        # Make the new version searchable and drop the previous one, in one transaction
+        row = self.connection.execute("SELECT path FROM documents WHERE id = ?", (document_id,)).fetchone()
+        if row is None:
+            return
+        previous = self.connection.execute(
+            "SELECT id FROM documents WHERE path = ? AND state = 'done'", (row[0],)
+        ).fetchall()
+        self._delete_documents(previous_id for previous_id, in previous)
+        self.connection.execute(
+            "UPDATE documents SET state = 'done', indexed_at = ? WHERE id = ?", (time.time(), document_id)
+        )
+        self.connection.commit()
+
+    def discard_document(self, document_id):
+        # Drop an unfinished version, e.g. after the document failed; the previous one stays searchable
+        self._delete_documents([document_id])
+        self.connection.commit()
+
+    def search(self, query, limit=20, phrase=False, raw=False):
+        # Return up to limit matching pages, best first, as dicts with the document path, output
+        # path, page number, highlight rectangles and a text snippet. The query's words must all
+        # occur on the page (as one phrase with phrase=True); raw=True passes FTS5 query syntax
+        # (OR, NOT, NEAR, prefix*) through unchanged.
+        terms = query_terms(query)
+        if raw:
+            match = query
+        elif phrase:
+            match = '"' + " ".join(terms) + '"'
+        else:
+            match = " ".join(f'"{term}"' for term in terms)
+        if not match.strip():
+            return []
+        try:
+            rows = self.connection.execute(
+                "SELECT d.path, d.output_path, p.page_num, p.words, "
+                "snippet(page_text, 0, '[', ']', '...', 12) "
+                "FROM page_text JOIN pages p ON p.id = page_text.rowid JOIN documents d ON d.id = p.document_id "
+                "WHERE page_text MATCH ? AND d.state = 'done' ORDER BY bm25(page_text) LIMIT ?",
+                (match, limit),
+            ).fetchall()
+        except sqlite3.OperationalError as e:
+            raise WordIndexError(f"Invalid search query {query!r}: {e}") from e
+
+        if raw:
+            terms = [term for term in terms if term not in ("and", "or", "not", "near")]
+        prefixes = {term.lower() for term in re.findall(r"(\w+)\*", query)} if raw else set()
+        hits = []
+        for path, output_path, page_num, words, snippet in rows:
+            hits.append({
+                "path": path,
+                "output_path": output_path,
+                "page": page_num,
+                "rects": highlight_rects(json.loads(words), terms, phrase=phrase, prefixes=prefixes),
+                "snippet": snippet,
+            })
+        return hits
+
+    def summary(self):
+        row = self.connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(pages), 0), COALESCE(SUM(words), 0) FROM documents WHERE state = 'done'"
+        ).fetchone()
+        return {"documents": row[0], "pages": row[1], "words": row[2]}
+
+    def close(self):
+        self.connection.close()
+
+def highlight_rects(words, terms, phrase=False, prefixes=()):
+    # Rectangles of the stored words ([text, x0, y0, x1, y1]) that make up a match: every word
+    # containing a query term, or with phrase=True, every run of words spelling the whole phrase
+    word_terms = [query_terms(word[0]) for word in words]
+
+    def matches(tokens, term):
+        return term in tokens or (term in prefixes and any(token.startswith(term) for token in tokens))
+
+    if not phrase:
+        return [word[1:] for word, tokens in zip(words, word_terms) if any(matches(tokens, term) for term in terms)]
+
+    # A word can hold several tokens ("e-mail"), so the phrase is matched on the token sequence
+    tokens, owners = [], []
+    for index, word_tokens in enumerate(word_terms):
+        tokens.extend(word_tokens)
+        owners.extend([index] * len(word_tokens))
+    matched = {}
+    for start in range(len(tokens) - len(terms) + 1):
+        if terms and tokens[start:start + len(terms)] == terms:
+            matched.update(dict.fromkeys(owners[start:start + len(terms)]))
+    return [words[index][1:] for index in matched]
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(prog="cli.py search", description="Search the OCR word index.")
+    parser.add_argument("query", help="words to find (all must occur on the page)")
+    parser.add_argument("--index", default=DEFAULT_INDEX_FILE,
+                        help=f"index database (default: {DEFAULT_INDEX_FILE}; the OCR runs write it to their output folder)")
+    parser.add_argument("-n", "--limit", type=int, default=20, help="maximum number of pages to return")
+    parser.add_argument("--phrase", action="store_true", help="match the words as one phrase")
+    parser.add_argument("--raw", action="store_true", help="pass FTS5 query syntax (OR, NOT, NEAR, prefix*) through")
+    parser.add_argument("--json", action="store_true", help="print the hits as JSON")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.index):
+        print(f"No word index at {args.index}")
+        return 1
+    index = WordIndex(args.index)
+    try:
+        start_time = time.perf_counter()
+        try:
+            hits = index.search(args.query, limit=args.limit, phrase=args.phrase, raw=args.raw)
+        except WordIndexError as e:
+            print(e)
+            return 1
+        elapsed_ms = (time.perf_counter() - start_time) * 1000
+    finally:
+        index.close()
+
+    if args.json:
+        json.dump(hits, sys.stdout, indent=4)
+        print()
+        return 0
+    for hit in hits:
+        print(f"{hit['output_path'] or hit['path']}  page {hit['page'] + 1}  ({len(hit['rects'])} highlights)")
+        print(f"    {hit['snippet']}")
+    print(f"{len(hits)} pages found in {elapsed_ms:.1f} ms")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(cli())